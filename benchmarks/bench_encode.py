@@ -0,0 +1,94 @@
+# bench_encode.py
+# 圖片編碼效能測試：以合成的雜訊 + 漸層圖片，比較各種格式 / 品質的編碼耗時與大小，
+# 以及 process pool 同時編碼多張圖的吞吐量，用來決定 IMAGE_FORMAT / IMAGE_QUALITY 等設定。
+#   python benchmarks/bench_encode.py [--size 1024] [--images 16] [--processes 4]
+#   python benchmarks/bench_encode.py --formats JPEG:85,JPEG:70,WEBP:80
+# 需要 PIL。
+import os
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPTS = Path(__file__).resolve().parent.parent / "scripts"
+sys.path.insert(0, str(SCRIPTS))
+
+from PIL import Image  # noqa: E402
+import image_encoder  # noqa: E402
+
+
+def make_image(size: int, seed: int = 0) -> "Image.Image":
+    """漸層加雜訊，壓縮難度接近真實照片（純色圖會讓結果過度樂觀）"""
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient("L").resize((size, size))
+    noise = Image.effect_noise((size, size), 40)
+    channels = [Image.blend(gradient.rotate(rng.choice((0, 90, 180, 270))), noise, 0.35) for _ in range(3)]
+    return Image.merge("RGB", channels)
+
+
+def parse_formats(spec: str) -> list:
+    formats = []
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        fmt, _, quality = item.partition(":")
+        formats.append((fmt.upper(), int(quality or 85)))
+    return formats
+
+
+def bench_formats(image, formats: list, thumbnail: int):
+    print(f"\n--- 單張 {image.size[0]}x{image.size[1]}（本執行緒） ---")
+    for fmt, quality in formats:
+        for progressive in ((True, False) if fmt == "JPEG" else (False,)):
+            options = image_encoder.EncodeOptions(format=fmt, quality=quality, progressive=progressive,
+                                                  thumbnail_size=thumbnail)
+            best = min((image_encoder._encode(image_encoder._source(image), options) for _ in range(3)),
+                       key=lambda r: r["seconds"])
+            label = f"{fmt} q{quality}" + (" progressive" if progressive else "")
+            print(f"{label:24s} {best['seconds'] * 1000:8.1f} ms  {len(best['data']) / 1024:8.1f} KB"
+                  f"  縮圖 {len(best['thumbnail'] or b'') / 1024:6.1f} KB")
+
+
+def bench_pool(images: list, processes: int, options):
+    # get_encode_pool 每次呼叫時才讀 IMAGE_ENCODE_PROCESSES，這裡直接切換
+    image_encoder.IMAGE_ENCODE_PROCESSES = processes
+    encode = lambda image: image_encoder.encode_image_variants(image, options)
+    threads = max(1, processes)
+    try:
+        # 先讓每個子行程完成啟動，避免把 spawn 的時間算進去
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(encode, images[:threads]))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(encode, images))
+        elapsed = time.perf_counter() - start
+    finally:
+        image_encoder.shutdown_encode_pool()
+    total = sum(len(r["data"]) + len(r["thumbnail"] or b"") for r in results)
+    label = f"{processes} processes" if processes else "inline"
+    print(f"{label:24s} {len(images)} 張 {elapsed:6.2f}s  {len(images) / elapsed:6.1f} 張/s"
+          f"  平均 {total / len(images) / 1024:.1f} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="圖片編碼效能測試")
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--images", type=int, default=16)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--thumbnail", type=int, default=256)
+    parser.add_argument("--formats", default="JPEG:85,JPEG:70,WEBP:80,WEBP:60")
+    args = parser.parse_args()
+
+    images = [make_image(args.size, seed) for seed in range(args.images)]
+    formats = parse_formats(args.formats)
+    bench_formats(images[0], formats, args.thumbnail)
+
+    fmt, quality = formats[0]
+    options = image_encoder.EncodeOptions(format=fmt, quality=quality, thumbnail_size=args.thumbnail)
+    print(f"\n--- {args.images} 張，{fmt} q{quality} ---")
+    for processes in sorted({0, args.processes}):
+        bench_pool(images, processes, options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# bench_parser.py
+# LLM 回應解析器的微型效能測試與語料驗證：
+#   python benchmarks/bench_parser.py [--repeat 2000]
+# 1. 以 parser_corpus/ 的正常與格式錯誤回應驗證 parse_response 的錯誤回報是否符合 expected.json
+# 2. 比較舊版（多次 split / regex）與新版單次掃描解析器的耗時
+import re
+import sys
+import json
+import timeit
+import argparse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT.parent / "scripts"))
+
+from response_parser import parse_response  # noqa: E402
+
+CORPUS = ROOT / "parser_corpus"
+
+
+# === 舊版解析（保留作為比較基準） ===
+def legacy_extract_between(text, start_marker, end_marker):
+    try:
+        return text.split(start_marker)[1].split(end_marker)[0].strip()
+    except IndexError:
+        return ""
+def legacy_extract_list_after(text, marker):
+    try:
+        section = text.split(marker)[1]
+        return [line[1:].strip() for line in section.strip().split("\n") if line.startswith("-")]
+    except IndexError:
+        return []
+def legacy_extract_response_parts(content):
+    return {
+        "story": legacy_extract_between(content, "###STORY:", "###SUMMARY:"),
+        "summary": legacy_extract_between(content, "###SUMMARY:", "###PROMPTS:"),
+        "prompt_list": legacy_extract_list_after(content, "###PROMPTS:"),
+    }
+def legacy_extract_response(text):
+    story_match = re.search(r"###STORY:\s*(.*?)\s*###SUMMARY:", text, re.DOTALL)
+    summary_match = re.search(r"###SUMMARY:\s*(.*?)\s*###PROMPTS:", text, re.DOTALL)
+    prompts_match = re.findall(r"-\s*(.+)", text.split("###PROMPTS:")[-1])
+    return story_match, summary_match, prompts_match
+
+
+def load_corpus() -> dict:
+    return {p.name: p.read_bytes().decode("utf-8") for p in sorted(CORPUS.glob("*.txt"))}  # 保留 CRLF
+
+
+def check_corpus(corpus: dict) -> bool:
+    expected = json.loads((CORPUS / "expected.json").read_text(encoding="utf-8"))
+    ok = True
+    for name, text in corpus.items():
+        got = [[e.section, e.code] for e in parse_response(text).errors]
+        want = expected.get(name)
+        status = "✅" if got == want else "❌"
+        ok &= got == want
+        print(f"{status} {name:36s} errors={got}" + ("" if got == want else f" expected={want}"))
+    return ok
+
+
+def bench(corpus: dict, repeat: int):
+    texts = list(corpus.values())
+    # 放大成較長的回應，觀察長度成長時的差異
+    long_texts = [t.replace("\n\n", "\n\n" + "More story text. " * 200 + "\n\n", 1) for t in texts]
+    cases = {
+        "legacy extract_response_parts": lambda ts: [legacy_extract_response_parts(t) for t in ts],
+        "legacy extract_response": lambda ts: [legacy_extract_response(t) for t in ts],
+        "parse_response": lambda ts: [parse_response(t) for t in ts],
+    }
+    for label, data in (("corpus", texts), ("corpus x long story", long_texts)):
+        print(f"\n--- {label}：{len(data)} 筆 × {repeat} 次 ---")
+        for name, fn in cases.items():
+            seconds = min(timeit.repeat(lambda: fn(data), number=repeat, repeat=3))
+            per_doc_us = seconds / (repeat * len(data)) * 1e6
+            print(f"{name:32s} {per_doc_us:8.2f} µs / 筆")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM 回應解析器效能測試")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    ok = check_corpus(corpus)
+    bench(corpus, args.repeat)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# bench_pipeline.py
+# 離線端到端效能測試：本機資料夾當 bucket、fake_services 模擬 OpenRouter / ImgBB，
+# 依序執行 setup_today_structure.py → generate_story.py → generate_image.py，
+# 報告每個階段的耗時、往返次數、傳輸量與記憶體峰值。
+#   python benchmarks/bench_pipeline.py [--chars 1,10,100] [--latency 0.05] [--error-rate 0.02] [--rate-429 0.05]
+#   python benchmarks/bench_pipeline.py --save results.json              # 存下結果
+#   python benchmarks/bench_pipeline.py --baseline results.json          # 往返次數比基準多超過 --tolerance 時回傳 1
+# 需要與正式流程相同的套件（PIL、requests 等），不需要 Firebase 與任何 API key。
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+SCRIPTS = ROOT.parent / "scripts"
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(SCRIPTS))
+
+from fake_services import FakeServices, CHAT_PATH, UPLOAD_PATH  # noqa: E402
+
+STAGES = [
+    ("setup", "setup_today_structure.py"),
+    ("story", "generate_story.py"),
+    ("image", "generate_image.py"),
+]
+STORAGE_OPS = ("read", "write", "list", "stat", "delete", "compose")
+
+# 子行程：執行階段腳本後，印出本行程的量測計數與記憶體峰值
+RUNNER = """
+import sys, json, runpy, resource
+sys.path.insert(0, {scripts!r})
+sys.argv = [{script!r}]
+runpy.run_path({script!r}, run_name="__main__")
+import metrics
+print("BENCH_RESULT " + json.dumps({{
+    "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "counters": metrics.snapshot()["counters"],
+}}))
+"""
+
+
+# === 準備資料 ===
+def seed_bucket(root: Path, n_chars: int):
+    """建立今天的主題檔與角色卡（日期與正式流程一樣取台北時間今天）"""
+    from settings import get_settings
+    from storage_backend import LocalBackend
+    from firebase_config import get_theme_path
+
+    day = get_settings().day
+    store = LocalBackend(str(root))
+    cids = [f"bench_{i:03d}" for i in range(n_chars)]
+    theme = {day.today: [{"character_id": cid, "theme": {"title": f"Bench Theme {i}"}} for i, cid in enumerate(cids)]}
+    store.write(get_theme_path(day.year, day.week_num), json.dumps(theme).encode("utf-8"), "application/json")
+    for cid in cids:
+        card = {"id": cid, "name": cid.replace("_", " ").title()}
+        store.write(f"characters/data/{cid}.json", json.dumps(card).encode("utf-8"), "application/json")
+
+
+def stage_env(workdir: Path, services: FakeServices, args) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "STORAGE_BACKEND": "local",
+        "LOCAL_STORAGE_ROOT": str(workdir / "bucket"),
+        "STORAGE_CACHE_DIR": str(workdir / "cache"),
+        "OPENROUTER_URL": services.base_url + CHAT_PATH,
+        "IMGBB_UPLOAD_URL": services.base_url + UPLOAD_PATH,
+        "OR_DEEPKEEP_R1_API": "bench",
+        "IMG_BB_API_KEY": "bench",
+        "LLM_CACHE_BYPASS": "1",
+        "METRICS_ENABLED": "1",
+        "RATE_LIMITS": args.rate_limits,
+        "HTTP_BACKOFF_BASE": "0.05",
+        "HTTP_BACKOFF_MAX": "0.5",
+        "STORY_STREAMING": "1" if args.stream else "0",
+    })
+    return env
+
+
+# === 執行與統計 ===
+def run_stage(script: str, env: dict, cwd: Path) -> dict:
+    code = RUNNER.format(scripts=str(SCRIPTS), script=str(SCRIPTS / script))
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", code], env=env, cwd=cwd, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    result = next((json.loads(line[len("BENCH_RESULT "):]) for line in proc.stdout.splitlines()
+                   if line.startswith("BENCH_RESULT ")), None)
+    if proc.returncode != 0 or result is None:
+        sys.stderr.write(proc.stdout[-2000:] + proc.stderr[-4000:])
+        raise RuntimeError(f"{script} 執行失敗（exit {proc.returncode}）")
+    result["wall"] = wall
+    return result
+
+
+def summarize(result: dict, server: dict) -> dict:
+    c = result["counters"]
+    storage_calls = sum(c.get(f"storage.{op}", 0) for op in STORAGE_OPS)
+    return {
+        "wall_s": round(result["wall"], 3),
+        "storage_calls": storage_calls,
+        "storage_bytes": c.get("storage.read.bytes", 0) + c.get("storage.write.bytes", 0),
+        "http_calls": c.get("http.calls", 0),
+        "http_retries": c.get("http.retries", 0),
+        "http_bytes": server.get("bytes_in", 0) + server.get("bytes_out", 0),
+        "round_trips": storage_calls + c.get("http.calls", 0),
+        "peak_mb": round(result["maxrss_kb"] / 1024, 1),
+    }
+
+
+def bench(n_chars: int, args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix=f"bench_{n_chars}_"))
+    try:
+        seed_bucket(workdir / "bucket", n_chars)
+        with FakeServices(args.latency, args.error_rate, args.rate_429, seed=args.seed) as services:
+            env = stage_env(workdir, services, args)
+            report = {}
+            for stage, script in STAGES:
+                services.reset_stats()
+                result = run_stage(script, env, workdir)
+                report[stage] = summarize(result, services.reset_stats())
+            return report
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+# === 輸出 ===
+COLUMNS = ["wall_s", "round_trips", "storage_calls", "storage_bytes", "http_calls", "http_retries", "http_bytes", "peak_mb"]
+def print_table(results: dict):
+    print(f"{'chars':>5} {'stage':6} " + " ".join(f"{c:>13}" for c in COLUMNS))
+    for n, report in results.items():
+        for stage, row in report.items():
+            print(f"{n:>5} {stage:6} " + " ".join(f"{row[c]:>13}" for c in COLUMNS))
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """比較往返次數與傳輸量，回傳超出容許範圍的項目"""
+    regressions = []
+    for n, report in results.items():
+        for stage, row in report.items():
+            base = baseline.get(str(n), {}).get(stage)
+            if not base:
+                continue
+            for key in ("round_trips", "storage_bytes", "http_bytes"):
+                if row[key] > base[key] * (1 + tolerance):
+                    regressions.append(f"{n} chars / {stage}: {key} {base[key]} → {row[key]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chars", default="1,10,100", help="每天角色數，逗號分隔")
+    parser.add_argument("--latency", type=float, default=0.05, help="模擬服務每個請求的延遲（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回傳 500 的比例")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="回傳 429 的比例")
+    parser.add_argument("--stream", action="store_true", help="以 SSE 串流呼叫 LLM")
+    parser.add_argument("--rate-limits", default="openrouter=1000:1000,imgbb=1000:1000",
+                        help="傳給 RATE_LIMITS；預設放寬，只量測 I/O 模式")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="把結果存成 JSON")
+    parser.add_argument("--baseline", help="與先前存下的 JSON 比較")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="容許的增加比例")
+    parser.add_argument("--keep", action="store_true", help="保留暫存 bucket 以便檢查")
+    args = parser.parse_args()
+
+    results = {}
+    for n in (int(x) for x in args.chars.split(",") if x.strip()):
+        print(f"▶️ {n} 位角色…", flush=True)
+        results[n] = bench(n, args)
+    print_table(results)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"💾 已儲存：{args.save}")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"❌ {line}")
+        if regressions:
+            sys.exit(1)
+        print("✅ 沒有超出基準的 I/O 回歸")
+
+
+if __name__ == "__main__":
+    main()
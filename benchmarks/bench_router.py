@@ -0,0 +1,106 @@
+# bench_router.py
+# LLM 路由測試：兩個本機模擬端點，主要路線有長尾延遲（每 N 個請求有一個很慢）、可設定錯誤率，
+# 備用路線延遲穩定，比較「只用主要路線」「failover」「failover + hedge」的延遲分布與請求數。
+#   python benchmarks/bench_router.py [--calls 60] [--concurrency 4] [--slow 1.5 --slow-every 10] [--error-rate 0.1]
+# 需要 requests。
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT.parent / "scripts"))
+os.environ.setdefault("HTTP_BACKOFF_BASE", "0.05")     # http_client / llm_router 在 import 時讀取設定
+os.environ.setdefault("LLM_HEDGE_MIN_DELAY", "0.05")    # 模擬端點的延遲是毫秒級
+
+from fake_services import FakeServices, CHAT_PATH  # noqa: E402
+import http_client  # noqa: E402
+from llm_router import LLMRouter, Route  # noqa: E402
+
+KEY_ENV = "BENCH_ROUTER_KEY"
+
+
+def send(route: Route, cancel) -> dict:
+    # 與 utils 相同以串流送出，被 hedge 取消時關閉連線
+    response = http_client.post(
+        route.url,
+        headers={"Authorization": f"Bearer {os.environ[route.key_env]}"},
+        json={"model": route.model, "stream": True,
+              "messages": [{"role": "user", "content": str(time.time_ns())}]},
+        max_retries=0,
+        stream=True,
+    )
+    try:
+        response.raise_for_status()
+        lines = 0
+        for line in http_client.iter_lines(response):
+            if cancel.is_set():
+                raise RuntimeError("已取消")
+            lines += bool(line)
+        return {"lines": lines}
+    finally:
+        response.close()
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_case(name: str, router: LLMRouter, calls: int, concurrency: int, services: list):
+    for s in services:
+        s.reset_stats()
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            router.call(send)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(calls)))
+    latencies = [t for t, e in results if e is None]
+    failed = sum(1 for _, e in results if e is not None)
+    requests_sent = [s.stats.get("llm.requests", 0) for s in services]
+    if latencies:
+        print(f"{name:22s} p50 {percentile(latencies, 0.5):6.3f}s  p95 {percentile(latencies, 0.95):6.3f}s"
+              f"  max {max(latencies):6.3f}s  失敗 {failed:3d}  請求數 主要/備用 {requests_sent[0]}/{requests_sent[1]}")
+    else:
+        print(f"{name:22s} 全部失敗（{failed}）")
+    for route, stats in router.snapshot().items():
+        print(f"    {route:36s} {stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM 路由 failover / hedge 測試")
+    parser.add_argument("--calls", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--slow", type=float, default=1.5, help="主要路線長尾請求的延遲")
+    parser.add_argument("--slow-every", type=int, default=10, help="主要路線每幾個請求有一個很慢")
+    parser.add_argument("--error-rate", type=float, default=0.1, help="主要路線回傳 500 的比例")
+    args = parser.parse_args()
+
+    os.environ[KEY_ENV] = "bench"
+    script = [args.latency] * (args.slow_every - 1) + [args.slow]
+    with FakeServices(latency_script=script, error_rate=args.error_rate, seed=1) as primary, \
+            FakeServices(latency=args.latency * 2, seed=2) as backup:
+        main_route = Route("primary", "fake-main", primary.base_url + CHAT_PATH, KEY_ENV)
+        backup_route = Route("backup", "fake-backup", backup.base_url + CHAT_PATH, KEY_ENV)
+        services = [primary, backup]
+        print(f"--- {args.calls} 次呼叫，同時 {args.concurrency} 個 ---")
+        run_case("只用主要路線", LLMRouter([main_route], cooldown=0), args.calls, args.concurrency, services)
+        run_case("failover", LLMRouter([main_route, backup_route], cooldown=0), args.calls, args.concurrency, services)
+
+        hedged = LLMRouter([main_route, backup_route], hedge=True, cooldown=0)
+        run_case("failover + hedge（暖機）", hedged, args.calls, args.concurrency, services)
+        run_case("failover + hedge", hedged, args.calls, args.concurrency, services)
+
+
+if __name__ == "__main__":
+    main()
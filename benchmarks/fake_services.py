@@ -0,0 +1,157 @@
+# fake_services.py
+# 本機模擬的 OpenRouter / ImgBB，給 bench_pipeline.py 在離線環境下跑完整流程：
+#   POST /api/v1/chat/completions   回傳格式正確的故事（支援 stream=true 的 SSE）
+#   POST /1/upload                  回傳假的圖片網址
+# 可設定延遲、錯誤率（HTTP 500）與 429 比例，並統計請求數與傳輸量。
+# latency_script 可指定每個請求依序使用的延遲（循環使用），用來模擬長尾延遲。
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHAT_PATH = "/api/v1/chat/completions"
+UPLOAD_PATH = "/1/upload"
+
+
+def fake_story(seed: str, prompts: int = 10) -> str:
+    """依請求內容產生固定的 ###STORY / ###SUMMARY / ###PROMPTS 回應"""
+    tag = hashlib.sha1(seed.encode("utf-8")).hexdigest()[:8]
+    story = " ".join(f"Scene {i} of tale {tag}: the little animal walks through the quiet forest." for i in range(1, 25))
+    lines = [f"- prompt {i} for {tag}, watercolor, soft light, wide shot" for i in range(1, prompts + 1)]
+    return f"###STORY:\n{story}\n\n###SUMMARY:\nA short gentle tale {tag}.\n\n###PROMPTS:\n" + "\n".join(lines) + "\n"
+
+
+class FakeServices:
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0, rate_429: float = 0.0,
+                 stream_chunks: int = 40, seed: int = 0, latency_script: list = None):
+        self.latency = latency           # 每個請求的基本延遲（秒）
+        self.error_rate = error_rate     # 回傳 500 的機率
+        self.rate_429 = rate_429         # 回傳 429 的機率
+        self.stream_chunks = stream_chunks
+        self.latency_script = list(latency_script or [])
+        self._served = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {}
+        self._server = None
+        self._thread = None
+
+    # === 統計 ===
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+    def _roll(self) -> float:
+        with self._lock:
+            return self._random.random()
+    def _next_latency(self) -> float:
+        with self._lock:
+            self._served += 1
+            if not self.latency_script:
+                return self.latency
+            return self.latency_script[(self._served - 1) % len(self.latency_script)]
+    def reset_stats(self) -> dict:
+        with self._lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    # === 啟動 / 停止 ===
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive，才量得到連線池的效果
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                services._handle(self)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # === 請求處理 ===
+    def _send(self, handler, status: int, body: bytes, content_type: str = "application/json", headers: dict = None):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            handler.send_header(k, v)
+        handler.end_headers()
+        handler.wfile.write(body)
+        self._count("bytes_out", len(body))
+
+    def _handle(self, handler):
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        path = handler.path.split("?", 1)[0]
+        endpoint = "llm" if path == CHAT_PATH else "upload" if path == UPLOAD_PATH else "other"
+        self._count(f"{endpoint}.requests")
+        self._count("bytes_in", len(body))
+        time.sleep(self._next_latency())
+
+        roll = self._roll()
+        if roll < self.rate_429:
+            self._count(f"{endpoint}.429")
+            return self._send(handler, 429, b'{"error":"rate limited"}', headers={"Retry-After": "0.2"})
+        if roll < self.rate_429 + self.error_rate:
+            self._count(f"{endpoint}.500")
+            return self._send(handler, 500, b'{"error":"internal"}')
+
+        if endpoint == "llm":
+            return self._chat(handler, json.loads(body or b"{}"))
+        if endpoint == "upload":
+            url = f"https://i.example.test/{hashlib.sha1(body).hexdigest()[:16]}.jpg"
+            return self._send(handler, 200, json.dumps({"data": {"url": url}}).encode("utf-8"))
+        self._send(handler, 404, b'{"error":"not found"}')
+
+    def _chat(self, handler, payload: dict):
+        content = fake_story(json.dumps(payload.get("messages", []), sort_keys=True))
+        usage = {"prompt_tokens": 600, "completion_tokens": len(content) // 4}
+        model = payload.get("model", "fake")
+        if not payload.get("stream"):
+            body = {"model": model, "usage": usage,
+                    "choices": [{"message": {"role": "assistant", "content": content}}]}
+            return self._send(handler, 200, json.dumps(body).encode("utf-8"))
+
+        # SSE：內容切成多段，每段間隔一點時間，模擬逐 token 輸出
+        size = max(1, len(content) // self.stream_chunks)
+        events = [": keep-alive\n\n"]
+        for i in range(0, len(content), size):
+            chunk = {"model": model, "choices": [{"delta": {"content": content[i:i + size]}}]}
+            events.append(f"data: {json.dumps(chunk)}\n\n")
+        events.append(f"data: {json.dumps({'model': model, 'choices': [], 'usage': usage})}\n\n")
+        events.append("data: [DONE]\n\n")
+        encoded = [e.encode("utf-8") for e in events]
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Content-Length", str(sum(len(e) for e in encoded)))
+        handler.end_headers()
+        for event in encoded:
+            handler.wfile.write(event)
+            handler.wfile.flush()
+            time.sleep(self.latency / len(encoded))
+        self._count("bytes_out", sum(len(e) for e in encoded))
@@ -0,0 +1,139 @@
+# backfill.py
+# 補跑一段日期的內容：
+#   python backfill.py 2025-06-01 2025-06-14 [--stages setup,story,image] [--workers 4]
+# 1. 解析每一天的主題（優先讀主題索引；沒有索引時同一個週主題檔只讀一次）
+# 2. 每天建立 story 檔、log.json 與 today_paths（多天同時進行）
+# 3. 故事：依角色分片交給 worker pool，同一角色的日期依序處理，記憶與檢索索引才會照時間累積
+# 4. 圖片：每天一條「生成 → 編碼 → 上傳」管線，多天同時進行
+# 5. 週檔內容與 checkpoint 在同一個 unit of work 中寫出（中途中斷也不會遺失已標記完成的內容），
+#    分段以該日 00:00 排序，讀取與合併時仍依日期先後
+import os
+import argparse
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from settings import load_env, DayContext
+from metrics import span, write_run_summary
+from firebase_config import get_theme_path
+from theme_index import load_day_themes
+from utils import (
+    load_theme_file,
+    get_today_characters,
+    read_json_from_firebase,
+    get_today_paths_path,
+    log_and_print,
+)
+from setup_today_structure import setup_day
+from generate_story import generate_character_story
+from generate_image import generate_all_images
+
+load_env()
+
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "4"))
+STAGES = ("setup", "story", "image")
+
+
+def date_range(start, end) -> list:
+    """回傳 start ~ end（含）每一天的 DayContext"""
+    first, last = DayContext.for_date(start).date, DayContext.for_date(end).date
+    if last < first:
+        raise ValueError(f"結束日期 {last} 早於開始日期 {first}")
+    return [DayContext(first + timedelta(days=i)) for i in range((last - first).days + 1)]
+
+
+# === 各階段 ===
+def resolve_themes(days: list) -> dict:
+    """回傳 {date: {character_id: theme}}；優先讀主題索引，沒有索引的日期才讀週主題檔（同一個檔只讀一次）"""
+    loaded, themes = {}, {}
+    for day in days:
+        character_themes = load_day_themes(day.today)
+        if character_themes is None:
+            path = get_theme_path(day.year, day.week_num, day.month)
+            if path not in loaded:
+                loaded[path] = load_theme_file(path) or {}
+            character_themes = get_today_characters(loaded[path], day.today)
+        themes[day.today] = character_themes
+    return themes
+
+
+def backfill_setup(days: list, workers: int) -> dict:
+    themes = resolve_themes(days)
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="backfill_setup") as pool:
+        results = pool.map(lambda day: setup_day(day, themes[day.today]), days)
+        return {day.today: paths for day, paths in zip(days, results)}
+
+
+def load_day_paths(days: list) -> dict:
+    """跳過 setup 時，讀取先前建立的 today_paths"""
+    return {day.today: read_json_from_firebase(get_today_paths_path(day.year_month, day.today)) or {}
+            for day in days}
+
+
+def backfill_stories(days: list, day_paths: dict, workers: int) -> dict:
+    by_character = {}
+    for day in days:
+        for cid, info in day_paths.get(day.today, {}).items():
+            if "theme" in info:
+                by_character.setdefault(cid, []).append((day, info))
+
+    def run_character(cid: str) -> dict:
+        results = {}
+        for day, info in by_character[cid]:
+            try:
+                results[day.today] = generate_character_story(cid, info, day=day)
+            except Exception as e:
+                log_and_print(f"❌ [{cid}] {day.today} 故事生成失敗：{e}\n", error_type="ERROR")
+                results[day.today] = {"character": cid, "error": str(e)}
+        return results
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="backfill_story") as pool:
+        futures = {cid: pool.submit(run_character, cid) for cid in by_character}
+        return {cid: future.result() for cid, future in futures.items()}
+
+
+def backfill_images(days: list, day_paths: dict, workers: int):
+    todo = [day for day in days if any("theme" in info for info in day_paths.get(day.today, {}).values())]
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="backfill_image") as pool:
+        futures = {day.today: pool.submit(generate_all_images, day_paths[day.today], day) for day in todo}
+        for date_str, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                log_and_print(f"❌ {date_str} 圖片生成失敗：{e}\n", error_type="ERROR")
+
+
+def backfill(start, end, stages=STAGES, workers: int = BACKFILL_WORKERS) -> dict:
+    days = date_range(start, end)
+    stories = {}
+    with span("stage.backfill.setup", days=len(days)):
+        day_paths = backfill_setup(days, workers) if "setup" in stages else load_day_paths(days)
+    if "story" in stages:
+        with span("stage.backfill.story"):
+            stories = backfill_stories(days, day_paths, workers)
+    if "image" in stages:
+        with span("stage.backfill.image"):
+            backfill_images(days, day_paths, workers)
+    return stories
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("start", help="開始日期 YYYY-MM-DD")
+    parser.add_argument("end", help="結束日期 YYYY-MM-DD（含）")
+    parser.add_argument("--stages", default=",".join(STAGES), help="要執行的階段，逗號分隔")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    args = parser.parse_args()
+
+    stages = tuple(s.strip() for s in args.stages.split(",") if s.strip())
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"未知的階段：{', '.join(sorted(unknown))}")
+
+    stories = backfill(args.start, args.end, stages, args.workers)
+    total = sum(len(r) for r in stories.values())
+    failed = sum(1 for r in stories.values() for v in r.values() if "error" in v)
+    log_and_print(f"📊 補跑 {args.start} ~ {args.end} 結束：故事成功 {total - failed} / {total}\n", error_type="OK")
+    write_run_summary("backfill", args.start)
+
+
+if __name__ == "__main__":
+    main()
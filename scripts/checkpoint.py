@@ -0,0 +1,103 @@
+# checkpoint.py
+# 每位角色每天的進度紀錄，放在 log.json 旁邊：
+#   logs/characters/{cid}/{date}_{theme}_checkpoint.json
+#   {
+#     "date": ..., "character": ..., "theme": ...,
+#     "stages": {"setup": {"done_at": ...}, "story": {...}, "image": {...}},
+#     "images": {"1": "https://...", ...}      # 已上傳的圖片（依 prompt 編號）
+#     "thumbnails": {"1": "https://...", ...}  # 對應的縮圖（有產生時）
+#   }
+# 各階段開始前先檢查，已完成的直接略過；圖片逐張記錄，重跑時只補上還沒完成的那幾張。
+# 故事重新生成後 prompt 會改變，因此完成 story 時會一併清掉圖片進度。
+# 有綁定 unit of work 時，階段完成的標記延到資料 commit 之後才寫入。
+import os
+from datetime import datetime
+from settings import load_env
+from storage_backend import get_storage, PreconditionError
+from serialization import decode, read_object, write_object
+from firebase_config import get_checkpoint_path
+from unit_of_work import current_unit_of_work
+
+load_env()
+
+CHECKPOINTS_ENABLED = os.getenv("CHECKPOINTS_ENABLED", "1") == "1"   # 0：一律重做（仍會記錄進度）
+STAGES = ("setup", "story", "image")
+
+
+class Checkpoint:
+    def __init__(self, cid: str, date: str, theme_slug: str):
+        self.cid = cid
+        self.date = date
+        self.theme = theme_slug
+        self.path = get_checkpoint_path(cid, date, theme_slug)
+        self._state = None
+
+    def _empty(self) -> dict:
+        return {"date": self.date, "character": self.cid, "theme": self.theme, "stages": {}, "images": {}}
+
+    # === 讀取 ===
+    def load(self) -> dict:
+        """讀取最新進度（不經過快取，避免拿到其他程序更新前的版本）"""
+        self._state = read_object(self.path, cached=False) or self._empty()
+        return self._state
+
+    @property
+    def state(self) -> dict:
+        return self._state if self._state is not None else self.load()
+
+    def is_done(self, stage: str) -> bool:
+        return CHECKPOINTS_ENABLED and stage in self.state["stages"]
+
+    def image_urls(self) -> dict:
+        """已上傳的圖片 {編號: url}"""
+        if not CHECKPOINTS_ENABLED:
+            return {}
+        return {int(k): v for k, v in self.state["images"].items()}
+
+    def thumbnail_urls(self) -> dict:
+        if not CHECKPOINTS_ENABLED:
+            return {}
+        return {int(k): v for k, v in self.state.get("thumbnails", {}).items()}
+
+    # === 寫入 ===
+    def _update(self, change, max_attempts: int = 5):
+        """以 generation 前置條件更新，衝突時重讀後再套用一次 change(state)"""
+        store = get_storage()
+        for _ in range(max_attempts):
+            obj = store.backend.read(self.path)
+            state = decode(obj.data) if obj else self._empty()
+            change(state)
+            try:
+                write_object(self.path, state, if_generation_match=obj.generation if obj else 0)
+                self._state = state
+                return
+            except PreconditionError:
+                continue
+        raise RuntimeError(f"進度紀錄更新失敗（多次衝突）：{self.path}")
+
+    def mark_done(self, stage: str):
+        if stage not in STAGES:
+            raise ValueError(f"未知的階段：{stage}")
+
+        def change(state):
+            state["stages"][stage] = {"done_at": datetime.now().isoformat()}
+            if stage == "story":
+                # 新故事代表新的 prompt，舊的圖片進度不再適用
+                state["stages"].pop("image", None)
+                state["images"] = {}
+                state["thumbnails"] = {}
+        uow = current_unit_of_work()
+        if uow is None:
+            self._update(change)
+            return
+        # 有 unit of work 時，等暫存的資料寫入後才標記完成；本地狀態先更新
+        change(self.state)
+        uow.after_commit(lambda: self._update(change))
+
+    def mark_image(self, index: int, url: str, thumbnail_url: str = None):
+        """圖片已上傳到外部服務，進度立即寫入（不等 unit of work）"""
+        def change(state):
+            state["images"][str(index)] = url
+            if thumbnail_url:
+                state.setdefault("thumbnails", {})[str(index)] = thumbnail_url
+        self._update(change)
@@ -0,0 +1,104 @@
+# completion_cache.py
+# LLM 回應快取：以 (model, system_prompt, user_prompt, temperature, max_tokens) 的雜湊為 key，
+# 透過 storage_backend 存成 cache/completions/{key}.json，重跑或補跑同一天時不必再呼叫 LLM。
+#   - LLM_CACHE_TTL：有效秒數，過期視為未命中（每筆自己記錄建立時間，不需要共用的索引檔）
+#   - LLM_CACHE_MAX_ENTRIES：最多保留幾筆；寫入時每隔 LLM_CACHE_PRUNE_INTERVAL 秒（行程啟動後第一次要等滿間隔）
+#     列出一次 prefix，依列表上的寫入時間刪除過期的項目，仍超量時從最舊的開始刪除（不下載任何項目）
+#   - LLM_CACHE_BYPASS=1：不讀快取（仍會寫入新結果）
+import os
+import json
+import time
+import hashlib
+import threading
+from storage_backend import get_storage
+from serialization import decode, write_object
+from settings import load_env
+from metrics import incr
+
+load_env()
+
+LLM_CACHE_PREFIX = "cache/completions/"
+LLM_CACHE_LEGACY_INDEX = f"{LLM_CACHE_PREFIX}index.json"   # 舊版的共用索引，清理時順便刪除
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "500"))
+LLM_CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "0") == "1"
+LLM_CACHE_PRUNE_INTERVAL = float(os.getenv("LLM_CACHE_PRUNE_INTERVAL", "3600"))
+
+
+def completion_key(payload: dict) -> str:
+    """只取會影響輸出的欄位計算雜湊"""
+    inputs = {
+        "model": payload.get("model"),
+        "messages": payload.get("messages"),
+        "temperature": payload.get("temperature"),
+        "max_tokens": payload.get("max_tokens"),
+    }
+    raw = json.dumps(inputs, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    def __init__(self, ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 bypass: bool = LLM_CACHE_BYPASS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self._lock = threading.Lock()
+        self._last_prune = time.time()   # 短暫執行的階段腳本不在寫入路徑上清理；常駐的排程器每隔一段時間清理
+
+    def _path(self, key: str) -> str:
+        return f"{LLM_CACHE_PREFIX}{key}.json"
+
+    def get(self, key: str):
+        """回傳快取的原始回應 dict，未命中、過期或 bypass 時回傳 None"""
+        if self.bypass:
+            return None
+        obj = get_storage().read(self._path(key))
+        if obj is None:
+            incr("cache.llm.miss")
+            return None
+        entry = decode(obj.data)
+        if time.time() - entry.get("created_at", 0) > self.ttl:
+            incr("cache.llm.expired")
+            return None
+        incr("cache.llm.hit")
+        return entry["response"]
+
+    def put(self, key: str, response: dict):
+        write_object(self._path(key), {"created_at": time.time(), "response": response})
+        if time.time() - self._last_prune >= LLM_CACHE_PRUNE_INTERVAL:
+            try:
+                self.prune()
+            except Exception as e:
+                print(f"⚠️ LLM 快取清理失敗：{e}")
+
+    def prune(self) -> int:
+        """
+        列出 prefix，刪除過期的項目，仍超過 max_entries 時從最舊的開始刪除，回傳刪除筆數。
+        每筆的年齡取自列表上的最後寫入時間（每筆只寫一次，與 created_at 相同），不必下載內容；
+        每筆只由自己的檔案決定去留，多個行程同時清理最多重複刪除，不會互相衝突。
+        """
+        with self._lock:
+            self._last_prune = time.time()
+            store = get_storage()
+            ages = store.list_updated(LLM_CACHE_PREFIX)
+            if ages.pop(LLM_CACHE_LEGACY_INDEX, None) is not None:
+                store.delete(LLM_CACHE_LEGACY_INDEX)
+
+            now = time.time()
+            expired = [p for p, t in ages.items() if now - t > self.ttl]
+            alive = sorted((p for p in ages if p not in expired), key=ages.get)
+            evicted = expired + alive[:max(0, len(alive) - self.max_entries)]
+            for path in evicted:
+                store.delete(path)
+            incr("cache.llm.evicted", len(evicted))
+            return len(evicted)
+
+
+_cache = None
+
+def get_completion_cache() -> CompletionCache:
+    global _cache
+    if _cache is None:
+        _cache = CompletionCache()
+    return _cache
@@ -1,33 +1,65 @@
 # config.py
+# 日期與 today_paths 都是延遲求值：import 時不會連線，第一次讀取屬性時才計算。
+# 仍可照舊 `from config import TODAY, year_month, week_num`。
 
+import os
 from pathlib import Path
-from zoneinfo import ZoneInfo
-from datetime import datetime
-from utils import get_today_paths
-from datetime import date
-
-
-# === 今日日期資訊 ===
-TIMEZONE = "Asia/Taipei"
-tz = ZoneInfo(TIMEZONE)
-now = datetime.now(tz)
-TODAY = now.strftime("%Y-%m-%d")     # 格式為 2025-06-23
-year = TODAY[:4]        # 格式為 "2025"
-year_month = TODAY[:7]  # 格式為 "2025-06"
-week_only = now.strftime("%W")     # 只取週數（兩位數字）       ##(%U)：一週從週日開始
-week_num = f"W{date.today().isocalendar()[1]}" # 組成 "W26"    ##(%W)：一週從週一開始（通常ISO格式）
-today_str = now.strftime("%Y-%m-%d %H:%M")  # 加入時間
+from settings import load_env, get_settings
+
+load_env()
 
 # === 專案根目錄 ===
 BASE_PATH = Path(__file__).resolve().parent.parent
 
 # === 常用路徑變數 ===
-THEME_PATH = BASE_PATH / "themes" / f"{year}_themes.json"
 CHARACTERS_PATH = BASE_PATH / "characters"
 LOGS_PATH = BASE_PATH / "logs"
 
-# === 角色與主題 ===
-# 自動初始化 today_paths（若不存在會建立）
-today_paths = get_today_paths()
+# === 並行設定 ===
+STORY_CONCURRENCY = int(os.getenv("STORY_CONCURRENCY", "4"))   # 同時生成故事的角色數
+STORY_STREAMING = os.getenv("STORY_STREAMING", "1") == "1"      # 以串流方式呼叫 LLM（prompt 完成就能開始預先生圖）
+IMAGE_GEN_WORKERS = int(os.getenv("IMAGE_GEN_WORKERS", "2"))    # 圖片生成執行緒數
+IMAGE_PREFETCH = os.getenv("IMAGE_PREFETCH", "1") == "1"        # 排程／補跑時，故事串流出的 prompt 先開始生圖
+IMAGE_PREFETCH_WORKERS = int(os.getenv("IMAGE_PREFETCH_WORKERS", str(IMAGE_GEN_WORKERS)))
+IMAGE_ENCODE_WORKERS = int(os.getenv("IMAGE_ENCODE_WORKERS", str(os.cpu_count() or 2)))  # 同時送進編碼 process pool 的圖片數
+IMAGE_UPLOAD_WORKERS = int(os.getenv("IMAGE_UPLOAD_WORKERS", "3"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))  # 各階段之間的 queue 上限
+
+# === 今日日期資訊（延遲求值） ===
+_DAY_ATTRS = {
+    "TODAY": "today",            # 格式為 2025-06-23
+    "year": "year",              # 格式為 "2025"
+    "year_month": "year_month",  # 格式為 "2025-06"
+    "week_only": "week_only",    # 只取週數（兩位數字）
+    "week_num": "week_num",      # 組成 "W26"
+}
+_today_paths = None
+
+
+def get_today_paths():
+    # 第一次使用時才載入 utils（以及 Firebase）
+    from utils import get_today_paths as _get_today_paths
+    return _get_today_paths()
 
 
+def __getattr__(name):
+    global _today_paths
+    settings = get_settings()
+    if name in _DAY_ATTRS:
+        return getattr(settings.day, _DAY_ATTRS[name])
+    if name == "TIMEZONE":
+        return settings.timezone
+    if name == "tz":
+        return settings.tz
+    if name == "now":
+        return settings.now
+    if name == "today_str":
+        return settings.today_str
+    if name == "THEME_PATH":
+        return BASE_PATH / "themes" / f"{settings.day.year}_themes.json"
+    if name == "today_paths":
+        # 自動初始化 today_paths（若不存在會建立），只在第一次存取時讀取
+        if _today_paths is None:
+            _today_paths = get_today_paths()
+        return _today_paths
+    raise AttributeError(f"module 'config' has no attribute '{name}'")
@@ -1,55 +1,120 @@
-
 import os
-import firebase_admin
-from firebase_admin import credentials, storage
-from datetime import datetime
-from zoneinfo import ZoneInfo
-from dotenv import load_dotenv
-load_dotenv()
-
-BUCKET_NAME = os.getenv("BUCKET_NAME")
+import time
+import secrets
+from storage_backend import get_storage, PreconditionError
+from settings import load_env, get_settings
 
-# === 今日日期資訊 ===
-TIMEZONE = "Asia/Taipei"
-now = datetime.now(ZoneInfo(TIMEZONE))
-TODAY = now.strftime("%Y-%m-%d")
-year = TODAY[:4]
-month = TODAY[5:7]
-year_month = TODAY[:7]
+load_env()
 
-# 初始化一次即可
+# 初始化一次即可（第一次真正存取 bucket 時才呼叫）
 def initialize_firebase():
-    Firebase_API_KEY = os.getenv("Firebase_Admin_SDK")
+    import firebase_admin
+    from firebase_admin import credentials
+    settings = get_settings()
     if not firebase_admin._apps:
-        cred = credentials.Certificate(Firebase_API_KEY)
-        firebase_admin.initialize_app(cred, {"storageBucket": BUCKET_NAME})
+        cred = credentials.Certificate(settings.firebase_credentials)
+        firebase_admin.initialize_app(cred, {"storageBucket": settings.bucket_name})
 
 def get_bucket():
+    from firebase_admin import storage
     initialize_firebase()
     return storage.bucket()
 
+# === 今日日期資訊（延遲求值，保留舊名稱相容） ===
+def __getattr__(name):
+    settings = get_settings()
+    if name == "BUCKET_NAME":
+        return settings.bucket_name
+    if name == "TIMEZONE":
+        return settings.timezone
+    if name == "now":
+        return settings.now
+    if name in ("year", "month", "year_month"):
+        return getattr(settings.day, name)
+    if name == "TODAY":
+        return settings.day.today
+    raise AttributeError(f"module 'firebase_config' has no attribute '{name}'")
+
 # === Firsbase檔案與日誌工具 ===
 def read_txt_from_firebase(path: str) -> str:
-    bucket = storage.bucket(BUCKET_NAME)
-    blob = bucket.blob(str(path))
-    if not blob.exists():
+    obj = get_storage().read(str(path))
+    if obj is None:
         raise FileNotFoundError(f"Firebase 檔案不存在：{path}")
-    return blob.download_as_text(encoding="utf-8")
+    return obj.text()
 def write_txt_to_firebase(path: str, content: str):
-    bucket = storage.bucket(BUCKET_NAME)
-    blob = bucket.blob(str(path))
-    blob.upload_from_string(content, content_type="text/plain")
+    get_storage().write(str(path), content.encode("utf-8"), content_type="text/plain")
+def create_txt_if_missing(path: str, content: str) -> bool:
+    """
+    只在檔案不存在時建立（if_generation_match=0），已存在則不覆蓋，回傳是否有建立。
+    有綁定 unit of work 時延到 commit 才建立，回傳 False。
+    """
+    from unit_of_work import current_unit_of_work
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.create_if_missing(str(path), content)
+        return False
+    try:
+        get_storage().write(str(path), content.encode("utf-8"), content_type="text/plain", if_generation_match=0)
+        return True
+    except PreconditionError:
+        return False
+def write_txt_segment(path: str, content: str, order_ns: int = None) -> str:
+    """
+    在 {path}.parts/ 底下新增一個附加分段（只用 if_generation_match=0 建立），回傳分段路徑。
+    order_ns：排序用的時間（預設為現在）；補跑舊日期時傳入該日 00:00，分段會排在之後日期的內容前面。
+    """
+    prefix = get_txt_segment_prefix(path)
+    while True:
+        # 以奈秒時間戳命名，讀取時依名稱排序即為附加順序；指定 order_ns 時再接上現在時間，同一天依寫入先後
+        key = f"{time.time_ns():020d}" if order_ns is None else f"{order_ns:020d}{time.time_ns():020d}"
+        name = f"{prefix}{key}_{os.getpid()}_{secrets.token_hex(3)}.txt"
+        try:
+            get_storage().write(name, content.encode("utf-8"), content_type="text/plain", if_generation_match=0)
+            return name
+        except PreconditionError:
+            continue  # 名稱撞到（幾乎不會發生），換一個再試
 
 # === Firsbase路徑管理 ===
-def get_theme_path(year: int, week_num: str) -> str:
+def get_theme_path(year: int, week_num: str, month: str = None) -> str:
+    month = month or get_settings().day.month
     return f"themes/{year}/{month}_{week_num}_theme.json"
+def get_theme_index_path(date: str) -> str:
+    return f"themes/index/{date[:4]}/{date}.json"
+def get_theme_index_manifest_path(year: str) -> str:
+    return f"themes/index/{year}/manifest.json"
 def get_story_txt_path(character_id: str, year: int, week_num: str) -> str:
     return f"characters/{character_id}/{year}/2025_{week_num}.txt"
 def get_log_json_path(character_id: str, date: str, topic_slug: str) -> str:
     return f"logs/characters/{character_id}/{date}_{topic_slug}_log.json"
+def get_checkpoint_path(character_id: str, date: str, topic_slug: str) -> str:
+    return f"logs/characters/{character_id}/{date}_{topic_slug}_checkpoint.json"
+def get_work_queue_prefix(date: str) -> str:
+    return f"queue/{date}/"
+def get_work_item_path(date: str, character_id: str, stage: str) -> str:
+    return f"queue/{date}/{character_id}_{stage}.json"
+def get_txt_segment_prefix(path: str) -> str:
+    return f"{path}.parts/"
 def get_error_log_path(date: str) -> str:
     return f"logs/errors/{date}_error.json"
+def get_error_log_segment_prefix(date: str) -> str:
+    return f"logs/errors/{date}/"
+def get_run_summary_path(date: str, stage: str, run_id: str) -> str:
+    return f"logs/errors/{date}/{stage}_{run_id}_summary.json"
 def get_memory_summary_path(character_id: str, week_num: str) -> str:
     return f"memory/{character_id}/summary_week_{week_num}.txt"
 def get_memory_items_path(character_id: str, year_month: str) -> str:
     return f"memory/{character_id}/memory_{year_month}.json"
+def get_memory_daily_path(character_id: str, date: str) -> str:
+    return f"memory/{character_id}/daily/{date}.json"
+def get_memory_weekly_path(character_id: str, week_key: str) -> str:
+    return f"memory/{character_id}/weekly/{week_key}.json"
+def get_memory_monthly_path(character_id: str, year_month: str) -> str:
+    return f"memory/{character_id}/monthly/{year_month}.json"
+def get_memory_view_path(character_id: str) -> str:
+    return f"memory/{character_id}/view.json"
+def get_story_index_prefix(character_id: str) -> str:
+    return f"index/{character_id}/stories/"
+def get_story_index_path(character_id: str, year_month: str) -> str:
+    return f"index/{character_id}/stories/{year_month}.json"
+def get_story_index_stats_path(character_id: str) -> str:
+    return f"index/{character_id}/stories_stats.json"
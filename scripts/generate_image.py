@@ -1,67 +1,279 @@
 # generate_image.py
 
-import time
-import json
-from config import TODAY, year_month, get_today_paths
+import threading
+from dataclasses import asdict
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    get_today_paths,
+    IMAGE_GEN_WORKERS, IMAGE_ENCODE_WORKERS, IMAGE_UPLOAD_WORKERS, PIPELINE_QUEUE_SIZE,
+    IMAGE_PREFETCH_WORKERS,
+)
+from pipeline import Stage, StageError, run_pipeline
+from metrics import incr, span, write_run_summary
+from settings import get_settings, DayContext
+from checkpoint import Checkpoint
+from unit_of_work import unit_of_work
+from image_encoder import EncodeOptions, encode_image_variants, describe
+from image_cache import IMAGE_GENERATOR, get_image_cache, image_prompt_key
 from utils import (
-    generate_image_from_prompt, upload_to_imgbb, 
-    read_json_from_firebase, write_json_to_firebase, 
-    append_txt_to_firebase, generate_imgbb_name, 
+    generate_image_from_prompt, upload_bytes_to_imgbb, upload_image_to_imgbb,
+    read_json_from_firebase, write_json_to_firebase,
+    append_txt_to_firebase, compact_appended_txt, generate_imgbb_name,
     slugify, log_and_print
 )
 
 
-# === 載入今日角色與主題資訊 ===
-today_paths = get_today_paths()
-today_themes = [
-    {"character_id": cid, "theme": info["theme"]}
-    for cid, info in today_paths.items()
-    if "theme" in info
-]
+# === 管線各階段（每個 job 是一張圖：角色 + 編號 + prompt） ===
+# prompt 快取命中（或預先生圖已完成）的 job 帶著 "url" 直接通過後面的階段
+def generate_stage(job: dict) -> dict:
+    if not job.get("prefetch"):
+        prefetched = _wait_prefetched(job["key"])
+        if prefetched:
+            log_and_print(f"♻️ [{job['cid']}] 圖片 {job['index']} 沿用預先生成的圖：{prefetched['url']}\n", "OK")
+            return {**job, "url": prefetched["url"], "thumbnail_url": prefetched.get("thumbnail_url")}
+    cached = get_image_cache().get(job["key"])
+    if cached:
+        log_and_print(f"♻️ [{job['cid']}] 圖片 {job['index']} 沿用快取：{cached['url']}\n", "OK")
+        return {**job, "url": cached["url"], "thumbnail_url": cached.get("thumbnail_url")}
+    log_and_print(f"\n🎨 [{job['cid']}] 開始生成圖片 {job['index']}: {job['prompt']}\n", "OK")
+    img = generate_image_from_prompt(job["prompt"])
+    if not img:
+        raise RuntimeError("生成失敗")
+    img_name = generate_imgbb_name(cid=job["cid"], theme_slug=job["theme"], index=job["index"])
+    print(f"DEBUG: 產生圖檔名稱：{img_name}")
+    return {**job, "name": img_name, "image": img}
+
+def encode_stage(job: dict) -> dict:
+    if "url" in job:
+        return job
+    # 在 image_encoder 的 process pool 中編碼，完整圖片與縮圖一次產生
+    result = encode_image_variants(job.pop("image"))
+    log_and_print(f"🗜️ [{job['cid']}] 圖片 {job['index']} {describe(result)}\n", "OK")
+    return {**job, "data": result["data"], "thumbnail": result["thumbnail"]}
+
+def upload_stage(job: dict) -> dict:
+    if "url" in job:
+        return job
+    cache = get_image_cache()
+    data, thumbnail = job.pop("data"), job.pop("thumbnail", None)
+    # 請求頻率由 rate_limit 的 "imgbb" 限流器控制，遇到 429 會依 Retry-After 暫停
+    uploaded = upload_image_to_imgbb(data, job["name"])
+    url, thumbnail_url = (uploaded["url"], uploaded["thumbnail_url"]) if uploaded else (None, None)
+    if url:
+        log_and_print(f"✅ 上傳成功：\n{url}\n", "OK")
+        # 縮圖預設用 ImgBB 附的；有設定 IMAGE_THUMBNAIL_SIZE 時才另外上傳自己編碼的縮圖
+        if thumbnail:
+            thumbnail_url = upload_bytes_to_imgbb(thumbnail, f"{job['name']}_thumb") or thumbnail_url
+        try:
+            cache.put(job["key"], url, thumbnail_url)
+        except Exception as e:
+            log_and_print(f"⚠️ [{job['cid']}] 圖片快取寫入失敗：{e}\n", "warning")
+    else:
+        log_and_print("⚠️ 上傳失敗\n", "warning")
+    return {**job, "url": url, "thumbnail_url": thumbnail_url}
+
+
+def cache_settings() -> dict:
+    """會影響上傳結果的設定，納入 prompt 快取的 key"""
+    return {"generator": IMAGE_GENERATOR, **asdict(EncodeOptions())}
+
 
-if not today_themes:
-    log_and_print(f"\n❌ 今天 {TODAY} 沒有要處理的角色與主題\n", "error")
-    raise SystemExit
+# === 故事串流時預先生圖 ===
+_prefetching = {}   # prompt key → Future：本行程中進行中或已完成的預先生圖
+_prefetch_lock = threading.Lock()
 
-# === 開始逐一處理角色圖像 ===
-for entry in today_themes:
-    today_cid = entry["character_id"]
-    theme_slug = entry["theme"]
 
-    log_path = today_paths[today_cid]["log"]
-    txt_path = today_paths[today_cid]["txt"]
+def _wait_prefetched(key: str):
+    """同一個 prompt 正在預先生圖時等它完成，回傳帶 url 的 job；沒有或失敗時回傳 None（照常生成）"""
+    with _prefetch_lock:
+        future = _prefetching.get(key)
+    if future is None or future.cancel():
+        return None
+    try:
+        result = future.result()
+    except Exception:
+        return None
+    return result if result.get("url") else None
 
-    log_data = read_json_from_firebase(log_path)
-    prompts = log_data.get("prompt_list", [])
-    image_urls = []
 
-    for idx, prompt in enumerate(prompts, 1):
-        log_and_print(f"\n🎨 開始生成圖片 {idx}: {prompt}\n", "OK")
+def _prefetch(job: dict) -> dict:
+    try:
+        with span("image.prefetch", character=job["cid"]):
+            result = upload_stage(encode_stage(generate_stage(job)))
+        incr("image.prefetch", failed=0 if result.get("url") else 1)
+        return result
+    except Exception as e:
+        incr("image.prefetch", failed=1)
+        log_and_print(f"⚠️ [{job['cid']}] 圖片 {job['index']} 預先生成失敗，圖片階段會重新生成：{e}\n", "warning")
+        raise
 
-        img = generate_image_from_prompt(prompt)
-        img_name = generate_imgbb_name(cid=today_cid, theme_slug=theme_slug, index=idx)
-        print(f"DEBUG: 產生圖檔名稱：{img_name}")
 
-        if img:
-            url = upload_to_imgbb(img, img_name)
-            if url:
-                image_urls.append(url)
-                log_and_print(f"✅ 上傳成功：\n{url}\n", "OK")
-            else:
-                log_and_print("⚠️ 上傳失敗\n", "warning")
-        else:
-            log_and_print("⚠️ 生成失敗\n", "error")
+class ImagePrefetcher:
+    """
+    接在 generate_character_story 的 on_prompt：故事還在串流時，每完成一個 prompt 就在背景
+    生成 → 編碼 → 上傳並寫入 prompt 快取。之後的圖片階段以同一個 prompt key 直接沿用
+    （還在進行中的會等它完成），不必等整篇故事寫完才開始生圖。
+    prompt 被取代或撤回時，尚未開始的預先生圖會被取消；已完成的結果留在快取中。
+    """
+    def __init__(self, today_paths: dict, workers: int = IMAGE_PREFETCH_WORKERS):
+        self.today_paths = today_paths
+        self.settings = cache_settings()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="image_prefetch")
+        self._slots = {}   # (cid, index) → (key, Future)
+        self._lock = threading.Lock()
 
-        time.sleep(1.5)  # 為保險起見避免過快請求
+    def on_prompt(self, cid: str, index: int, prompt):
+        with self._lock:
+            old = self._slots.pop((cid, index), None)
+            if old and old[1].cancel():
+                with _prefetch_lock:
+                    if _prefetching.get(old[0]) is old[1]:
+                        del _prefetching[old[0]]
+            if prompt is None:
+                return
+            key = image_prompt_key(prompt, self.settings)
+            job = {"cid": cid, "theme": self.today_paths[cid]["theme"], "index": index, "prompt": prompt,
+                   "key": key, "prefetch": True}
+            with _prefetch_lock:
+                future = _prefetching.get(key)
+                if future is None or future.cancelled():
+                    future = _prefetching[key] = self._pool.submit(_prefetch, job)
+            self._slots[(cid, index)] = (key, future)
+
+    def close(self):
+        """等進行中的預先生圖結束（結果已在快取中），並從本行程的登記中移除"""
+        self._pool.shutdown(wait=True)
+        with self._lock, _prefetch_lock:
+            for key, future in self._slots.values():
+                if _prefetching.get(key) is future:
+                    del _prefetching[key]
+            self._slots.clear()
+
+
+# === 單一角色全部圖片完成後寫回 ===
+def finalize_character(cid: str, info: dict, log_data: dict, image_urls: list,
+                       day: DayContext = None, append_weekly: bool = True,
+                       thumbnail_urls: list = None):
+    """append_weekly=False 時只更新 log.json（還有圖片沒完成，週檔等全部完成再寫一次）"""
+    day = day or get_settings().day
+    log_path = info["log"]
+    txt_path = info["txt"]
 
     log_data["images"] = image_urls
+    if thumbnail_urls is not None:
+        log_data["thumbnails"] = thumbnail_urls
     write_json_to_firebase(log_path, log_data)
+    if not append_weekly:
+        return
 
     # === 附加圖片網址至 weekly story txt ===
-    txt_block = f"Image_URLs ({TODAY}):\n"
+    txt_block = f"Image_URLs ({day.today}):\n"
     txt_block += "\n".join(f"- {url}" for url in image_urls)
     txt_block += "\n------------------------------------------------------------\n"
-    append_txt_to_firebase(txt_path, txt_block)
+    append_txt_to_firebase(txt_path, txt_block, order_ns=day.start_ns)
 
     log_and_print(f"📦 圖片資訊已儲存至:\n{log_path}\n{txt_path}\n")
 
+
+def compact_weekly(cid: str, txt_path: str):
+    """合併週檔分段；失敗只記錄，下次完成時會再合併"""
+    try:
+        merged = compact_appended_txt(txt_path)
+        if merged:
+            log_and_print(f"🧩 [{cid}] 週檔已合併 {merged} 個分段：{txt_path}\n", "OK")
+    except Exception as e:
+        log_and_print(f"⚠️ [{cid}] 週檔分段合併失敗：{e}\n", "warning")
+
+
+def generate_all_images(today_paths: dict, day: DayContext = None):
+    """
+    所有角色的所有 prompt 一起送進「生成 → 編碼 → 上傳」管線，
+    某位角色的圖片全部完成時就立即寫回 log 與週檔。
+    每張圖上傳後記錄在 checkpoint，重跑時只處理還沒上傳的圖片；
+    有圖片失敗時不寫週檔，等重跑補齊後才寫一次。
+    day 的意義同 generate_story.generate_character_story。
+    """
+    day = day or get_settings().day
+    jobs, log_cache, pending, urls, thumbnails, checkpoints = [], {}, {}, {}, {}, {}
+    settings = cache_settings()
+
+    def finish(cid: str):
+        done = [u for u in urls[cid] if u]
+        complete = len(done) == len(urls[cid])
+        thumbs = [thumbnails[cid].get(idx) for idx, u in enumerate(urls[cid], 1) if u]
+        with unit_of_work() as uow:
+            finalize_character(cid, today_paths[cid], log_cache[cid], done, day,
+                               append_weekly=complete, thumbnail_urls=thumbs)
+            if complete:
+                checkpoints[cid].mark_done("image")
+                # 當天的故事與圖片都已寫進週檔分段：寫出後把分段併回主檔，直接讀週檔的人也看得到
+                uow.after_commit(lambda: compact_weekly(cid, today_paths[cid]["txt"]))
+        if not complete:
+            log_and_print(f"⚠️ [{cid}] 還有 {len(urls[cid]) - len(done)} 張圖片未完成，重跑時會補上\n", "warning")
+
+    for cid, info in today_paths.items():
+        if "theme" not in info:
+            continue
+        checkpoint = checkpoints[cid] = Checkpoint(cid, day.today, info["theme"])
+        if checkpoint.is_done("image"):
+            log_and_print(f"⏭️ [{cid}] {day.today} 圖片已完成，略過\n", "OK")
+            continue
+        log_data = read_json_from_firebase(info["log"])
+        prompts = log_data.get("prompt_list", [])
+        uploaded = checkpoint.image_urls()
+        log_cache[cid] = log_data
+        urls[cid] = [uploaded.get(idx) for idx in range(1, len(prompts) + 1)]
+        thumbnails[cid] = checkpoint.thumbnail_urls()
+        pending[cid] = 0
+        for idx, prompt in enumerate(prompts, 1):
+            if urls[cid][idx - 1]:
+                continue
+            jobs.append({"cid": cid, "theme": info["theme"], "index": idx, "prompt": prompt,
+                         "key": image_prompt_key(prompt, settings)})
+            pending[cid] += 1
+
+        if pending[cid] == 0:
+            finish(cid)
+
+    def on_result(_, job, result):
+        cid = job["cid"]
+        if isinstance(result, StageError):
+            log_and_print(f"⚠️ [{cid}] 圖片 {job['index']} {result}\n", "error")
+        elif result["url"]:
+            urls[cid][job["index"] - 1] = result["url"]
+            if result["thumbnail_url"]:
+                thumbnails[cid][job["index"]] = result["thumbnail_url"]
+            try:
+                checkpoints[cid].mark_image(job["index"], result["url"], result["thumbnail_url"])
+            except Exception as e:
+                log_and_print(f"⚠️ [{cid}] 圖片 {job['index']} 進度記錄失敗：{e}\n", "warning")
+        pending[cid] -= 1
+        if pending[cid] == 0:
+            try:
+                finish(cid)
+            except Exception as e:
+                log_and_print(f"❌ [{cid}] 圖片資訊寫回失敗：{e}\n", "error")
+
+    stages = [
+        Stage("generate", generate_stage, IMAGE_GEN_WORKERS),
+        Stage("encode", encode_stage, IMAGE_ENCODE_WORKERS),
+        Stage("upload", upload_stage, IMAGE_UPLOAD_WORKERS),
+    ]
+    run_pipeline(jobs, stages, queue_size=PIPELINE_QUEUE_SIZE, on_result=on_result)
+
+
+def main():
+    # === 載入今日角色與主題資訊 ===
+    day = get_settings().day
+    today_paths = get_today_paths()
+    if not any("theme" in info for info in today_paths.values()):
+        log_and_print(f"\n❌ 今天 {day.today} 沒有要處理的角色與主題\n", "error")
+        raise SystemExit
+
+    with span("stage.image"):
+        generate_all_images(today_paths, day)
+    write_run_summary("image", day.today)
+
+
+if __name__ == "__main__":
+    main()
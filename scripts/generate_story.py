@@ -1,17 +1,21 @@
-
-
 import time
-from config import TODAY, year, year_month, week_num
+from concurrent.futures import ThreadPoolExecutor
+from config import STORY_CONCURRENCY, STORY_STREAMING
 import textwrap
 from firebase_config import (
-    initialize_firebase,
     get_story_txt_path,
-    get_log_json_path,
+    get_memory_items_path,
     read_txt_from_firebase,
 )
+from memory_store import load_memory_text, record_daily_memory
+from story_index import add_story, related_memory
+from settings import get_settings, DayContext
+from checkpoint import Checkpoint
+from unit_of_work import unit_of_work
+from metrics import span, write_run_summary
 from utils import (
     call_Deepseek_story,
-    extract_response,
+    call_Deepseek_story_stream,
     count_tokens,
     log_and_print,
     call_llm_for_story,
@@ -20,44 +24,162 @@ from utils import (
     read_json_from_firebase,
     write_json_to_firebase,
     extract_response_parts,
+    build_repair_prompt,
 )
+from response_parser import ParsedResponse, SectionError, ResponseFormatError, parse_response
+
+# === 排版週檔內容 ===
+def format_daily_entry(theme_slug: str, story: str, summary: str, prompts: list, date: str = None) -> str:
+    date = date or get_settings().day.today
+    wrapper = textwrap.TextWrapper(width=100, subsequent_indent="    ")
+    story_formatted = wrapper.fill(story)
+    summary_formatted = wrapper.fill(summary)
+    max_index_len = len(str(len(prompts)))
+    prompts_formatted = "\n".join([
+        wrapper.fill(f"{str(i + 1).rjust(max_index_len)}. {p}")
+        for i, p in enumerate(prompts)
+    ])
+
+    daily_entry = f"""=== {date}: {theme_slug} ===
+    STORY:
+    {story_formatted}
+
+    SUMMARY:
+    {summary_formatted}
+
+    PROMPTS:
+    {prompts_formatted}
+
+    """
+    return daily_entry
+
+
+# === 呼叫 LLM：格式錯誤時只重做有問題的段落 ===
+def _emit_prompt(cid: str, on_prompt, emitted: dict, index: int, prompt):
+    """同一編號的 prompt 沒變就不重複回呼；內容不同時再回呼一次（下游以新的取代舊的）"""
+    if on_prompt and emitted.get(index) != prompt:
+        emitted[index] = prompt
+        on_prompt(cid, index, prompt)
+
+
+def _sync_prompts(cid: str, on_prompt, emitted: dict, prompts: list):
+    """以最終的 prompt 清單為準：改變的重新回呼，清單中已不存在的編號以 prompt=None 通知撤回"""
+    for index, prompt in enumerate(prompts, 1):
+        _emit_prompt(cid, on_prompt, emitted, index, prompt)
+    for index in sorted(i for i in emitted if i > len(prompts) and emitted[i] is not None):
+        _emit_prompt(cid, on_prompt, emitted, index, None)
+
 
-initialize_firebase()
+def _call_story(cid: str, system_prompt: str, user_prompt: str, on_prompt=None, use_cache: bool = True,
+                emitted: dict = None) -> dict:
+    """emitted：{編號: 已交給 on_prompt 的 prompt}；重新生成時相同的 prompt 不再重複回呼"""
+    emitted = {} if emitted is None else emitted
+    if STORY_STREAMING:
+        def prompt_ready(index, prompt):
+            log_and_print(f"🖼️ [{cid}] prompt {index} 已完成：{prompt}\n", error_type="OK")
+            _emit_prompt(cid, on_prompt, emitted, index, prompt)
+        try:
+            response_raw = call_Deepseek_story_stream(system_prompt, user_prompt, on_prompt=prompt_ready,
+                                                      use_cache=use_cache)
+        except ResponseFormatError as e:
+            # 串流中途因格式錯誤中止：內容不完整（故事可能是空的），一律整篇重來
+            log_and_print(f"⚠️ [{cid}] 串流輸出格式錯誤，已提早中止：{e}\n", error_type="WARNING")
+            return {"parsed": ParsedResponse(errors=list(e.errors) + [SectionError("FORMAT", "abort", str(e))])}
+    else:
+        response_raw = call_Deepseek_story(system_prompt, user_prompt, use_cache=use_cache)
+    return extract_response_parts(response_raw)
 
-log_file_path = f"logs/setup_log/{year_month}_{TODAY}_setup_log.txt"
 
+def request_story(cid: str, system_prompt: str, user_prompt: str, on_prompt=None) -> dict:
+    """
+    取得並驗證 LLM 回應：
+    - 故事本身有問題（或整體格式錯誤）→ 整篇重新生成一次（略過快取）
+    - 只有摘要或 prompts 有問題 → 只請 LLM 補這些段落，故事保留
+    仍然不符格式時拋出 ResponseFormatError，由上層記錄為該角色失敗。
+    on_prompt(cid, index, prompt) 可能對同一編號呼叫多次（重新生成或補段落後 prompt 改變），以最後一次為準；
+    prompt 為 None 表示該編號已不存在。成功回傳前會依最終的 prompt 清單補齊回呼。
+    """
+    emitted = {}
+    full_response = _call_story(cid, system_prompt, user_prompt, on_prompt, emitted=emitted)
+    parsed = full_response["parsed"]
+
+    if parsed.bad_sections & {"STORY", "FORMAT"}:
+        log_and_print(f"⚠️ [{cid}] 故事格式錯誤，重新生成：{parsed.errors}\n", error_type="WARNING")
+        full_response = _call_story(cid, system_prompt, user_prompt, on_prompt, use_cache=False, emitted=emitted)
+        parsed = full_response["parsed"]
+
+    if parsed.errors and not parsed.bad_sections & {"STORY", "FORMAT"}:
+        bad = parsed.bad_sections
+        log_and_print(f"⚠️ [{cid}] 只重新生成：{', '.join(sorted(bad))}\n", error_type="WARNING")
+        repair_system, repair_user = build_repair_prompt(parsed.story, bad)
+        repair_raw = call_Deepseek_story(repair_system, repair_user)
+        repaired = parse_response(repair_raw["choices"][0]["message"]["content"], required=tuple(sorted(bad)))
+        if "SUMMARY" in bad:
+            parsed.summary = repaired.summary
+        if "PROMPTS" in bad:
+            parsed.prompts = repaired.prompts
+        parsed.errors = repaired.errors
 
-# === 建立 prompt ===
+    if parsed.errors:
+        raise ResponseFormatError(f"LLM 回應格式錯誤：{parsed.errors}", parsed.errors, parsed)
+    _sync_prompts(cid, on_prompt, emitted, parsed.prompts)
 
+    full_response.update(parsed.as_dict())
+    full_response.setdefault("model", "")
+    full_response.setdefault("usage", {})
+    full_response.setdefault("content", "")
+    return full_response
 
 
-# === 讀取 today_paths ===
-today_paths = read_json_from_firebase(get_today_paths_path(year_month, TODAY))
+# === 單一角色：讀取 → 生成 → 寫入 ===
+def generate_character_story(cid: str, info: dict, on_prompt=None, day: DayContext = None) -> dict:
+    """
+    on_prompt(cid, index, prompt)：串流模式下每完成一個圖片 prompt 就呼叫，
+    讓下游在故事寫完前就能開始生圖；prompt 之後被取代時會再呼叫一次，撤回時 prompt 為 None（見 request_story）。
+    day：要生成的日期，預設為今天（台北時間）。週檔分段以該日排序，補跑的舊日期會排在之後日期的內容前面。
+    """
+    day = day or get_settings().day
+    checkpoint = Checkpoint(cid, day.today, info["theme"])
+    if checkpoint.is_done("story"):
+        log_and_print(f"⏭️ [{cid}] {day.today} 故事已完成，略過\n", error_type="OK")
+        return {"character": cid, "skipped": True}
+    # log.json 的多次更新與週檔 append 在 commit 時合併寫出，checkpoint 於資料寫入後才標記
+    with span("story", character=cid, date=day.today), unit_of_work():
+        result = _generate_character_story(cid, info, on_prompt, day)
+        checkpoint.mark_done("story")
+    return result
+
 
-# === 開始處理每位角色 ===
-for cid, info in today_paths.items():
+def _generate_character_story(cid: str, info: dict, on_prompt, day: DayContext) -> dict:
+    TODAY, year, year_month, week_num = day.today, day.year, day.year_month, day.week_num
     theme_slug = info["theme"]
     log_path = info["log"]
-    # txt_path = info["txt"]
 
-    # === 讀取角色卡 ===
-    character_card = read_json_from_firebase(f"characters/data/{cid}.json")
+    with span("story.memory", character=cid):
+        # === 讀取角色卡 ===
+        character_card = read_json_from_firebase(f"characters/data/{cid}.json")
 
-    # === 讀取週記憶（可選） ===
-    memory_path = f"memory/{cid}/memory_{year_month}.json"
-    try:
-        memory = read_txt_from_firebase(memory_path)
-    except Exception:
-        memory = ""
+        # === 讀取記憶（固定大小的 view；尚未建立時退回舊的月記憶檔）：只看今天之前，補跑舊日期也不會看到之後的故事 ===
+        memory = load_memory_text(cid, before=TODAY)
+        if not memory:
+            try:
+                memory = read_txt_from_firebase(get_memory_items_path(cid, year_month))
+            except Exception:
+                memory = ""
+
+        # === 依今天主題檢索相關的過往故事（附在記憶最後，裁切時優先保留） ===
+        related = related_memory(cid, theme_slug, before=TODAY)
+        if related:
+            memory = f"{memory}\n\n{related}".strip()
 
     # === 建立 Prompt ===
     system_prompt, user_prompt = call_llm_for_story(character_card, theme_slug, memory)
-    log_and_print(f"\n🟡 Prompt 組合完成，開始生成...\n", error_type="OK")
+    log_and_print(f"\n🟡 [{cid}] Prompt 組合完成，開始生成...\n", error_type="OK")
     # === 呼叫 LLM 並解析 ===
     start_time = time.time()
-    response_raw = call_Deepseek_story(system_prompt, user_prompt)
-    full_response = extract_response_parts(response_raw)
-    log_and_print(f"\n🟢 LLM 回應完成\n", error_type="OK")
+    with span("story.llm", character=cid):
+        full_response = request_story(cid, system_prompt, user_prompt, on_prompt)
+    log_and_print(f"\n🟢 [{cid}] LLM 回應完成\n", error_type="OK")
     end_time = time.time()
 
     # === 記錄結果 ===
@@ -65,52 +187,74 @@ for cid, info in today_paths.items():
     summary = full_response["summary"]
     prompts = full_response["prompt_list"]
     model = full_response["model"]
-    tokens = count_tokens(system_prompt + user_prompt)
+    # token 數以 API 回傳的 usage 為準，沒有時才自行計算
+    usage = full_response["usage"]
+    tokens_prompt = usage.get("prompt_tokens") or count_tokens(system_prompt + user_prompt)
+    tokens_completion = usage.get("completion_tokens") or count_tokens(full_response["content"])
     duration = round(end_time - start_time, 2)
 
-    # === 寫入 log.json ===
-    log_data = read_json_from_firebase(log_path)
-    log_data.update({
-        "date": TODAY,
-        "character": cid,
-        "theme": theme_slug,
-        "story": story,
-        "summary": summary,
-        "prompt_list": prompts,
-        "model_story": model,
-        "tokens_story": tokens,
-        "duration": duration,
-        "images": [],
-    })
-    write_json_to_firebase(log_path, log_data)
-
-    # === 寫入 weekly 檔案 ===
-    weekly_txt_path = get_story_txt_path(cid, year, week_num)
-    # === 美化排版 ===
-    image_urls = []
-    wrapper = textwrap.TextWrapper(width=100, subsequent_indent="    ")
-    story_formatted = wrapper.fill(story)
-    summary_formatted = wrapper.fill(summary)
-    max_index_len = len(str(len(prompts)))
-    prompts_formatted = "\n".join([
-        wrapper.fill(f"{str(i + 1).rjust(max_index_len)}. {p}")
-        for i, p in enumerate(prompts)
-    ])
-    images_formatted = "\n".join(image_urls)
+    with span("story.write", character=cid):
+        # === 寫入 log.json ===
+        log_data = read_json_from_firebase(log_path)
+        log_data.update({
+            "date": TODAY,
+            "character": cid,
+            "theme": theme_slug,
+            "story": story,
+            "summary": summary,
+            "prompt_list": prompts,
+            "model_story": model,
+            "tokens_story": tokens_completion,   # 故事本身（LLM 輸出）的 token 數
+            "tokens_prompt": tokens_prompt,
+            "tokens_completion": tokens_completion,
+            "duration": duration,
+            "images": [],
+        })
+        write_json_to_firebase(log_path, log_data)
 
-    daily_entry = f"""=== {TODAY}: {theme_slug} ===
-    STORY:
-    {story_formatted}
+        # === 更新角色記憶（每日 → 週 → 月逐層壓縮）與檢索索引 ===
+        record_daily_memory(cid, day, theme_slug, summary)
+        add_story(cid, TODAY, theme_slug, summary, story)
 
-    SUMMARY:
-    {summary_formatted}
+        # 寫入週檔案（append）
+        weekly_txt_path = get_story_txt_path(cid, year, week_num)
+        entry = format_daily_entry(theme_slug, story, summary, prompts, TODAY)
+        append_txt_to_firebase(weekly_txt_path, entry, order_ns=day.start_ns)
+    log_and_print(f"✅ [{cid}] 故事生成並儲存完成！\n", error_type="OK")
+    return {"character": cid, "duration": duration, "prompts": len(prompts)}
 
-    PROMPTS:
-    {prompts_formatted}
 
+# === 所有角色並行處理 ===
+def generate_all_stories(today_paths: dict, concurrency: int = STORY_CONCURRENCY, day: DayContext = None) -> dict:
+    """
+    以 thread pool 同時處理多位角色：一位角色等待 LLM 時，其他角色的讀寫可以同時進行。
+    每位角色的錯誤各自隔離，結果依 today_paths 的順序回報。
+    LLM 的請求頻率由 rate_limit 中 "openrouter" 的限流器控制。
     """
-    # append_txt_to_firebase(txt_path, daily_entry)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="story") as pool:
+        futures = {cid: pool.submit(generate_character_story, cid, info, day=day) for cid, info in today_paths.items()}
+        for cid, future in futures.items():
+            try:
+                results[cid] = future.result()
+            except Exception as e:
+                log_and_print(f"❌ [{cid}] 故事生成失敗：{e}\n", error_type="ERROR")
+                results[cid] = {"character": cid, "error": str(e)}
+    return results
+
+
+def main():
+    # === 讀取 today_paths ===
+    day = get_settings().day
+    today_paths = read_json_from_firebase(get_today_paths_path(day.year_month, day.today))
+    with span("stage.story"):
+        results = generate_all_stories(today_paths, day=day)
+
+    failed = [cid for cid, r in results.items() if "error" in r]
+    log_and_print(f"📊 故事生成結束：成功 {len(results) - len(failed)} / {len(results)}"
+                  + (f"，失敗：{', '.join(failed)}" if failed else "") + "\n", error_type="OK")
+    write_run_summary("story", day.today)
+
 
-    # 寫入週檔案（append）
-    append_txt_to_firebase(weekly_txt_path, daily_entry)
-    log_and_print(f"✅ 故事生成並儲存完成！\n", error_type="OK")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# http_client.py
+# 所有對外 HTTP 呼叫（OpenRouter、ImgBB）共用的連線池客戶端：
+#   - keep-alive 連線池，不必每次重新 TCP / TLS 握手
+#   - 連線與讀取逾時（避免單一請求卡住整個每日流程）
+#   - 5xx / 429 / 連線錯誤時指數退避 + jitter 重試，429 依 Retry-After 等待
+#   - 非冪等的請求（POST）只在確定伺服器沒有處理時重試：連線建立失敗、429、503；
+#     讀取逾時或 502/504 時請求可能已被處理（LLM 已計費、圖片已上傳），不自動重送
+#   - HTTP2=1 時改用 httpx（需安裝 h2）走 HTTP/2
+import os
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from settings import load_env
+from metrics import incr
+
+load_env()
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "180"))     # LLM 回應可能很慢
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "1.0"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "60"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP2 = os.getenv("HTTP2", "0") == "1"
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+NON_IDEMPOTENT_RETRY_STATUS = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _create_client():
+    if HTTP2:
+        import httpx
+        limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+        return httpx.Client(http2=True, limits=limits)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+def get_client():
+    """取得共用的 requests.Session（或 HTTP2=1 時的 httpx.Client）"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _create_client()
+    return _client
+
+
+def _transport_errors() -> tuple:
+    errors = [requests.ConnectionError, requests.Timeout]
+    if HTTP2:
+        import httpx
+        errors.append(httpx.TransportError)
+    return tuple(errors)
+def _is_connect_error(e: Exception) -> bool:
+    """連線尚未建立就失敗（請求沒有送到伺服器），非冪等的請求也可以安全重試"""
+    if HTTP2:
+        import httpx
+        return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError) and not isinstance(e, requests.Timeout):
+        from urllib3.exceptions import NewConnectionError
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+def _timeout_arg(connect: float, read: float):
+    if HTTP2:
+        import httpx
+        return httpx.Timeout(read, connect=connect)
+    return (connect, read)
+def retry_after_seconds(response):
+    """解析 Retry-After（秒數格式），無法解析回傳 None"""
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+def backoff_delay(attempt: int) -> float:
+    """第 attempt 次重試前的等待秒數（full jitter）"""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** (attempt - 1))))
+
+
+def _send(client, method: str, url: str, timeout, stream: bool, kwargs: dict):
+    if HTTP2:
+        req = client.build_request(method, url, timeout=timeout, **kwargs)
+        return client.send(req, stream=stream)
+    return client.request(method, url, timeout=timeout, stream=stream, **kwargs)
+
+
+def request(method: str, url: str, *, limiter=None, connect_timeout: float = None,
+            read_timeout: float = None, max_retries: int = None, stream: bool = False,
+            idempotent: bool = None, **kwargs):
+    """
+    發送請求並在可重試的情況下自動重試，回傳最後一次的 response。
+    - limiter：rate_limit.TokenBucket，每次嘗試前取得額度，429 時讓它暫停
+    - idempotent：重送是否安全，預設依 method 判斷（POST 視為否，只重試連線失敗與 429 / 503）
+    - 其餘參數（headers / params / json / data / files）直接交給底層客戶端
+    連線錯誤重試用盡時會拋出原本的例外；5xx / 429 用盡時回傳該 response 交給呼叫端判斷。
+    stream=True 時只在收到回應標頭前重試，內容交給 iter_lines() 逐行讀取，用完需 close()。
+    """
+    client = get_client()
+    timeout = _timeout_arg(connect_timeout or HTTP_CONNECT_TIMEOUT, read_timeout or HTTP_READ_TIMEOUT)
+    max_retries = HTTP_MAX_RETRIES if max_retries is None else max_retries
+    idempotent = method.upper() in IDEMPOTENT_METHODS if idempotent is None else idempotent
+    retry_status = RETRY_STATUS if idempotent else NON_IDEMPOTENT_RETRY_STATUS
+
+    attempt = 0
+    while True:
+        attempt += 1
+        if limiter:
+            incr("http.rate_limit_wait_seconds", limiter.acquire())
+        incr("http.calls")
+        try:
+            response = _send(client, method, url, timeout, stream, kwargs)
+        except _transport_errors() as e:
+            incr("http.errors")
+            if attempt > max_retries or not (idempotent or _is_connect_error(e)):
+                raise
+            incr("http.retries")
+            delay = backoff_delay(attempt)
+            print(f"⚠️ HTTP 連線錯誤（{e.__class__.__name__}），{delay:.1f} 秒後第 {attempt} 次重試：{url}")
+            time.sleep(delay)
+            continue
+
+        if response.status_code not in retry_status or attempt > max_retries:
+            if limiter and response.status_code < 400:
+                limiter.on_success()
+            return response
+
+        incr("http.retries", **{f"status_{response.status_code}": 1})
+        retry_after = retry_after_seconds(response)
+        response.close()
+        if response.status_code == 429 and limiter:
+            limiter.penalize(retry_after)   # 由限流器統一暫停所有共用此 endpoint 的執行緒
+            delay = 0.0
+        else:
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        print(f"⚠️ HTTP {response.status_code}，{delay:.1f} 秒後第 {attempt} 次重試：{url}")
+        time.sleep(delay)
+def iter_lines(response):
+    """逐行讀取串流回應（requests / httpx 皆可），回傳 str"""
+    if HTTP2:
+        yield from response.iter_lines()
+        return
+    for line in response.iter_lines(decode_unicode=True):
+        yield line if isinstance(line, str) else line.decode("utf-8")
+
+
+def post(url: str, **kwargs):
+    return request("POST", url, **kwargs)
+def get(url: str, **kwargs):
+    return request("GET", url, **kwargs)
@@ -0,0 +1,68 @@
+# image_cache.py
+# 圖片快取，重跑或補跑時不必重新生成與上傳：
+#   以「正規化後的 prompt + 生成與編碼設定」的雜湊為 key，
+#   存成 cache/images/{key}.json → {"url", "thumbnail_url"}，命中時連生成都略過
+#   - IMAGE_CACHE_TTL：prompt 快取有效秒數
+#   - IMAGE_CACHE_BYPASS=1：不讀快取（仍會寫入新結果）
+# 不做相似圖（perceptual hash）沿用：不同 prompt 的圖構圖相近也不代表同一個場景。
+import os
+import re
+import json
+import time
+import hashlib
+from serialization import read_object, write_object
+from settings import load_env
+from metrics import incr
+
+load_env()
+
+IMAGE_CACHE_PREFIX = "cache/images/"
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", str(90 * 24 * 3600)))
+IMAGE_CACHE_BYPASS = os.getenv("IMAGE_CACHE_BYPASS", "0") == "1"
+IMAGE_GENERATOR = os.getenv("IMAGE_GENERATOR", "placeholder")   # 換生成模型時 key 會跟著改變
+
+
+def normalize_prompt(prompt: str) -> str:
+    """大小寫、前後空白與連續空白不影響 key"""
+    return re.sub(r"\s+", " ", prompt).strip().lower()
+
+
+def image_prompt_key(prompt: str, settings: dict) -> str:
+    """settings：會影響輸出圖片的設定（生成模型、格式、品質、縮圖大小…）"""
+    raw = json.dumps({"prompt": normalize_prompt(prompt), "settings": settings}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    def __init__(self, ttl: float = IMAGE_CACHE_TTL, bypass: bool = IMAGE_CACHE_BYPASS):
+        self.ttl = ttl
+        self.bypass = bypass
+
+    def _path(self, key: str) -> str:
+        return f"{IMAGE_CACHE_PREFIX}{key}.json"
+
+    def get(self, key: str):
+        """回傳 {"url", "thumbnail_url"}，未命中、過期或 bypass 時回傳 None"""
+        if self.bypass:
+            return None
+        entry = read_object(self._path(key))
+        if entry is None:
+            incr("cache.image.miss")
+            return None
+        if time.time() - entry.get("created_at", 0) > self.ttl:
+            incr("cache.image.expired")
+            return None
+        incr("cache.image.hit")
+        return entry
+
+    def put(self, key: str, url: str, thumbnail_url: str = None):
+        write_object(self._path(key), {"created_at": time.time(), "url": url, "thumbnail_url": thumbnail_url})
+
+
+_cache = None
+
+def get_image_cache() -> ImageCache:
+    global _cache
+    if _cache is None:
+        _cache = ImageCache()
+    return _cache
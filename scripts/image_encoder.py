@@ -0,0 +1,147 @@
+# image_encoder.py
+# 圖片編碼：在 process pool 中把生成的圖片編碼成上傳用的 bytes，CPU 密集的壓縮不佔用主程序的 GIL。
+# 每張圖只解碼一次，同時產生完整圖片與縮圖：
+#   IMAGE_FORMAT=JPEG|WEBP        IMAGE_QUALITY=85        IMAGE_PROGRESSIVE=1（JPEG 漸進式）
+#   IMAGE_THUMBNAIL_SIZE=0（長邊像素，0 表示不產生縮圖）   IMAGE_THUMBNAIL_QUALITY=70
+#   （預設不自己產生縮圖：ImgBB 上傳時會附縮圖網址；自訂縮圖要多上傳一次）
+#   IMAGE_ENCODE_PROCESSES=CPU 核心數（0 表示在呼叫端執行緒直接編碼）
+# 每張圖回報編碼耗時與位元組數（log 與 metrics 的 image.encode.*），方便調整大小與上傳延遲的取捨。
+# 子行程以 spawn 啟動，不會繼承主程序的連線與執行緒。
+import os
+import time
+import threading
+import multiprocessing
+from io import BytesIO
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+from settings import load_env
+from metrics import incr
+
+load_env()
+
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_PROGRESSIVE = os.getenv("IMAGE_PROGRESSIVE", "1") == "1"
+IMAGE_THUMBNAIL_SIZE = int(os.getenv("IMAGE_THUMBNAIL_SIZE", "0"))
+IMAGE_THUMBNAIL_QUALITY = int(os.getenv("IMAGE_THUMBNAIL_QUALITY", "70"))
+IMAGE_ENCODE_PROCESSES = int(os.getenv("IMAGE_ENCODE_PROCESSES", str(os.cpu_count() or 1)))
+
+_CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+@dataclass(frozen=True)
+class EncodeOptions:
+    format: str = IMAGE_FORMAT
+    quality: int = IMAGE_QUALITY
+    progressive: bool = IMAGE_PROGRESSIVE
+    thumbnail_size: int = IMAGE_THUMBNAIL_SIZE
+    thumbnail_quality: int = IMAGE_THUMBNAIL_QUALITY
+
+
+# === 編碼（在子行程中執行，只依賴 PIL） ===
+def _save(img, options: EncodeOptions, quality: int) -> bytes:
+    buffered = BytesIO()
+    if options.format == "JPEG":
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(buffered, format="JPEG", quality=quality, optimize=True, progressive=options.progressive)
+    elif options.format == "WEBP":
+        img.save(buffered, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(buffered, format=options.format)
+    return buffered.getvalue()
+
+
+def _encode(source, options: EncodeOptions) -> dict:
+    """
+    source：(mode, size, raw pixels) 或已編碼的圖片 bytes（例如 API 回傳的 PNG）。
+    解碼一次，完整圖片與縮圖都從同一份像素產生。
+    """
+    start = time.perf_counter()
+    if isinstance(source, (bytes, bytearray)):
+        img = Image.open(BytesIO(source))
+        img.load()
+    else:
+        mode, size, raw = source
+        img = Image.frombytes(mode, size, raw)
+    data = _save(img, options, options.quality)
+    thumbnail = None
+    if options.thumbnail_size > 0:
+        thumb = img.copy()
+        thumb.thumbnail((options.thumbnail_size, options.thumbnail_size), Image.LANCZOS)
+        thumbnail = _save(thumb, options, options.thumbnail_quality)
+    return {
+        "data": data,
+        "thumbnail": thumbnail,
+        "format": options.format,
+        "content_type": _CONTENT_TYPES.get(options.format, "application/octet-stream"),
+        "size": img.size,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+# === Process pool ===
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_encode_pool():
+    """共用的編碼 process pool（第一次使用時建立）；IMAGE_ENCODE_PROCESSES=0 時回傳 None"""
+    global _pool
+    if IMAGE_ENCODE_PROCESSES <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_ENCODE_PROCESSES,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown_encode_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def _source(image):
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    # 傳原始像素比 pickle 整個 Image 物件省事，子行程直接 frombytes
+    return (image.mode, image.size, image.tobytes())
+
+
+def encode_image_variants(image, options: EncodeOptions = None) -> dict:
+    """
+    回傳 {"data", "thumbnail", "format", "content_type", "size", "seconds"}；
+    thumbnail 在 thumbnail_size=0 時為 None。可從多個執行緒同時呼叫。
+    """
+    global _pool
+    options = options or EncodeOptions()
+    source = _source(image)
+    pool = get_encode_pool()
+    if pool is None:
+        result = _encode(source, options)
+    else:
+        try:
+            result = pool.submit(_encode, source, options).result()
+        except BrokenProcessPool:
+            # 子行程異常結束（例如被 OOM 終止）：換一個新的 pool，這張圖先在本執行緒編碼
+            with _pool_lock:
+                if _pool is pool:
+                    _pool = None
+            result = _encode(source, options)
+    incr("image.encode", seconds=result["seconds"], bytes=len(result["data"]),
+         thumbnail_bytes=len(result["thumbnail"] or b""))
+    return result
+
+
+def describe(result: dict) -> str:
+    """給 log 用的一行摘要：格式、耗時、大小"""
+    text = f"{result['format']} {result['size'][0]}x{result['size'][1]} {len(result['data']) / 1024:.0f}KB"
+    if result["thumbnail"]:
+        text += f"（縮圖 {len(result['thumbnail']) / 1024:.0f}KB）"
+    return text + f"，編碼 {result['seconds']:.2f}s"
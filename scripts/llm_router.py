@@ -0,0 +1,232 @@
+# llm_router.py
+# LLM 路由：依序嘗試多個 provider / model（皆為 OpenAI 相容的 chat completions 端點）：
+#   - 記錄每條路線最近的延遲與錯誤率，連續失敗的路線暫時排到最後（冷卻時間隨失敗次數加倍）
+#   - 失敗時自動換下一條路線（failover）
+#   - LLM_HEDGE=1：第一個請求超過該路線延遲的 p95 仍未回來時，對下一條路線送出第二個請求，
+#     先成功的為準，另一個標記取消（send 應檢查 cancel 並關閉連線）；只有一條路線時不做 hedge
+# 設定方式：
+#   LLM_ROUTES="openrouter=deepseek/deepseek-r1-0528:free,openrouter=meta-llama/llama-3.3-70b-instruct:free"
+#   LLM_PROVIDERS="openrouter=https://openrouter.ai/api/v1/chat/completions,local=http://127.0.0.1:8000/v1/chat/completions"
+#   LLM_API_KEYS="openrouter=OR_DEEPKEEP_R1_API"（provider=存放 API key 的環境變數名稱）
+# 每個 provider 使用 rate_limit 中同名的限流器。
+import os
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from settings import load_env
+from metrics import incr
+
+load_env()
+
+DEFAULT_PROVIDERS = {"openrouter": os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")}
+DEFAULT_API_KEYS = {"openrouter": "OR_DEEPKEEP_R1_API"}
+DEFAULT_ROUTES = "openrouter=deepseek/deepseek-r1-0528:free"
+
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "60"))          # 樣本不足時的 hedge 等待秒數
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "5"))  # 至少幾筆延遲紀錄才用 p95
+LLM_ROUTE_RETRIES = int(os.getenv("LLM_ROUTE_RETRIES", "1"))          # 每條路線自己的重試次數（用盡才 failover）
+LLM_ROUTE_COOLDOWN = float(os.getenv("LLM_ROUTE_COOLDOWN", "30"))
+LLM_ROUTE_WINDOW = int(os.getenv("LLM_ROUTE_WINDOW", "50"))           # 延遲與錯誤率只看最近幾次
+LLM_ROUTER_THREADS = int(os.getenv("LLM_ROUTER_THREADS", "16"))        # 同時進行中的請求上限（含 hedge）
+
+
+def _parse_pairs(spec: str, defaults: dict = None) -> dict:
+    pairs = dict(defaults or {})
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, value = item.partition("=")
+        pairs[name.strip()] = value.strip()
+    return pairs
+
+
+@dataclass(frozen=True)
+class Route:
+    provider: str
+    model: str
+    url: str
+    key_env: str = ""
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider}/{self.model}"
+
+
+def load_routes(spec: str = None) -> list:
+    """依 LLM_ROUTES 的順序建立路線清單"""
+    providers = _parse_pairs(os.getenv("LLM_PROVIDERS", ""), DEFAULT_PROVIDERS)
+    keys = _parse_pairs(os.getenv("LLM_API_KEYS", ""), DEFAULT_API_KEYS)
+    routes = []
+    for item in filter(None, (s.strip() for s in (spec or os.getenv("LLM_ROUTES", DEFAULT_ROUTES)).split(","))):
+        provider, _, model = item.partition("=")
+        provider, model = provider.strip(), model.strip()
+        if provider not in providers:
+            raise ValueError(f"LLM_ROUTES 的 provider {provider!r} 沒有在 LLM_PROVIDERS 設定端點")
+        routes.append(Route(provider, model, providers[provider], keys.get(provider, "")))
+    if not routes:
+        raise ValueError("LLM_ROUTES 沒有任何路線")
+    return routes
+
+
+class RouteStats:
+    def __init__(self, window: int = LLM_ROUTE_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)   # 1 = 失敗
+        self.failures = 0                      # 連續失敗次數
+        self.cooldown_until = 0.0
+
+    def p(self, q: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def as_dict(self) -> dict:
+        p50, p95 = self.p(0.5), self.p(0.95)
+        return {
+            "calls": len(self.outcomes),
+            "error_rate": round(self.error_rate, 3),
+            "p50": round(p50, 3) if p50 is not None else None,
+            "p95": round(p95, 3) if p95 is not None else None,
+            "cooling_down": self.cooldown_until > time.monotonic(),
+        }
+
+
+class AllRoutesFailed(RuntimeError):
+    def __init__(self, errors: list):
+        super().__init__("所有 LLM 路線都失敗：" + "；".join(f"{name}: {e}" for name, e in errors))
+        self.errors = errors
+
+
+class StreamInterrupted(RuntimeError):
+    """串流已收到部分內容後中斷：內容可能已交給下游，不能換路線重來"""
+
+
+class LLMRouter:
+    def __init__(self, routes: list, hedge: bool = LLM_HEDGE, cooldown: float = LLM_ROUTE_COOLDOWN):
+        self.routes = list(routes)
+        self.hedge = hedge
+        self.cooldown = cooldown
+        self._stats = {route: RouteStats() for route in self.routes}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=LLM_ROUTER_THREADS, thread_name_prefix="llm_route")
+
+    # === 統計 ===
+    def _record(self, route: Route, seconds: float = None, error: Exception = None):
+        with self._lock:
+            stats = self._stats[route]
+            if error is None:
+                stats.latencies.append(seconds)
+                stats.outcomes.append(0)
+                stats.failures = 0
+                stats.cooldown_until = 0.0
+            else:
+                stats.outcomes.append(1)
+                stats.failures += 1
+                stats.cooldown_until = time.monotonic() + self.cooldown * 2 ** min(stats.failures - 1, 5)
+        incr(f"llm.route.{route.name}", errors=0 if error is None else 1)
+
+    def ordered(self) -> list:
+        """設定的順序為準，冷卻中的路線排到最後（全部都在冷卻時維持原順序）"""
+        now = time.monotonic()
+        with self._lock:
+            ready = [r for r in self.routes if self._stats[r].cooldown_until <= now]
+            cooling = sorted((r for r in self.routes if r not in ready), key=lambda r: self._stats[r].cooldown_until)
+        return ready + cooling
+
+    def hedge_delay(self, route: Route) -> float:
+        with self._lock:
+            stats = self._stats[route]
+            p95 = stats.p(0.95) if len(stats.latencies) >= LLM_HEDGE_MIN_SAMPLES else None
+        return max(LLM_HEDGE_MIN_DELAY, p95 if p95 is not None else LLM_HEDGE_DELAY)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {route.name: stats.as_dict() for route, stats in self._stats.items()}
+
+    # === 呼叫 ===
+    def call(self, send, hedge: bool = None, fatal: tuple = ()):
+        """
+        send(route, cancel) 發出請求並回傳結果；cancel 是 threading.Event，被設定時應盡快放棄。
+        fatal 中的例外不換路線，直接拋出（例如串流已經回呼過部分內容）。
+        全部路線都失敗時拋出 AllRoutesFailed。
+        """
+        hedge = self.hedge if hedge is None else hedge
+        routes = self.ordered()
+        queue, inflight, errors = routes[1:], {}, []
+        state = {"hedged": False, "hedge_at": 0.0, "primary": None}
+
+        def launch(route: Route):
+            cancel = threading.Event()
+            future = self._pool.submit(send, route, cancel)
+            inflight[future] = (route, cancel, time.monotonic())
+            if not state["hedged"]:
+                state["primary"] = future
+                state["hedge_at"] = time.monotonic() + self.hedge_delay(route)
+
+        def cancel_others(record: bool = False):
+            for route, other, started in inflight.values():
+                other.set()
+                if record:
+                    # 被取消的請求至少花了這麼久，計入延遲，p95 才不會只剩快的那些
+                    with self._lock:
+                        self._stats[route].latencies.append(time.monotonic() - started)
+
+        launch(routes[0])
+        while inflight:
+            # 沒有其他路線時不 hedge：對同一條路線重送只會加倍負載（限流與帳單）
+            waiting_hedge = hedge and queue and not state["hedged"] and len(inflight) == 1
+            timeout = max(0.0, state["hedge_at"] - time.monotonic()) if waiting_hedge else None
+            done, _ = wait(inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 超過 p95 還沒回來：對下一條路線再送一次
+                state["hedged"] = True
+                incr("llm.hedged")
+                launch(queue.pop(0))
+                continue
+
+            for future in done:
+                route, cancel, started = inflight.pop(future)
+                try:
+                    result = future.result()
+                except fatal:
+                    cancel_others()
+                    raise
+                except Exception as e:
+                    if cancel.is_set():
+                        continue
+                    self._record(route, error=e)
+                    errors.append((route.name, e))
+                    print(f"⚠️ LLM 路線 {route.name} 失敗：{e}")
+                    if not inflight and queue:
+                        incr("llm.failover")
+                        launch(queue.pop(0))
+                    continue
+
+                self._record(route, seconds=time.monotonic() - started)
+                if inflight:
+                    incr("llm.hedge_cancelled", len(inflight))
+                    cancel_others(record=True)
+                if state["hedged"]:
+                    incr("llm.hedge_won" if future is not state["primary"] else "llm.hedge_lost")
+                if isinstance(result, dict):
+                    result.setdefault("route", route.name)
+                return result
+        raise AllRoutesFailed(errors)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+def get_router() -> LLMRouter:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = LLMRouter(load_routes())
+        return _router
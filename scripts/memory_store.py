@@ -0,0 +1,214 @@
+# memory_store.py
+# 角色記憶：每日摘要 → 週摘要 → 月摘要，逐層壓縮，讀取大小固定。
+#   memory/{cid}/daily/{date}.json          每天一筆（只新增，不改寫）
+#   memory/{cid}/weekly/{year}_{week}.json  本週結束後由每日摘要合併而成（補記舊日期時併入同一週）
+#   memory/{cid}/monthly/{year_month}.json  本月結束後由週摘要合併而成
+#   memory/{cid}/view.json                  讀取用的固定大小視圖：本週每日 + 最近幾週 + 最近幾個月
+# 每次更新只寫入新的一筆與 view.json（以 generation 前置條件更新），不會改寫完整歷史。
+# 有綁定 unit of work 時延到 commit 才寫入，故事失敗被捨棄時記憶也不會更新。
+import os
+from settings import load_env, DayContext
+from storage_backend import get_storage, PreconditionError
+from serialization import decode, read_object, write_object
+from tokens import truncate_to_tokens
+from unit_of_work import current_unit_of_work
+from firebase_config import (
+    get_memory_daily_path,
+    get_memory_weekly_path,
+    get_memory_monthly_path,
+    get_memory_view_path,
+)
+
+load_env()
+
+MEMORY_WEEKLY_KEEP = int(os.getenv("MEMORY_WEEKLY_KEEP", "4"))      # view 中保留幾週
+MEMORY_MONTHLY_KEEP = int(os.getenv("MEMORY_MONTHLY_KEEP", "3"))    # view 中保留幾個月
+MEMORY_ENTRY_TOKENS = int(os.getenv("MEMORY_ENTRY_TOKENS", "80"))   # 合併時每筆摘要最多保留的 token
+MEMORY_DIGEST_TOKENS = int(os.getenv("MEMORY_DIGEST_TOKENS", "400"))  # 合併後整段的 token 上限，平均分給每筆
+
+
+def _write_json(path: str, data, if_generation_match: int = None) -> int:
+    return write_object(path, data, if_generation_match=if_generation_match)
+
+
+def _digest(texts: list) -> str:
+    """
+    把多筆摘要壓成一段（不呼叫 LLM）：整體預算平均分給每筆（最多 MEMORY_ENTRY_TOKENS），
+    筆數多時每筆都截短，而不是只留下前面幾筆。
+    """
+    texts = [t.strip() for t in texts if t and t.strip()]
+    if not texts:
+        return ""
+    share = max(1, min(MEMORY_ENTRY_TOKENS, MEMORY_DIGEST_TOKENS // len(texts)))
+    parts = [truncate_to_tokens(t, share, keep="head") for t in texts]
+    return truncate_to_tokens(" ".join(parts), MEMORY_DIGEST_TOKENS, keep="head")
+
+
+def _week_key(date_str: str) -> str:
+    """ISO 年 + 兩位數週數（2025_W09），字串排序即時間順序"""
+    year, week, _ = DayContext.for_date(date_str).date.isocalendar()
+    return f"{year}_W{week:02d}"
+
+
+# === 逐層壓縮 ===
+def _merge_week(cid: str, week: str, entries: list) -> dict:
+    """把每日摘要併入該週的週摘要（已存在時合併日期，不覆蓋先前合併過的天）"""
+    path = get_memory_weekly_path(cid, week)
+    existing = read_object(path, cached=False) or {}
+    summaries = {e["date"]: e["summary"] for e in entries}
+    for date in existing.get("dates", []):
+        if date not in summaries:
+            daily = read_object(get_memory_daily_path(cid, date), cached=False) or {}
+            summaries[date] = daily.get("summary", "")
+    dates = sorted(summaries)
+    digest = {
+        "week": week,
+        "month": dates[0][:7],
+        "dates": dates,
+        "digest": _digest([summaries[d] for d in dates]),
+    }
+    _write_json(path, digest)
+    return digest
+
+
+def _merge_month(cid: str, month: str, digests: list) -> dict:
+    """把週摘要併入月摘要；同一週重複併入時以最新的週摘要為準"""
+    path = get_memory_monthly_path(cid, month)
+    existing = read_object(path, cached=False) or {}
+    by_week = {d["week"]: d["digest"] for d in digests}
+    for week in existing.get("weeks", []):
+        if week not in by_week:
+            weekly = read_object(get_memory_weekly_path(cid, week), cached=False) or {}
+            by_week[week] = weekly.get("digest", "")
+    weeks = sorted(by_week)
+    merged = {"month": month, "weeks": weeks, "digest": _digest([by_week[w] for w in weeks])}
+    _write_json(path, merged)
+    return merged
+
+
+def _roll_up(cid: str, view: dict, day: DayContext) -> dict:
+    # 「本週」以 recent 中最新的一天為準：補記較舊的日期時，不會把比它新的天提早合併
+    latest = max((e["date"] for e in view["recent"]), default=day.today)
+    current_week = _week_key(max(latest, day.today))
+
+    # 1. 比本週舊、且不晚於這次記錄日期的每日摘要 → 週摘要（同一週併入既有的週摘要）
+    by_week, keep = {}, []
+    for entry in view["recent"]:
+        week = _week_key(entry["date"])
+        if week < current_week and entry["date"] <= day.today:
+            by_week.setdefault(week, []).append(entry)
+        else:
+            keep.append(entry)
+    view["recent"] = keep
+    weekly = {d["week"]: d for d in view["weekly"]}
+    for week, entries in sorted(by_week.items()):
+        weekly[week] = _merge_week(cid, week, entries)
+    view["weekly"] = [weekly[w] for w in sorted(weekly)]
+
+    # 2. 超出保留數量的舊週摘要 → 月摘要
+    overflow = view["weekly"][:max(0, len(view["weekly"]) - MEMORY_WEEKLY_KEEP)]
+    view["weekly"] = view["weekly"][len(overflow):]
+    by_month = {}
+    for digest in overflow:
+        by_month.setdefault(digest["month"], []).append(digest)
+    monthly = {m["month"]: m for m in view["monthly"]}
+    for month, digests in sorted(by_month.items()):
+        monthly[month] = _merge_month(cid, month, digests)
+    view["monthly"] = [monthly[m] for m in sorted(monthly)][-MEMORY_MONTHLY_KEEP:]
+    return view
+
+
+# === 寫入 ===
+def record_daily_memory(cid: str, day: DayContext, theme: str, summary: str, max_attempts: int = 5) -> dict:
+    """
+    新增一天的記憶並更新 view.json，必要時把舊的每日 / 週摘要往上合併。
+    同一天重複記錄會覆蓋當天那筆（重跑不會重複累積）。
+    有綁定 unit of work 時延到 commit（故事資料寫出後）才更新，回傳 None。
+    """
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.after_commit(lambda: _record_daily_memory(cid, day, theme, summary, max_attempts))
+        return None
+    return _record_daily_memory(cid, day, theme, summary, max_attempts)
+
+
+def _record_daily_memory(cid: str, day: DayContext, theme: str, summary: str, max_attempts: int) -> dict:
+    entry = {"date": day.today, "theme": theme, "summary": summary}
+    _write_json(get_memory_daily_path(cid, day.today), entry)
+
+    store = get_storage()
+    view_path = get_memory_view_path(cid)
+    for _ in range(max_attempts):
+        obj = store.backend.read(view_path)
+        view = decode(obj.data) if obj else {"recent": [], "weekly": [], "monthly": []}
+        view["recent"] = [e for e in view["recent"] if e["date"] != day.today] + [entry]
+        view["recent"].sort(key=lambda e: e["date"])
+        view = _roll_up(cid, view, day)
+        try:
+            _write_json(view_path, view, if_generation_match=obj.generation if obj else 0)
+            return view
+        except PreconditionError:
+            continue  # 其他程序剛好也在更新，重新讀取後再試
+    raise RuntimeError(f"記憶視圖更新失敗（多次衝突）：{view_path}")
+
+
+# === 讀取 ===
+def _week_before(cid: str, digest: dict, before: str):
+    """週摘要只保留 before 之前的天；整週都在之後時回傳 None（部分重疊時由每日摘要重新合併，不寫回）"""
+    dates = [d for d in digest.get("dates", []) if d < before]
+    if len(dates) == len(digest.get("dates", [])):
+        return digest
+    if not dates:
+        return None
+    summaries = [(read_object(get_memory_daily_path(cid, d)) or {}).get("summary", "") for d in dates]
+    return {**digest, "month": dates[0][:7], "dates": dates, "digest": _digest(summaries)}
+
+
+def _month_before(cid: str, digest: dict, before: str):
+    """月摘要只保留 before 之前的週；需要裁切時由週摘要重新合併（不寫回）"""
+    cutoff_week = _week_key(before)
+    if all(w < cutoff_week for w in digest.get("weeks", [])):
+        return digest
+    texts, weeks = [], []
+    for week in digest.get("weeks", []):
+        if week > cutoff_week:
+            continue
+        weekly = read_object(get_memory_weekly_path(cid, week)) or {}
+        weekly = _week_before(cid, weekly, before) if week == cutoff_week else weekly
+        if weekly:
+            weeks.append(week)
+            texts.append(weekly.get("digest", ""))
+    return {**digest, "weeks": weeks, "digest": _digest(texts)} if weeks else None
+
+
+def view_before(cid: str, view: dict, before: str) -> dict:
+    """
+    只包含 before（不含）之前日期的記憶視圖，補跑舊日期時用，避免看到「未來」的故事。
+    視圖本身只保留最近幾週／幾個月，補跑很久以前的日期時能看到的記憶會比較少。
+    """
+    monthly = [_month_before(cid, m, before) for m in view.get("monthly", []) if m["month"] <= before[:7]]
+    weekly = [_week_before(cid, w, before) for w in view.get("weekly", [])]
+    return {
+        "recent": [e for e in view.get("recent", []) if e["date"] < before],
+        "weekly": [w for w in weekly if w],
+        "monthly": [m for m in monthly if m],
+    }
+
+
+def load_memory_view(cid: str, before: str = None) -> dict:
+    """before：只看這天之前的記憶（補跑時傳入當天日期）"""
+    view = read_object(get_memory_view_path(cid), default={})
+    return view_before(cid, view, before) if view and before else view
+def format_memory(view: dict) -> str:
+    """由舊到新排列：月摘要 → 週摘要 → 本週每日"""
+    blocks = []
+    for m in view.get("monthly", []):
+        blocks.append(f"=== Month {m['month']} ===\n{m['digest']}")
+    for w in view.get("weekly", []):
+        blocks.append(f"=== Week {w['week']} ===\n{w['digest']}")
+    for e in view.get("recent", []):
+        blocks.append(f"=== {e['date']}: {e['theme']} ===\n{e['summary']}")
+    return "\n\n".join(blocks)
+def load_memory_text(cid: str, before: str = None) -> str:
+    """回傳放進 prompt 的記憶文字；大小受 view 的保留數量限制"""
+    return format_memory(load_memory_view(cid, before=before))
@@ -0,0 +1,117 @@
+# metrics.py
+# 輕量的執行量測：
+#   - span("story", character=cid)：記錄每個階段 / 角色的耗時（可巢狀、可多執行緒）
+#   - incr("storage.download", bytes=...)：計數器（儲存呼叫次數、傳輸量、HTTP 呼叫、重試、快取命中…）
+#   - write_run_summary("story")：執行結束時把摘要寫成 JSON，放在 run log 分段旁邊
+#       logs/errors/{date}/{stage}_{run_id}_summary.json
+# 只做記憶體中的加總，關閉 METRICS_ENABLED 時所有呼叫都是空操作。
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from settings import load_env
+
+load_env()
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+MAX_SPANS = 10000   # 保留的 span 明細上限，避免長時間執行時無限成長
+
+_lock = threading.Lock()
+_local = threading.local()
+_counters = {}
+_spans = []
+_started_at = time.time()
+
+
+def incr(name: str, value: float = 1, **extra):
+    """累加計數器；extra 例如 bytes=1234 會累加到 "{name}.bytes" """
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+        for key, v in extra.items():
+            full = f"{name}.{key}"
+            _counters[full] = _counters.get(full, 0) + v
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """記錄一段區間的耗時；巢狀使用時會記下上層 span 名稱"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e.__class__.__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stack.pop()
+        record = {"name": name, "parent": parent, "duration": round(duration, 4), **attrs}
+        if error:
+            record["error"] = error
+        with _lock:
+            if len(_spans) < MAX_SPANS:
+                _spans.append(record)
+            key = f"span.{name}"
+            _counters[f"{key}.count"] = _counters.get(f"{key}.count", 0) + 1
+            _counters[f"{key}.seconds"] = _counters.get(f"{key}.seconds", 0) + duration
+
+
+def snapshot() -> dict:
+    """目前的計數器與 span 統計（不含明細）"""
+    with _lock:
+        counters = {k: round(v, 4) if isinstance(v, float) else v for k, v in sorted(_counters.items())}
+        return {"elapsed": round(time.time() - _started_at, 3), "counters": counters}
+
+
+def reset():
+    global _started_at
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+        _started_at = time.time()
+
+
+def build_summary(stage: str) -> dict:
+    with _lock:
+        spans = list(_spans)
+    summary = snapshot()
+    summary.update({
+        "stage": stage,
+        "pid": os.getpid(),
+        "started_at": datetime.fromtimestamp(_started_at).isoformat(),
+        "finished_at": datetime.now().isoformat(),
+        "spans": spans,
+    })
+    return summary
+
+
+def write_run_summary(stage: str, date_str: str = None) -> str:
+    """把本次執行的量測摘要寫到 logs/errors/{date}/ 底下，回傳路徑；失敗只印出警告"""
+    if not METRICS_ENABLED:
+        return ""
+    from storage_backend import get_storage
+    from firebase_config import get_run_summary_path
+
+    date_str = date_str or datetime.now().strftime("%Y-%m-%d")
+    run_id = f"{datetime.fromtimestamp(_started_at).strftime('%H%M%S')}_{os.getpid()}"
+    path = get_run_summary_path(date_str, stage, run_id)
+    summary = build_summary(stage)
+    try:
+        body = json.dumps(summary, ensure_ascii=False).encode("utf-8")
+        get_storage().write(path, body, content_type="application/json")
+    except Exception as e:
+        print(f"⚠️ 執行摘要寫入失敗：{e}")
+        return ""
+    return path
@@ -0,0 +1,88 @@
+# pipeline.py
+# 多階段管線：每個階段有自己的 worker 執行緒，階段之間以有上限的 queue 串接，
+# 讓「生成 → 編碼 → 上傳」在不同 prompt／角色之間重疊進行。
+# 單一項目在任一階段失敗時，只有該項目帶著例外往後傳，不影響其他項目。
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Callable
+from metrics import span
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable
+    workers: int = 1
+
+
+class StageError(Exception):
+    def __init__(self, stage: str, error: Exception):
+        super().__init__(f"{stage}: {error}")
+        self.stage = stage
+        self.error = error
+
+
+def run_pipeline(items: list, stages: list, queue_size: int = 8, on_result: Callable = None) -> list:
+    """
+    依序讓每個 item 通過所有 stages，回傳與 items 同順序的結果清單。
+    失敗的項目結果為 StageError。on_result(index, item, result) 會在主執行緒中、
+    每個項目完成時立即呼叫（完成順序不保證與輸入順序相同）。
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def worker(i, stage, remaining, lock):
+        inbox, outbox = queues[i], queues[i + 1]
+        while True:
+            job = inbox.get()
+            if job is _DONE:
+                # 本階段最後一個結束的 worker 負責通知下一階段
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    next_workers = stages[i + 1].workers if i + 1 < len(stages) else 1
+                    for _ in range(next_workers):
+                        outbox.put(_DONE)
+                return
+            index, value = job
+            if not isinstance(value, StageError):
+                try:
+                    with span(f"pipeline.{stage.name}"):
+                        value = stage.fn(value)
+                except Exception as e:
+                    value = StageError(stage.name, e)
+            outbox.put((index, value))
+
+    threads = []
+    for i, stage in enumerate(stages):
+        remaining, lock = [stage.workers], threading.Lock()
+        for n in range(stage.workers):
+            t = threading.Thread(target=worker, args=(i, stage, remaining, lock),
+                                 name=f"{stage.name}-{n}", daemon=True)
+            t.start()
+            threads.append(t)
+
+    def feed():
+        for index, item in enumerate(items):
+            queues[0].put((index, item))
+        for _ in range(stages[0].workers):
+            queues[0].put(_DONE)
+    threading.Thread(target=feed, name="pipeline-feed", daemon=True).start()
+
+    results = [None] * len(items)
+    outbox = queues[-1]
+    while True:
+        job = outbox.get()
+        if job is _DONE:
+            break
+        index, value = job
+        results[index] = value
+        if on_result:
+            on_result(index, items[index], value)
+
+    for t in threads:
+        t.join()
+    return results
@@ -0,0 +1,90 @@
+# rate_limit.py
+# 依外部服務（provider / endpoint）分開的 token bucket 限流器，多執行緒共用。
+# 設定方式：RATE_LIMITS="openrouter=0.33:2,imgbb=1:3"（每秒補充量:最大累積量）
+import os
+import time
+import threading
+from settings import load_env
+
+load_env()
+
+DEFAULT_RATE_LIMITS = {
+    "openrouter": (20 / 60, 2),  # OpenRouter 免費模型約每分鐘 20 次
+    "imgbb": (1.0, 3),
+}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_rate = rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """取得額度，不足時阻塞等待；回傳等待的秒數"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                elif self.rate == float("inf"):
+                    return waited
+                else:
+                    self._refill(now)
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return waited
+                    delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def penalize(self, retry_after: float = None):
+        """
+        收到 HTTP 429 時呼叫：所有執行緒暫停到 Retry-After 之後，
+        並把補充速率減半（之後每次成功再慢慢恢復）。
+        """
+        with self._lock:
+            now = time.monotonic()
+            pause = retry_after if retry_after is not None else 1.0 / min(self.rate, 1.0)
+            self._blocked_until = max(self._blocked_until, now + pause)
+            self._tokens = 0.0
+            self._updated = self._blocked_until
+            if self.rate != float("inf"):
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def on_success(self):
+        """請求成功時逐步把速率恢復到設定值"""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+def _parse_rate_limits(spec: str) -> dict:
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, value = item.partition("=")
+        rate, _, capacity = value.partition(":")
+        limits[name.strip()] = (float(rate), float(capacity or 1))
+    return limits
+
+
+RATE_LIMITS = _parse_rate_limits(os.getenv("RATE_LIMITS", ""))
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(name: str) -> TokenBucket:
+    """取得某個 provider 的共用限流器；未設定的名稱不限流（極大速率）"""
+    with _limiters_lock:
+        if name not in _limiters:
+            rate, capacity = RATE_LIMITS.get(name, (float("inf"), 1))
+            _limiters[name] = TokenBucket(rate, capacity)
+        return _limiters[name]
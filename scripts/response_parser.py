@@ -0,0 +1,167 @@
+# response_parser.py
+# LLM 回應格式解析（單次線性掃描）：
+#   ###STORY:
+#   ...
+#   ###SUMMARY:
+#   ...
+#   ###PROMPTS:
+#   - prompt_1
+#   ...
+# - StreamingResponseParser：串流時逐段 feed，每完成一行 prompt 就立即回呼；
+#   abort_on_error=True 時一發現明顯不符格式就拋出 ResponseFormatError，讓呼叫端中止串流。
+# - parse_response：完整文字一次解析並驗證（故事非空、摘要非空、剛好 10 個 prompt），
+#   錯誤以 SectionError 逐段回報，呼叫端可以只重新生成有問題的段落。
+import re
+from dataclasses import dataclass, field
+
+SECTIONS = ("STORY", "SUMMARY", "PROMPTS")
+EXPECTED_PROMPTS = 10
+MAX_PREAMBLE_CHARS = 2000   # 出現 ###STORY: 之前最多容許的前言長度
+
+_MARKER_RE = re.compile(r"^\s*###\s*(STORY|SUMMARY|PROMPTS)\s*:\s*(.*)$")
+_PROMPT_RE = re.compile(r"^\s*(?:[-*•]|\d{1,2}[.)])\s*(.*)$")   # "- xxx"、"* xxx"、"1. xxx"
+
+
+@dataclass
+class SectionError:
+    section: str     # STORY / SUMMARY / PROMPTS / FORMAT
+    code: str        # missing / empty / prompt_count / order / preamble
+    message: str
+
+
+@dataclass
+class ParsedResponse:
+    story: str = ""
+    summary: str = ""
+    prompts: list = field(default_factory=list)
+    errors: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    @property
+    def bad_sections(self) -> set:
+        return {e.section for e in self.errors}
+
+    def as_dict(self) -> dict:
+        return {"story": self.story, "summary": self.summary, "prompt_list": list(self.prompts)}
+
+
+class ResponseFormatError(RuntimeError):
+    """LLM 回應不符合 ###STORY / ###SUMMARY / ###PROMPTS 格式"""
+    def __init__(self, message: str, errors: list = None, parsed: ParsedResponse = None):
+        super().__init__(message)
+        self.errors = errors or []
+        self.parsed = parsed
+
+
+class StreamingResponseParser:
+    def __init__(self, on_prompt=None, expected_prompts: int = EXPECTED_PROMPTS, abort_on_error: bool = True):
+        self.on_prompt = on_prompt              # on_prompt(index, prompt)，index 從 1 開始
+        self.expected_prompts = expected_prompts
+        self.abort_on_error = abort_on_error
+        self.section = None                      # 目前所在段落，None 代表還在前言
+        self.seen = []                           # 出現過的段落
+        self.parts = {"STORY": [], "SUMMARY": [], "PROMPTS": []}
+        self.prompts = []
+        self.errors = []
+        self._pending = ""                        # 尚未遇到換行的殘餘文字
+        self._preamble_chars = 0
+
+    def feed(self, chunk: str):
+        """餵入一段文字（可以是任意切分的 token），只處理已完整的行"""
+        self._pending += chunk
+        *lines, self._pending = self._pending.split("\n")
+        for line in lines:
+            self._process_line(line)
+
+    def close(self) -> dict:
+        """處理最後一行並回傳 story / summary / prompt_list"""
+        return self.finish().as_dict()
+
+    def finish(self) -> ParsedResponse:
+        if self._pending:
+            self._process_line(self._pending)
+            self._pending = ""
+        return ParsedResponse(
+            story="\n".join(self.parts["STORY"]).strip(),
+            summary="\n".join(self.parts["SUMMARY"]).strip(),
+            prompts=list(self.prompts),
+            errors=list(self.errors),
+        )
+
+    def _error(self, section: str, code: str, message: str):
+        error = SectionError(section, code, message)
+        self.errors.append(error)
+        if self.abort_on_error:
+            raise ResponseFormatError(message, [error])
+
+    def _process_line(self, line: str):
+        line = line.rstrip("\r")
+        match = _MARKER_RE.match(line)
+        if match:
+            self._enter_section(match.group(1))
+            line = match.group(2)
+            if not line:
+                return
+
+        if self.section is None:
+            self._preamble_chars += len(line) + 1
+            if self.abort_on_error and self._preamble_chars > MAX_PREAMBLE_CHARS:
+                self._error("FORMAT", "preamble", f"超過 {MAX_PREAMBLE_CHARS} 字仍未出現 ###STORY:")
+            return
+
+        if self.section == "PROMPTS":
+            prompt = _PROMPT_RE.match(line)
+            if prompt:
+                self._add_prompt(prompt.group(1).strip())
+            return
+
+        self.parts[self.section].append(line)
+
+    def _enter_section(self, name: str):
+        if name in self.seen or (self.section and SECTIONS.index(name) < SECTIONS.index(self.section)):
+            self._error(name, "order", f"段落順序錯誤：###{name}: 出現在 ###{self.section}: 之後")
+        self.seen.append(name)
+        self.section = name
+
+    def _add_prompt(self, prompt: str):
+        if not prompt:
+            return
+        if len(self.prompts) >= self.expected_prompts and self.abort_on_error:
+            self._error("PROMPTS", "prompt_count", f"prompt 數量超過 {self.expected_prompts} 個")
+        self.prompts.append(prompt)
+        if self.on_prompt:
+            self.on_prompt(len(self.prompts), prompt)
+
+
+def parse_response(text: str, expected_prompts: int = EXPECTED_PROMPTS, required: tuple = SECTIONS) -> ParsedResponse:
+    """
+    一次掃描解析完整回應並驗證；不拋例外，錯誤記錄在 ParsedResponse.errors。
+    required 可只指定部分段落（例如重新生成 SUMMARY / PROMPTS 時）。
+    """
+    parser = StreamingResponseParser(expected_prompts=expected_prompts, abort_on_error=False)
+    parser.feed(text or "")
+    parsed = parser.finish()
+
+    for name in required:
+        if name not in parser.seen:
+            parsed.errors.append(SectionError(name, "missing", f"缺少 ###{name}: 段落"))
+        elif name == "STORY" and not parsed.story:
+            parsed.errors.append(SectionError(name, "empty", "故事內容是空的"))
+        elif name == "SUMMARY" and not parsed.summary:
+            parsed.errors.append(SectionError(name, "empty", "摘要內容是空的"))
+        elif name == "PROMPTS" and len(parsed.prompts) != expected_prompts:
+            parsed.errors.append(SectionError(
+                name, "prompt_count", f"prompt 數量為 {len(parsed.prompts)}，應為 {expected_prompts}"))
+    return parsed
+
+
+def parse_response_strict(text: str, expected_prompts: int = EXPECTED_PROMPTS) -> ParsedResponse:
+    """同 parse_response，但有任何錯誤就拋出 ResponseFormatError（附上所有 SectionError）"""
+    parsed = parse_response(text, expected_prompts)
+    if parsed.errors:
+        detail = "；".join(f"{e.section}: {e.message}" for e in parsed.errors)
+        raise ResponseFormatError(f"LLM 回應格式錯誤：{detail}", parsed.errors, parsed)
+    return parsed
@@ -0,0 +1,204 @@
+# run_log.py
+# 執行日誌：log_and_print 只把紀錄放進記憶體緩衝，
+# 由背景執行緒依「筆數 / 時間 / 程式結束」批次寫成 append-only 的 JSONL 分段檔。
+#   logs/errors/{date}/{run_id}_{seq}.jsonl
+# 讀取時再與舊格式 logs/errors/{date}_error.json 合併成同一份每日清單。
+# 排程器每次執行後把前一天的分段合併回 {date}_error.json；也可以手動執行：
+#   python run_log.py read [--date 2025-06-23]       印出某日完整日誌（JSON）
+#   python run_log.py compact [--date 2025-06-23]    合併某日分段（預設昨天）
+import os
+import sys
+import json
+import atexit
+import argparse
+import threading
+from datetime import datetime, timedelta
+from firebase_config import (
+    get_error_log_path,
+    get_error_log_segment_prefix,
+)
+from storage_backend import get_storage
+from serialization import decode, write_object
+from settings import load_env
+from metrics import incr
+
+load_env()
+
+LOG_FLUSH_SIZE = int(os.getenv("LOG_FLUSH_SIZE", "50"))           # 累積幾筆就寫出
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "10"))  # 最長幾秒寫出一次
+LOG_BUFFER_MAX = int(os.getenv("LOG_BUFFER_MAX", "5000"))          # 寫入一直失敗時緩衝區最多保留幾筆（丟棄最舊的）
+
+
+class RunLogSink:
+    def __init__(self, flush_size: int = LOG_FLUSH_SIZE, flush_interval: float = LOG_FLUSH_INTERVAL,
+                 max_buffer: int = LOG_BUFFER_MAX):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0                   # 因緩衝區已滿而丟棄的筆數
+        self.run_id = f"{datetime.now().strftime('%H%M%S')}_{os.getpid()}"
+        self._buffer = []                  # [(date_str, entry), ...]
+        self._seq = 0
+        self._lock = threading.Lock()       # 保護 _buffer
+        self._flush_lock = threading.Lock() # 同時間只允許一個 flush
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._worker = None
+
+    # === 熱路徑：只做 append ===
+    def emit(self, entry: dict, date_str: str):
+        with self._lock:
+            self._buffer.append((date_str, entry))
+            self._trim()
+            size = len(self._buffer)
+            closed = self._closed
+            if self._worker is None and not closed:
+                self._start_worker()
+        if closed:
+            # 已關閉（例如 atexit 之後仍有紀錄）：沒有背景執行緒了，直接寫出
+            self.flush()
+        elif size >= self.flush_size:
+            self._wakeup.set()
+
+    def _trim(self):
+        """緩衝區超過上限時丟棄最舊的紀錄並計數（呼叫端持有 _lock）"""
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            del self._buffer[:overflow]
+            self.dropped += overflow
+            incr("log.dropped", overflow)
+
+    def _start_worker(self):
+        self._worker = threading.Thread(target=self._run, name="run-log-flusher", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    # === 批次寫出 ===
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._buffer = self._buffer, []
+            if not pending:
+                return
+
+            by_date = {}
+            for date_str, entry in pending:
+                by_date.setdefault(date_str, []).append(entry)
+
+            failed = []
+            for date_str, entries in by_date.items():
+                try:
+                    self._write_segment(date_str, entries)
+                except Exception as e:
+                    print(f"❌ 錯誤紀錄寫入失敗：{e}")
+                    failed.extend((date_str, entry) for entry in entries)
+
+            # 寫入失敗的紀錄放回緩衝區，下次再試（總數受 max_buffer 限制）
+            if failed:
+                with self._lock:
+                    self._buffer[:0] = failed
+                    self._trim()
+
+    def _write_segment(self, date_str: str, entries: list):
+        self._seq += 1
+        path = f"{get_error_log_segment_prefix(date_str)}{self.run_id}_{self._seq:04d}.jsonl"
+        body = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+        # 每個分段只建立一次，不會覆蓋其他程序的紀錄
+        get_storage().write(path, body.encode("utf-8"), content_type="application/x-ndjson", if_generation_match=0)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+        with self._lock:
+            lost = len(self._buffer)
+        if lost or self.dropped:
+            print(f"⚠️ 錯誤紀錄未能寫出：{lost} 筆仍在緩衝區，{self.dropped} 筆因緩衝區已滿被丟棄")
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+def get_run_log_sink() -> RunLogSink:
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = RunLogSink()
+    return _sink
+
+
+# === 讀取：合併舊格式與分段檔 ===
+def _load_entries(store, date_str: str, segments: list) -> list:
+    entries = []
+
+    legacy = store.read(get_error_log_path(date_str))
+    if legacy is not None:
+        entries.extend(decode(legacy.data))
+    # 合併寫出後、刪除分段前中斷時，分段的內容已在 {date}_error.json 中：略過相同的紀錄
+    merged = {json.dumps(e, ensure_ascii=False, sort_keys=True) for e in entries}
+
+    for name in segments:
+        if not name.endswith(".jsonl"):
+            continue  # 同一資料夾中的執行摘要（*_summary.json）不是日誌分段
+        segment = store.read(name)
+        if segment is None:
+            continue
+        for line in segment.text().splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                if json.dumps(entry, ensure_ascii=False, sort_keys=True) not in merged:
+                    entries.append(entry)
+
+    entries.sort(key=lambda e: e.get("timestamp", ""))
+    return entries
+def read_error_log(date_str: str) -> list:
+    """
+    回傳某日完整錯誤日誌（與舊版 {date}_error.json 相同的 list 格式），依時間排序。
+    """
+    store = get_storage()
+    segments = store.list(get_error_log_segment_prefix(date_str))
+    return _load_entries(store, date_str, segments)
+def compact_error_log(date_str: str) -> int:
+    """
+    將分段檔合併回 {date}_error.json 並刪除分段，回傳合併後的筆數。
+    適合在當日結束後由排程執行一次；沒有分段時不改寫。
+    """
+    store = get_storage()
+    segments = [n for n in store.list(get_error_log_segment_prefix(date_str)) if n.endswith(".jsonl")]
+    if not segments:
+        return 0
+    entries = _load_entries(store, date_str, segments)
+
+    write_object(get_error_log_path(date_str), entries)
+    for name in segments:
+        store.delete(name)
+    return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("read", "compact"):
+        sub.add_parser(name).add_argument("--date", help="日期 YYYY-MM-DD（read 預設今天，compact 預設昨天）")
+    args = parser.parse_args()
+
+    if args.command == "read":
+        date_str = args.date or datetime.now().strftime("%Y-%m-%d")
+        print(json.dumps(read_error_log(date_str), ensure_ascii=False, indent=2))
+    else:
+        date_str = args.date or (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+        print(f"✅ {date_str} 錯誤日誌已合併：共 {compact_error_log(date_str)} 筆")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+# scheduler.py
+# 常駐排程：每天台北時間 SCHEDULER_RUN_AT 執行 setup → story → image。
+#   python scheduler.py                              常駐，依排程執行
+#   python scheduler.py --once [--date 2025-06-23]   立即執行一次後結束
+# - Firebase、HTTP 連線池、tiktoken 與快取在同一個程序內保持溫熱，不必每個階段重新初始化
+# - 每位角色是一條 story → image 的相依鏈：A 的故事一完成就開始生圖，不必等 B 的故事
+# - http://127.0.0.1:{SCHEDULER_STATUS_PORT}/status 回傳目前狀態（JSON），POST /run 立即觸發一次
+import os
+import json
+import time
+import signal
+import argparse
+import threading
+from datetime import datetime, timedelta
+from dataclasses import dataclass
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http_client
+import metrics
+from config import STORY_CONCURRENCY, IMAGE_PREFETCH
+from settings import load_env, get_settings, DayContext
+from storage_backend import get_storage
+from tokens import get_encoding
+from unit_of_work import UnitOfWork
+from llm_router import get_router
+from utils import log_and_print
+from run_log import compact_error_log
+from setup_today_structure import setup_day
+from generate_story import generate_character_story
+from generate_image import generate_all_images, ImagePrefetcher
+
+load_env()
+
+SCHEDULER_RUN_AT = os.getenv("SCHEDULER_RUN_AT", "06:00")                   # 台北時間 HH:MM
+SCHEDULER_STATUS_PORT = int(os.getenv("SCHEDULER_STATUS_PORT", "8765"))     # 0：不開狀態端點
+SCHEDULER_IMAGE_CONCURRENCY = int(os.getenv("SCHEDULER_IMAGE_CONCURRENCY", "2"))  # 同時生圖的角色數
+
+
+# === 相依圖 ===
+@dataclass
+class Task:
+    name: str
+    fn: Callable
+    deps: tuple = ()
+    pool: str = "default"
+    state: str = "pending"     # pending / queued / running / done / failed / skipped
+    started: float = None
+    finished: float = None
+    error: str = None
+
+    def as_dict(self) -> dict:
+        duration = round(self.finished - self.started, 2) if self.started and self.finished else None
+        return {"state": self.state, "deps": list(self.deps), "duration": duration, "error": self.error}
+
+
+class TaskGraph:
+    """依相依關係執行工作：相依的工作都完成就送進對應的 thread pool；相依失敗時略過"""
+    def __init__(self, pools: dict):
+        self.pools = pools          # {pool 名稱: worker 數}
+        self.tasks = {}
+
+    def add(self, name: str, fn: Callable, deps: tuple = (), pool: str = "default") -> Task:
+        self.tasks[name] = Task(name, fn, tuple(deps), pool)
+        return self.tasks[name]
+
+    def _run_task(self, task: Task):
+        task.state, task.started = "running", time.time()
+        try:
+            task.fn()
+            task.state = "done"
+        except Exception as e:
+            task.state, task.error = "failed", str(e)
+            log_and_print(f"❌ {task.name} 失敗：{e}\n", error_type="ERROR")
+        finally:
+            task.finished = time.time()
+
+    def run(self):
+        executors = {name: ThreadPoolExecutor(max_workers=max(1, n), thread_name_prefix=name)
+                     for name, n in self.pools.items()}
+        running = set()
+        try:
+            while True:
+                for task in self.tasks.values():
+                    if task.state != "pending":
+                        continue
+                    states = [self.tasks[d].state for d in task.deps]
+                    if any(s in ("failed", "skipped") for s in states):
+                        task.state = "skipped"
+                    elif all(s == "done" for s in states):
+                        task.state = "queued"
+                        running.add(executors[task.pool].submit(self._run_task, task))
+                if not running:
+                    break
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+
+    def as_dict(self) -> dict:
+        return {name: task.as_dict() for name, task in self.tasks.items()}
+
+
+# === 排程器 ===
+class Scheduler:
+    def __init__(self, run_at: str = SCHEDULER_RUN_AT):
+        hour, _, minute = run_at.partition(":")
+        self.run_hour, self.run_minute = int(hour), int(minute or 0)
+        self.status = {"state": "idle", "started_at": datetime.now().isoformat(),
+                       "next_run": None, "current": None, "last_run": None}
+        self._graph = None
+        self._stop = threading.Event()
+        self._trigger = threading.Event()
+        self._server = None
+
+    # === 啟動前預熱 ===
+    def warm_up(self):
+        store = get_storage()
+        getattr(store.backend, "bucket", None)   # FirebaseBackend：初始化 Firebase app
+        http_client.get_client()
+        get_encoding()
+        log_and_print("🔥 Storage、HTTP 連線池與 tokenizer 已就緒\n", error_type="OK")
+
+    @staticmethod
+    def _in_unit(unit: UnitOfWork, commit: bool, fn: Callable, *args, **kwargs):
+        """
+        在角色的 unit of work 中執行；成功且 commit=True 時寫出暫存。
+        失敗時只捨棄這個階段新增的暫存（setup 先前的暫存保留，最後一起寫出），不寫出不完整的結果。
+        """
+        savepoint = unit.savepoint()
+        try:
+            with unit.bind():
+                result = fn(*args, **kwargs)
+        except BaseException:
+            unit.rollback(savepoint)
+            raise
+        if commit:
+            unit.commit()
+        return result
+
+    # === 執行一天 ===
+    def run_day(self, day: DayContext):
+        get_settings().refresh()   # 常駐程序跨日後，預設日期要跟著更新
+        metrics.reset()
+        current = {"date": day.today, "started_at": datetime.now().isoformat(), "phase": "setup", "tasks": {}}
+        self.status.update(state="running", current=current)
+        try:
+            with metrics.span("stage.scheduler", date=day.today):
+                # 每位角色一個 unit of work：setup 寫的 log.json 留在記憶體給 story / image 直接讀，
+                # story 與 image 階段各自結束時寫出（含 after_commit：story 的完成標記必須早於圖片進度寫入）
+                units = {}
+                today_paths = setup_day(day, units=units)
+                current["phase"] = "generate"
+                # 故事串流出的 prompt 交給 prefetcher 先開始生圖，圖片階段以 prompt key 沿用結果
+                prefetcher = ImagePrefetcher(today_paths) if IMAGE_PREFETCH else None
+                on_prompt = prefetcher.on_prompt if prefetcher else None
+                self._graph = graph = TaskGraph({"story": STORY_CONCURRENCY, "image": SCHEDULER_IMAGE_CONCURRENCY})
+                for cid, info in today_paths.items():
+                    if "theme" not in info:
+                        continue
+                    unit = units.setdefault(cid, UnitOfWork())
+                    graph.add(f"story:{cid}",
+                              lambda cid=cid, info=info, unit=unit: self._in_unit(
+                                  unit, True, generate_character_story, cid, info, on_prompt=on_prompt, day=day),
+                              pool="story")
+                    graph.add(f"image:{cid}",
+                              lambda cid=cid, info=info, unit=unit: self._in_unit(
+                                  unit, True, generate_all_images, {cid: info}, day),
+                              deps=(f"story:{cid}",), pool="image")
+                try:
+                    graph.run()
+                finally:
+                    if prefetcher:
+                        prefetcher.close()
+                for cid, unit in units.items():
+                    if unit.pending:
+                        try:
+                            unit.commit()
+                        except Exception as e:
+                            log_and_print(f"❌ [{cid}] 暫存的寫入失敗：{e}\n", error_type="ERROR")
+            current["tasks"] = graph.as_dict()
+            current["phase"] = "finished"
+        except Exception as e:
+            current["phase"], current["error"] = "failed", str(e)
+            log_and_print(f"❌ {day.today} 排程執行失敗：{e}\n", error_type="ERROR")
+        finally:
+            self._graph = None
+            current["finished_at"] = datetime.now().isoformat()
+            self.status.update(state="idle", current=None, last_run=current)
+            metrics.write_run_summary("scheduler", day.today)
+            self._compact_error_log()
+        return current
+
+    @staticmethod
+    def _compact_error_log():
+        """前一天（日誌依本機日期分檔）已不會再有新紀錄：把分段合併回 {date}_error.json"""
+        date_str = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+        try:
+            merged = compact_error_log(date_str)
+            if merged:
+                log_and_print(f"🧩 {date_str} 錯誤日誌已合併：共 {merged} 筆\n", error_type="OK")
+        except Exception as e:
+            log_and_print(f"⚠️ {date_str} 錯誤日誌合併失敗：{e}\n", error_type="WARNING")
+
+    def next_run_time(self, now: datetime) -> datetime:
+        target = now.replace(hour=self.run_hour, minute=self.run_minute, second=0, microsecond=0)
+        return target if target > now else target + timedelta(days=1)
+
+    def run_forever(self):
+        tz = get_settings().tz
+        next_run = self.next_run_time(datetime.now(tz))
+        while not self._stop.is_set():
+            self.status["next_run"] = next_run.isoformat()
+            # 最多等 60 秒就重新檢查一次，主機睡眠或校時後也不會錯過
+            timeout = min(60.0, max(0.0, (next_run - datetime.now(tz)).total_seconds()))
+            triggered = self._trigger.wait(timeout)
+            if self._stop.is_set():
+                break
+            now = datetime.now(tz)
+            if triggered or now >= next_run:
+                self._trigger.clear()
+                self.run_day(DayContext.for_date(now))
+                next_run = self.next_run_time(datetime.now(tz))
+
+    def trigger(self):
+        self._trigger.set()
+
+    def stop(self):
+        self._stop.set()
+        self._trigger.set()
+        if self._server:
+            self._server.shutdown()
+
+    # === 狀態端點 ===
+    def snapshot(self) -> dict:
+        status = dict(self.status)
+        graph = self._graph
+        if status["current"] and graph:
+            status["current"] = {**status["current"], "tasks": graph.as_dict()}
+        status["metrics"] = metrics.snapshot()
+        status["llm_routes"] = get_router().snapshot()
+        return status
+
+    def serve_status(self, port: int = SCHEDULER_STATUS_PORT):
+        scheduler = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code: int, body: dict):
+                data = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/status":
+                    return self._reply(200, scheduler.snapshot())
+                if self.path == "/healthz":
+                    return self._reply(200, {"ok": True})
+                self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                if self.path == "/run":
+                    if scheduler.status["state"] == "running":
+                        return self._reply(409, {"error": "already running"})
+                    scheduler.trigger()
+                    return self._reply(202, {"triggered": True})
+                self._reply(404, {"error": "not found"})
+
+        # 只綁定本機，不對外開放
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="status", daemon=True).start()
+        log_and_print(f"📡 狀態端點：http://127.0.0.1:{port}/status\n", error_type="OK")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--once", action="store_true", help="立即執行一次後結束")
+    parser.add_argument("--date", help="搭配 --once 指定日期 YYYY-MM-DD（預設今天）")
+    parser.add_argument("--at", default=SCHEDULER_RUN_AT, help="每天執行時間（台北時間 HH:MM）")
+    parser.add_argument("--port", type=int, default=SCHEDULER_STATUS_PORT, help="狀態端點 port，0 表示不開")
+    args = parser.parse_args()
+
+    scheduler = Scheduler(args.at)
+    scheduler.warm_up()
+    if args.once:
+        day = DayContext.for_date(args.date) if args.date else DayContext.for_date(datetime.now(get_settings().tz))
+        result = scheduler.run_day(day)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: scheduler.stop())
+    if args.port:
+        scheduler.serve_status(args.port)
+    log_and_print(f"⏰ 排程啟動：每天 {args.at}（{get_settings().timezone}）執行\n", error_type="OK")
+    scheduler.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# serialization.py
+# 儲存物件的序列化格式（依物件類型決定）：
+#   json          緊湊 JSON（不縮排）
+#   msgpack       MessagePack（需要 msgpack 套件，沒有時退回 json）
+#   +gzip         再以 gzip 壓縮（內容小於 SERIALIZATION_GZIP_MIN 時不壓縮）
+# 讀取時依內容開頭自動判斷（gzip magic / msgpack 的 map、array 標記 / 其餘一律當 JSON），新舊格式可以混用；
+# 格式不寫進 Content-Encoding，避免 GCS 自動解壓（decompressive transcoding）影響條件讀取與快取。
+# 設定方式：SERIALIZATION_FORMATS="log=json+gzip,index=msgpack+gzip"（未列出的沿用預設）
+# 舊物件轉換：python serialization.py migrate [--prefix logs/ ...] [--dry-run]
+import os
+import sys
+import gzip
+import json
+import argparse
+from settings import load_env
+from storage_backend import get_storage, PreconditionError
+
+load_env()
+
+DEFAULT_FORMATS = {
+    "log": "json+gzip",         # logs/：每日 log.json、today_paths、錯誤日誌
+    "memory": "json+gzip",      # memory/：每日 / 週 / 月摘要與 view
+    "index": "msgpack+gzip",    # index/：BM25 故事索引（最大的物件）
+    "cache": "json+gzip",       # cache/：LLM 回應快取
+    "manifest": "json",         # 小型清單與進度紀錄，讀取頻繁，保留可直接閱讀的 JSON
+    "default": "json",
+}
+SERIALIZATION_GZIP_MIN = int(os.getenv("SERIALIZATION_GZIP_MIN", "512"))   # 小於此位元組數不壓縮
+MIGRATE_PREFIXES = ("logs/", "memory/", "index/", "cache/", "themes/index/")
+
+# 依路徑判斷物件類型，由上而下第一個符合的前綴為準
+_KIND_RULES = (
+    ("cache/completions/index.json", "manifest"),
+    ("cache/", "cache"),
+    ("themes/index/", "manifest"),
+    ("index/", "index"),
+    ("memory/", "memory"),
+    ("logs/today_paths/", "manifest"),
+    ("logs/", "log"),
+)
+_GZIP_MAGIC = b"\x1f\x8b"
+# msgpack 的 map / array 開頭位元組（fixmap、fixarray、16/32 位元版本）；JSON 的開頭不會是這些位元組
+_MSGPACK_CONTAINER = frozenset(range(0x80, 0xa0)) | {0xdc, 0xdd, 0xde, 0xdf}
+_CONTENT_TYPES = {"json": "application/json", "msgpack": "application/msgpack"}
+
+
+def _parse_formats(spec: str) -> dict:
+    formats = dict(DEFAULT_FORMATS)
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        kind, _, fmt = item.partition("=")
+        formats[kind.strip()] = fmt.strip()
+    return formats
+
+
+SERIALIZATION_FORMATS = _parse_formats(os.getenv("SERIALIZATION_FORMATS", ""))
+
+
+def _msgpack():
+    try:
+        import msgpack
+        return msgpack
+    except ImportError:
+        return None
+
+
+def object_kind(path: str) -> str:
+    path = str(path)
+    if path.endswith("_checkpoint.json"):
+        return "manifest"
+    for prefix, kind in _KIND_RULES:
+        if path.startswith(prefix):
+            return kind
+    return "default"
+
+
+# === 編碼 / 解碼 ===
+def encode(data, fmt: str = "json") -> tuple:
+    """依格式編碼，回傳 (bytes, content_type)"""
+    base, _, compression = fmt.partition("+")
+    msgpack = _msgpack() if base == "msgpack" else None
+    if msgpack:
+        body = msgpack.packb(data, use_bin_type=True)
+    else:
+        base = "json"   # 未安裝 msgpack 時退回 JSON，讀取端一樣能解
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if compression == "gzip" and len(body) >= SERIALIZATION_GZIP_MIN:
+        return gzip.compress(body, compresslevel=6, mtime=0), "application/gzip"
+    return body, _CONTENT_TYPES[base]
+def encode_for(path: str, data) -> tuple:
+    """依 path 的物件類型選擇格式編碼"""
+    kind = object_kind(path)
+    return encode(data, SERIALIZATION_FORMATS.get(kind, SERIALIZATION_FORMATS["default"]))
+def decode(raw: bytes):
+    """
+    自動判斷格式解碼：gzip → 再判斷內層；以 msgpack 的 map / array 標記開頭視為 msgpack，
+    其餘都當 JSON 解析（含 null、true、負數、BOM 等任何合法 JSON）。
+    """
+    if raw[:2] == _GZIP_MAGIC:
+        raw = gzip.decompress(raw)
+    if not raw or raw[0] not in _MSGPACK_CONTAINER:
+        return json.loads(raw.decode("utf-8-sig"))
+    msgpack = _msgpack()
+    if msgpack is None:
+        raise RuntimeError("物件為 msgpack 格式，但未安裝 msgpack 套件")
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+# === 讀寫捷徑 ===
+def write_object(path: str, data, if_generation_match: int = None) -> int:
+    body, content_type = encode_for(path, data)
+    return get_storage().write(path, body, content_type=content_type, if_generation_match=if_generation_match)
+def read_object(path: str, default=None, cached: bool = True):
+    """讀取並解碼；cached=False 時略過快取（讀取後要以 generation 條件寫回的情況）"""
+    store = get_storage()
+    obj = (store if cached else store.backend).read(path)
+    return decode(obj.data) if obj else default
+
+
+# === 舊物件轉換 ===
+def migrate(prefixes=MIGRATE_PREFIXES, dry_run: bool = False) -> dict:
+    """把既有的 .json 物件依目前的格式設定重新編碼，回傳轉換前後的位元組數"""
+    store = get_storage()
+    report = {"objects": 0, "converted": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+    for prefix in prefixes:
+        for path in store.list(prefix):
+            if not path.endswith(".json"):
+                continue
+            obj = store.backend.read(path)
+            if obj is None:
+                continue
+            report["objects"] += 1
+            try:
+                data = decode(obj.data)
+            except (ValueError, RuntimeError) as e:
+                print(f"⚠️ 無法解碼，略過：{path}（{e}）")
+                report["skipped"] += 1
+                continue
+            body, content_type = encode_for(path, data)
+            report["bytes_before"] += len(obj.data)
+            report["bytes_after"] += len(body)
+            if body == obj.data or dry_run:
+                continue
+            try:
+                store.write(path, body, content_type=content_type, if_generation_match=obj.generation)
+                report["converted"] += 1
+            except PreconditionError:
+                print(f"⚠️ 轉換期間被其他程序更新，略過：{path}")
+                report["skipped"] += 1
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+    cmd = sub.add_parser("migrate", help="依目前格式設定重新編碼既有物件")
+    cmd.add_argument("--prefix", action="append", help="只處理這些前綴（可重複），預設 logs/ memory/ index/ cache/")
+    cmd.add_argument("--dry-run", action="store_true", help="只計算大小，不寫回")
+    args = parser.parse_args()
+
+    report = migrate(tuple(args.prefix or MIGRATE_PREFIXES), args.dry_run)
+    before, after = report["bytes_before"], report["bytes_after"]
+    ratio = f"{after / before:.1%}" if before else "-"
+    print(f"✅ 物件 {report['objects']}，轉換 {report['converted']}，略過 {report['skipped']}；"
+          f"{before} → {after} bytes（{ratio}）" + ("（dry run）" if args.dry_run else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
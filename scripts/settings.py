@@ -0,0 +1,110 @@
+# settings.py
+# 延遲求值的設定：日期、bucket、憑證都在第一次使用時才計算，
+# import 任何模組都不會連線或需要 Firebase 憑證。
+#   get_settings().day.today      → "2025-06-23"
+#   DayContext.for_date("2025-06-23").week_num → "W26"
+import os
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime
+from functools import cached_property
+from zoneinfo import ZoneInfo
+
+TIMEZONE = "Asia/Taipei"
+
+_env_loaded = False
+
+def load_env():
+    """載入 .env（只讀本機檔案，重複呼叫不會重複載入）"""
+    global _env_loaded
+    if _env_loaded:
+        return
+    _env_loaded = True
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        return
+    load_dotenv()
+
+
+# === 單日日期資訊 ===
+@dataclass(frozen=True)
+class DayContext:
+    date: date
+
+    @classmethod
+    def for_date(cls, value) -> "DayContext":
+        """接受 date、datetime 或 "YYYY-MM-DD" 字串"""
+        if isinstance(value, datetime):
+            value = value.date()
+        elif isinstance(value, str):
+            value = date.fromisoformat(value)
+        return cls(value)
+
+    @property
+    def today(self) -> str:
+        return self.date.strftime("%Y-%m-%d")     # 格式為 2025-06-23
+    @property
+    def year(self) -> str:
+        return self.today[:4]                     # 格式為 "2025"
+    @property
+    def month(self) -> str:
+        return self.today[5:7]                    # 結果會是 "06"
+    @property
+    def year_month(self) -> str:
+        return self.today[:7]                     # 格式為 "2025-06"
+    @property
+    def start_ns(self) -> int:
+        """當天 00:00（台北時間）的 epoch 奈秒；補跑時當作週檔分段的排序鍵"""
+        return int(datetime(self.date.year, self.date.month, self.date.day,
+                            tzinfo=ZoneInfo(TIMEZONE)).timestamp()) * 10**9
+    @property
+    def week_only(self) -> str:
+        return self.date.strftime("%W")           # 只取週數（兩位數字），一週從週一開始
+    @property
+    def week_num(self) -> str:
+        return f"W{self.date.isocalendar()[1]}"   # ISO 週數，組成 "W26"
+
+
+# === 全域設定 ===
+class Settings:
+    timezone = TIMEZONE
+
+    def __init__(self):
+        load_env()
+
+    @cached_property
+    def tz(self) -> ZoneInfo:
+        return ZoneInfo(self.timezone)
+    @cached_property
+    def now(self) -> datetime:
+        return datetime.now(self.tz)
+    @cached_property
+    def day(self) -> DayContext:
+        return DayContext.for_date(self.now)
+    @cached_property
+    def today_str(self) -> str:
+        return self.now.strftime("%Y-%m-%d %H:%M")  # 加入時間
+    def refresh(self):
+        """清掉與時間有關的快取（常駐程序跨日後使用）"""
+        for name in ("now", "day", "today_str"):
+            self.__dict__.pop(name, None)
+
+    @cached_property
+    def bucket_name(self) -> str:
+        return os.getenv("BUCKET_NAME")
+    @cached_property
+    def firebase_credentials(self) -> str:
+        return os.getenv("Firebase_Admin_SDK")
+
+
+_settings = None
+_settings_lock = threading.Lock()
+
+def get_settings() -> Settings:
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = Settings()
+    return _settings
@@ -3,8 +3,12 @@
 # config.py需告知scripts/位置
 # theme 檔名稱 ex:W25_theme.json
 
-import os
-from config import TODAY, year, year_month, week_num
+from contextlib import nullcontext
+from metrics import span, write_run_summary
+from settings import DayContext, get_settings
+from checkpoint import Checkpoint
+from theme_index import load_day_themes
+from unit_of_work import UnitOfWork, unit_of_work
 from utils import (
     get_theme_path,
     load_theme_file,
@@ -14,44 +18,30 @@ from utils import (
     get_log_json_path,
     save_today_paths,
     log_and_print,
+    read_json_from_firebase,
     write_json_to_firebase,
-    write_txt_to_firebase,
+    create_txt_if_missing,
     get_story_txt_path,
 )
 
-# === 主題檔案路徑與載入 ===
-THEME_PATH = get_theme_path(year, week_num)
 
-weekly_theme = load_theme_file(THEME_PATH)
+def main():
+    day = get_settings().day
+    with span("stage.setup"):
+        setup_day(day)
+    write_run_summary("setup", day.today)
 
-# === 抓出今天的角色與主題 ===
-character_themes = get_today_characters(weekly_theme, TODAY)
 
-if not character_themes:
-    log_and_print(f"✅ 今天 {TODAY} 沒有要生成內容的角色，結束執行。\n", error_type="WARNING")
-    exit()
+def _setup_character(cid: str, TODAY: str, theme_slug: str, story_path: str, log_path: str):
+    checkpoint = Checkpoint(cid, TODAY, theme_slug)
+    if checkpoint.is_done("setup"):
+        return
 
-log_and_print(f"🧩 今天 {TODAY} 角色：{', '.join(character_themes.keys())}\n", error_type="OK")
+    # 初始化 story 檔（如果不存在；已存在則保留本週內容）
+    create_txt_if_missing(story_path, "# Weekly log file initialized\n")
 
-# === 初始化 today_paths 結構 ===
-today_paths = {}
-
-for cid, theme in character_themes.items():
-    theme_slug = slugify(theme.get("title", "unknown"))
-    story_path = get_story_txt_path(cid, year, week_num)
-    log_path = get_log_json_path(cid, TODAY, theme_slug)
-
-    today_paths[cid] = {
-        "theme": theme_slug,
-        "log": log_path,
-        "txt": story_path,
-    }
-
-    # 初始化 story 檔（如果不存在）
-    write_txt_to_firebase(story_path, "# Weekly log file initialized\n")
-
-    # 初始化 log.json
-    if not os.path.exists(log_path) or os.path.getsize(log_path) == 0:
+    # 初始化 log.json（雲端已有內容則保留）
+    if not read_json_from_firebase(log_path):
         log_data = {
             "date": TODAY,
             "character": cid,
@@ -63,7 +53,60 @@ for cid, theme in character_themes.items():
             "duration": 0.0
         }
         write_json_to_firebase(log_path, log_data)
+    checkpoint.mark_done("setup")
+
+
+def resolve_day_themes(day: DayContext) -> dict:
+    """今天的 {character_id: theme}：優先讀主題索引（每天一個小檔），尚未編譯時退回週主題檔"""
+    character_themes = load_day_themes(day.today)
+    if character_themes is None:
+        weekly_theme = load_theme_file(get_theme_path(day.year, day.week_num, day.month))
+        character_themes = get_today_characters(weekly_theme, day.today)
+    return character_themes
+
+
+def setup_day(day: DayContext, character_themes: dict = None, units: dict = None) -> dict:
+    """
+    建立某一天的 story 檔、log.json 與 today_paths，回傳 today_paths。
+    character_themes 可由呼叫端預先解析（補跑多天時），未指定時由 resolve_day_themes 取得。
+    units：{character_id: UnitOfWork}，提供時各角色的寫入暫存在其中，由呼叫端 commit。
+    """
+    TODAY, year, year_month, week_num = day.today, day.year, day.year_month, day.week_num
+
+    # === 抓出今天的角色與主題 ===
+    if character_themes is None:
+        character_themes = resolve_day_themes(day)
+
+    if not character_themes:
+        log_and_print(f"✅ 今天 {TODAY} 沒有要生成內容的角色，結束執行。\n", error_type="WARNING")
+        return {}
+
+    log_and_print(f"🧩 今天 {TODAY} 角色：{', '.join(character_themes.keys())}\n", error_type="OK")
+
+    # === 初始化 today_paths 結構 ===
+    today_paths = {}
+
+    for cid, theme in character_themes.items():
+        theme_slug = slugify(theme.get("title", "unknown"))
+        story_path = get_story_txt_path(cid, year, week_num)
+        log_path = get_log_json_path(cid, TODAY, theme_slug)
+
+        today_paths[cid] = {
+            "theme": theme_slug,
+            "log": log_path,
+            "txt": story_path,
+        }
+
+        # 每位角色的建立動作在同一個 unit of work 中完成；呼叫端有提供 units 時延到呼叫端 commit
+        unit = units.setdefault(cid, UnitOfWork()) if units is not None else None
+        with (unit.bind() if unit else nullcontext()), unit_of_work():
+            _setup_character(cid, TODAY, theme_slug, story_path, log_path)
+
+    # === 儲存 today_paths 為 JSON ===
+    today_paths_path = save_today_paths(today_paths, year_month, TODAY)
+    log_and_print(f"✅ 已儲存 today_paths 至：{today_paths_path}\n", error_type="OK")
+    return today_paths
+
 
-# === 儲存 today_paths 為 JSON ===
-today_paths_path = save_today_paths(today_paths, year_month, TODAY)
-log_and_print(f"✅ 已儲存 today_paths 至：{today_paths_path}\n", error_type="OK")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,497 @@
+# storage_backend.py
+# 統一的雲端儲存介面：
+#   - FirebaseBackend：Firebase Storage（GCS）
+#   - LocalBackend：本機資料夾，可離線執行整條流程與做效能測試
+#   - CachedStorage：包在任一 backend 前面的兩層讀取快取
+#       1. 行程內 LRU（同一次執行重複讀取不走網路）
+#       2. 磁碟快取，以「backend（bucket / 本機資料夾）+ 路徑 + 物件 generation」為 key（跨三個階段腳本共用），
+#          超過 STORAGE_CACHE_MAX_AGE 沒有確認過的項目會清掉，總大小超過 STORAGE_CACHE_MAX_BYTES 時從最舊的開始清
+#     兩層都只在上次確認後 STORAGE_CACHE_TTL 秒內直接使用；過期後以 if_generation_not_match
+#     條件讀取重新確認（沒變就不傳內容），其他行程的更新最晚在 TTL 後看到。
+#     讀取後要以 generation 條件寫回的物件應略過快取（serialization.read_object(cached=False)）。
+#     只寫不讀的物件（週檔附加分段、執行日誌分段）不進快取。
+# 所有讀寫工具（read_json_from_firebase 等）都經由 get_storage() 取得同一個實例。
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from settings import load_env
+from metrics import incr
+
+load_env()
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只用行程內的鎖
+    fcntl = None
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firebase")          # firebase / local
+LOCAL_STORAGE_ROOT = os.getenv("LOCAL_STORAGE_ROOT", "local_bucket")
+STORAGE_CACHE_DIR = os.getenv("STORAGE_CACHE_DIR", str(Path.home() / ".cache" / "ai_animal_story"))
+STORAGE_LRU_SIZE = int(os.getenv("STORAGE_LRU_SIZE", "256"))
+STORAGE_CACHE_TTL = float(os.getenv("STORAGE_CACHE_TTL", "5"))      # 快取（LRU 與磁碟）免重新確認的秒數
+STORAGE_CACHE_MAX_BYTES = int(os.getenv("STORAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))  # 磁碟快取上限
+STORAGE_CACHE_MAX_AGE = float(os.getenv("STORAGE_CACHE_MAX_AGE", str(7 * 86400)))   # 磁碟快取項目保留秒數
+# 只寫不讀的物件：週檔附加分段（{path}.parts/）與執行日誌（logs/errors/）
+STORAGE_CACHE_SKIP = (".parts/", "logs/errors/")
+
+
+class PreconditionError(Exception):
+    """寫入時 if_generation_match 不成立（物件已存在或已被他人更新）"""
+
+
+@dataclass
+class StoredObject:
+    data: bytes
+    generation: int
+    content_type: str = ""
+
+    def text(self) -> str:
+        return self.data.decode("utf-8")
+
+
+# === 介面 ===
+class StorageBackend:
+    @property
+    def cache_namespace(self) -> str:
+        """磁碟快取的 key 前綴，不同 bucket／資料夾的同名物件不會互相覆蓋"""
+        return type(self).__name__
+    def read(self, path: str, if_generation_not_match: int = None):
+        """回傳 StoredObject；物件不存在回傳 None；generation 與參數相同時回傳 NOT_MODIFIED"""
+        raise NotImplementedError
+    def stat(self, path: str):
+        """回傳物件目前的 generation，不存在回傳 None"""
+        raise NotImplementedError
+    def write(self, path: str, data: bytes, content_type: str = "application/octet-stream",
+              if_generation_match: int = None) -> int:
+        """寫入並回傳新的 generation；if_generation_match=0 代表只在不存在時建立"""
+        raise NotImplementedError
+    def list(self, prefix: str) -> list:
+        """回傳 prefix 底下所有物件路徑（依名稱排序）"""
+        raise NotImplementedError
+    def list_updated(self, prefix: str) -> dict:
+        """回傳 {路徑: 最後寫入時間（epoch 秒）}，只靠列表結果，不下載內容"""
+        raise NotImplementedError
+    def delete(self, path: str):
+        raise NotImplementedError
+    def compose(self, path: str, sources: list, content_type: str = "text/plain",
+                if_generation_match: int = None) -> int:
+        """把 sources 依序串接寫到 path（sources 可包含 path 本身）"""
+        raise NotImplementedError
+
+
+NOT_MODIFIED = object()
+
+
+# === Firebase Storage ===
+class FirebaseBackend(StorageBackend):
+    def __init__(self):
+        self._bucket = None
+        self._init_lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        # 第一次真正需要時才初始化 Firebase（多執行緒同時呼叫時只初始化一次）
+        if self._bucket is None:
+            with self._init_lock:
+                if self._bucket is None:
+                    from firebase_config import get_bucket
+                    self._bucket = get_bucket()
+        return self._bucket
+
+    @property
+    def cache_namespace(self):
+        from settings import get_settings
+        return f"gs://{get_settings().bucket_name}"
+
+    def read(self, path, if_generation_not_match=None):
+        from google.api_core.exceptions import NotFound, NotModified
+        blob = self.bucket.blob(str(path))
+        try:
+            data = blob.download_as_bytes(if_generation_not_match=if_generation_not_match)
+        except NotFound:
+            incr("storage.read", missing=1)
+            return None
+        except NotModified:
+            incr("storage.read", not_modified=1)
+            return NOT_MODIFIED
+        incr("storage.read", bytes=len(data))
+        return StoredObject(data, blob.generation or 0, blob.content_type or "")
+
+    def stat(self, path):
+        incr("storage.stat")
+        blob = self.bucket.get_blob(str(path))
+        return blob.generation if blob else None
+
+    def write(self, path, data, content_type="application/octet-stream", if_generation_match=None):
+        from google.api_core.exceptions import PreconditionFailed
+        incr("storage.write", bytes=len(data))
+        blob = self.bucket.blob(str(path))
+        try:
+            blob.upload_from_string(data, content_type=content_type, if_generation_match=if_generation_match)
+        except PreconditionFailed as e:
+            raise PreconditionError(str(e)) from e
+        return blob.generation
+
+    def list(self, prefix):
+        incr("storage.list")
+        return sorted(b.name for b in self.bucket.list_blobs(prefix=prefix))
+
+    def list_updated(self, prefix):
+        incr("storage.list")
+        return {b.name: b.updated.timestamp() if b.updated else 0 for b in self.bucket.list_blobs(prefix=prefix)}
+
+    def delete(self, path):
+        from google.api_core.exceptions import NotFound
+        incr("storage.delete")
+        try:
+            self.bucket.blob(str(path)).delete()
+        except NotFound:
+            pass
+
+    def compose(self, path, sources, content_type="text/plain", if_generation_match=None):
+        from google.api_core.exceptions import PreconditionFailed
+        incr("storage.compose")
+        target = self.bucket.blob(str(path))
+        target.content_type = content_type
+        try:
+            target.compose([self.bucket.blob(s) for s in sources], if_generation_match=if_generation_match)
+        except PreconditionFailed as e:
+            raise PreconditionError(str(e)) from e
+        return target.generation
+
+
+# === 本機資料夾 ===
+class LocalBackend(StorageBackend):
+    """
+    以本機資料夾模擬 bucket。generation 使用檔案的 st_mtime_ns，
+    條件寫入以檔案鎖保護，多個行程同時寫入時行為與 GCS 前置條件一致。
+    """
+    def __init__(self, root: str = LOCAL_STORAGE_ROOT):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    @property
+    def cache_namespace(self):
+        return self.root.as_uri()
+
+    def _full(self, path) -> Path:
+        return self.root / str(path)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if not fcntl:
+                yield
+                return
+            with open(self.root / ".lock", "a") as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def read(self, path, if_generation_not_match=None):
+        full = self._full(path)
+        try:
+            generation = full.stat().st_mtime_ns
+            if if_generation_not_match is not None and generation == if_generation_not_match:
+                incr("storage.read", not_modified=1)
+                return NOT_MODIFIED
+            data = full.read_bytes()
+        except FileNotFoundError:
+            incr("storage.read", missing=1)
+            return None
+        incr("storage.read", bytes=len(data))
+        return StoredObject(data, generation)
+
+    def stat(self, path):
+        incr("storage.stat")
+        try:
+            return self._full(path).stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def write(self, path, data, content_type="application/octet-stream", if_generation_match=None):
+        incr("storage.write", bytes=len(data))
+        full = self._full(path)
+        full.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=full.parent, prefix=".tmp_")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            with self._locked():
+                previous = self.stat(path)
+                if if_generation_match is not None and previous != (if_generation_match or None):
+                    raise PreconditionError(f"generation 不符：{path}")
+                os.replace(tmp, full)
+                # 確保 generation 一定遞增（檔案系統時間解析度不足時手動往後推）
+                generation = full.stat().st_mtime_ns
+                if previous is not None and generation <= previous:
+                    generation = previous + 1
+                    os.utime(full, ns=(generation, generation))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return generation
+
+    def list(self, prefix):
+        return sorted(self.list_updated(prefix))
+
+    def list_updated(self, prefix):
+        incr("storage.list")
+        prefix = str(prefix)
+        base = self._full(prefix if prefix.endswith("/") else os.path.dirname(prefix))
+        if not base.is_dir():
+            return {}
+        found = {}
+        for p in base.rglob("*"):
+            if p.is_file() and not p.name.startswith("."):
+                name = p.relative_to(self.root).as_posix()
+                if name.startswith(prefix):
+                    found[name] = p.stat().st_mtime
+        return found
+
+    def delete(self, path):
+        incr("storage.delete")
+        try:
+            self._full(path).unlink()
+        except FileNotFoundError:
+            pass
+
+    def compose(self, path, sources, content_type="text/plain", if_generation_match=None):
+        incr("storage.compose")
+        data = b"".join(self._full(s).read_bytes() for s in sources)
+        return self.write(path, data, content_type, if_generation_match=if_generation_match)
+
+
+# === 兩層讀取快取 ===
+class CachedStorage(StorageBackend):
+    def __init__(self, backend: StorageBackend, lru_size: int = STORAGE_LRU_SIZE,
+                 cache_dir: str = STORAGE_CACHE_DIR, ttl: float = STORAGE_CACHE_TTL,
+                 max_bytes: int = STORAGE_CACHE_MAX_BYTES, max_age: float = STORAGE_CACHE_MAX_AGE):
+        self.backend = backend
+        self.lru_size = lru_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._lru = OrderedDict()   # path -> (StoredObject, 上次向 backend 確認的時間)
+        self._lock = threading.Lock()
+        self._written = 0           # 上次清理後寫入磁碟快取的位元組數
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self.prune_disk()
+
+    @staticmethod
+    def cacheable(path: str) -> bool:
+        return not any(part in path for part in STORAGE_CACHE_SKIP)
+
+    # --- LRU ---
+    def _lru_get(self, path):
+        """回傳 (StoredObject, checked_at)；沒有時回傳 (None, 0)"""
+        with self._lock:
+            entry = self._lru.get(path)
+            if entry is None:
+                return None, 0
+            self._lru.move_to_end(path)
+            return entry
+    def _lru_put(self, path, obj, checked_at: float):
+        with self._lock:
+            self._lru[path] = (obj, checked_at)
+            self._lru.move_to_end(path)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+    def _lru_drop(self, path):
+        with self._lock:
+            self._lru.pop(path, None)
+
+    # --- 磁碟快取：{key}.meta 記錄最新 generation 與確認時間，{key}_{generation} 存內容 ---
+    def _disk_key(self, path):
+        return hashlib.sha1(f"{self.backend.cache_namespace}\0{path}".encode("utf-8")).hexdigest()
+    def _disk_get(self, path):
+        """回傳 (StoredObject, checked_at)；沒有時回傳 (None, 0)"""
+        if not self.cache_dir:
+            return None, 0
+        key = self._disk_key(path)
+        try:
+            meta = json.loads((self.cache_dir / f"{key}.meta").read_text())
+            data = (self.cache_dir / f"{key}_{meta['generation']}").read_bytes()
+        except (FileNotFoundError, ValueError, KeyError):
+            return None, 0
+        return StoredObject(data, meta["generation"], meta.get("content_type", "")), meta.get("cached_at", 0)
+    def _disk_put(self, path, obj):
+        if not self.cache_dir:
+            return
+        key = self._disk_key(path)
+        current = self.cache_dir / f"{key}_{obj.generation}"
+        try:
+            for old in self.cache_dir.glob(f"{key}_*"):
+                if old != current:
+                    old.unlink()
+            if not current.exists():   # 重新確認且沒變時只更新 meta 的時間
+                current.write_bytes(obj.data)
+                self._written += len(obj.data)
+            meta = {"path": str(path), "generation": obj.generation,
+                    "content_type": obj.content_type, "cached_at": time.time()}
+            (self.cache_dir / f"{key}.meta").write_text(json.dumps(meta))
+        except OSError as e:
+            print(f"⚠️ 磁碟快取寫入失敗：{e}")
+        # 每寫入上限的 1/10 才掃一次資料夾，平常寫入不必列目錄
+        if self._written > self.max_bytes // 10:
+            self.prune_disk()
+    def _disk_drop(self, path):
+        if not self.cache_dir:
+            return
+        key = self._disk_key(path)
+        for p in self.cache_dir.glob(f"{key}*"):
+            p.unlink(missing_ok=True)
+
+    def prune_disk(self) -> int:
+        """
+        清理磁碟快取：刪掉超過 max_age 沒有確認過的項目（以 .meta 的修改時間為準），
+        總大小仍超過 max_bytes 時從最久沒確認的開始刪。回傳刪掉的項目數。
+        """
+        self._written = 0
+        if not self.cache_dir:
+            return 0
+        entries = {}   # key -> [最後確認時間, 大小, 檔案們]
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for f in it:
+                    try:
+                        st = f.stat()
+                    except FileNotFoundError:
+                        continue
+                    key = f.name.split(".", 1)[0].split("_", 1)[0]
+                    entry = entries.setdefault(key, [0, 0, []])
+                    if f.name.endswith(".meta"):
+                        entry[0] = st.st_mtime
+                    entry[1] += st.st_size
+                    entry[2].append(f.path)
+        except OSError:
+            return 0
+        # 沒有 meta 的殘留檔（寫到一半中斷）checked_at 為 0，會最先清掉
+        now, removed = time.time(), 0
+        total = sum(size for _, size, _ in entries.values())
+        for checked_at, size, files in sorted(entries.values(), key=lambda e: e[0]):
+            if now - checked_at <= self.max_age and total <= self.max_bytes:
+                break
+            for name in files:
+                try:
+                    os.unlink(name)
+                except OSError:
+                    pass
+            total -= size
+            removed += 1
+        if removed:
+            incr("cache.storage.evict", removed)
+        return removed
+
+    # --- StorageBackend ---
+    def read(self, path, if_generation_not_match=None):
+        path = str(path)
+        if not self.cacheable(path):
+            return self.backend.read(path, if_generation_not_match=if_generation_not_match)
+        obj, checked_at = self._lru_get(path)
+        if obj is not None and time.time() - checked_at < self.ttl:
+            incr("cache.storage.lru_hit")
+        else:
+            if obj is None:
+                obj, checked_at = self._disk_get(path)
+            if obj is not None and time.time() - checked_at < self.ttl:
+                incr("cache.storage.disk_hit")
+                self._lru_put(path, obj, checked_at)
+            else:
+                # 有快取但已過 TTL：條件讀取，內容沒變就不會重新傳輸
+                incr("cache.storage.revalidate" if obj is not None else "cache.storage.miss")
+                result = self.backend.read(path, if_generation_not_match=obj.generation if obj is not None else None)
+                if result is None:
+                    self.invalidate(path)
+                    return None
+                if result is not NOT_MODIFIED:
+                    obj = result
+                self._disk_put(path, obj)
+                self._lru_put(path, obj, time.time())
+        if if_generation_not_match is not None and obj.generation == if_generation_not_match:
+            return NOT_MODIFIED
+        return obj
+
+    def stat(self, path):
+        obj, checked_at = self._lru_get(str(path))
+        if obj is not None and time.time() - checked_at < self.ttl:
+            return obj.generation
+        return self.backend.stat(path)
+
+    def write(self, path, data, content_type="application/octet-stream", if_generation_match=None):
+        path = str(path)
+        try:
+            generation = self.backend.write(path, data, content_type, if_generation_match=if_generation_match)
+        except PreconditionError:
+            self.invalidate(path)
+            raise
+        if not self.cacheable(path):
+            return generation
+        obj = StoredObject(data, generation, content_type)
+        self._lru_put(path, obj, time.time())
+        self._disk_put(path, obj)
+        return generation
+
+    def list(self, prefix):
+        return self.backend.list(prefix)
+
+    def list_updated(self, prefix):
+        return self.backend.list_updated(prefix)
+
+    def delete(self, path):
+        self.invalidate(path)
+        self.backend.delete(path)
+
+    def compose(self, path, sources, content_type="text/plain", if_generation_match=None):
+        self.invalidate(path)
+        return self.backend.compose(path, sources, content_type, if_generation_match=if_generation_match)
+
+    def invalidate(self, path):
+        if not self.cacheable(str(path)):
+            return
+        self._lru_drop(str(path))
+        self._disk_drop(str(path))
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+        if self.cache_dir and self.cache_dir.exists():
+            shutil.rmtree(self.cache_dir)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+
+# === 取得共用實例 ===
+_storage = None
+_storage_lock = threading.Lock()
+
+def create_backend(kind: str = None) -> StorageBackend:
+    kind = (kind or STORAGE_BACKEND).lower()
+    if kind == "local":
+        return LocalBackend(LOCAL_STORAGE_ROOT)
+    if kind == "firebase":
+        return FirebaseBackend()
+    raise ValueError(f"未知的 STORAGE_BACKEND：{kind}")
+def get_storage() -> CachedStorage:
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = CachedStorage(create_backend())
+    return _storage
+def set_storage(storage) -> None:
+    """替換共用實例（本機測試、效能測試用）"""
+    global _storage
+    _storage = storage
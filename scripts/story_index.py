@@ -0,0 +1,213 @@
+# story_index.py
+# 每位角色過往故事的 BM25 檢索索引（純 Python，不需要外部向量服務），依月份分片：
+#   index/{cid}/stories/{year_month}.json   {"docs", "df", "total_len"}，只含該月的故事
+# generate_story.py 每寫完一篇 log 就加入一筆（只讀寫當月的分片，大小不隨歷史增加）；
+# 建立 prompt 時依今天的 theme_slug 取出最相關的幾篇摘要，總長度受 token 預算限制。
+#   index/{cid}/stories_stats.json         {"months": {year_month: {"n", "total_len", "df", "generation"}}}
+#     各月分片的統計（不含文件內容），每次更新分片後一起更新
+# 查詢時只讀最近 RETRIEVAL_MONTHS 個月的分片找候選文件，更早的月份只從統計檔取 df 與長度，
+# 讀取量不隨歷史增加；過去月份的分片幾乎不再改變，由 storage 快取提供。
+# 舊版的單一 index/{cid}/stories.json 不再讀取，執行 python story_index.py <cid> 重建。
+import os
+import re
+import sys
+import math
+from settings import load_env
+from storage_backend import get_storage, PreconditionError
+from serialization import decode, read_object, write_object
+from tokens import count_tokens, truncate_to_tokens
+from firebase_config import get_story_index_path, get_story_index_prefix, get_story_index_stats_path
+
+load_env()
+
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "400"))
+RETRIEVAL_SNIPPET_TOKENS = int(os.getenv("RETRIEVAL_SNIPPET_TOKENS", "120"))
+RETRIEVAL_MONTHS = int(os.getenv("RETRIEVAL_MONTHS", "6"))   # 讀取分片找候選文件的月數
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_STOPWORDS = {
+    "a", "an", "and", "the", "of", "to", "in", "on", "at", "for", "with", "is", "was", "were",
+    "it", "its", "his", "her", "their", "they", "he", "she", "as", "by", "from", "that", "this",
+    "be", "are", "but", "or", "into", "up", "out", "so", "all", "had", "has", "have",
+}
+
+
+def tokenize(text: str) -> list:
+    """小寫、以非英數字切詞（theme slug 的底線也會切開），去掉常見虛詞"""
+    return [w for w in re.findall(r"[a-z0-9]+", (text or "").lower()) if w not in _STOPWORDS]
+
+
+def _empty_index() -> dict:
+    return {"docs": {}, "df": {}, "total_len": 0}
+
+
+def _read_shard(cid: str, year_month: str):
+    obj = get_storage().backend.read(get_story_index_path(cid, year_month))
+    return (decode(obj.data), obj.generation) if obj else (_empty_index(), 0)
+
+
+def _shard_months(cid: str) -> list:
+    prefix = get_story_index_prefix(cid)
+    return [p[len(prefix):-len(".json")] for p in get_storage().list(prefix) if p.endswith(".json")]
+
+
+def _shard_stats(index: dict, generation: int) -> dict:
+    return {"n": len(index["docs"]), "total_len": index["total_len"], "df": index["df"], "generation": generation}
+
+
+def _update_stats(cid: str, year_month: str, index: dict, generation: int, max_attempts: int = 5):
+    """
+    以剛寫入的分片更新統計檔；分片的 generation 比統計檔記錄的舊時不覆蓋（同月份同時更新時）。
+    統計檔還不存在時（舊版建立的索引）先從現有的各月分片補齊一次。
+    """
+    path = get_story_index_stats_path(cid)
+    for _ in range(max_attempts):
+        obj = get_storage().backend.read(path)
+        if obj:
+            stats, stats_generation = decode(obj.data), obj.generation
+        else:
+            stats, stats_generation = {"months": {m: _shard_stats(*_read_shard(cid, m))
+                                                  for m in _shard_months(cid) if m != year_month}}, 0
+        if stats["months"].get(year_month, {}).get("generation", 0) > generation:
+            return
+        stats["months"][year_month] = _shard_stats(index, generation)
+        try:
+            write_object(path, stats, if_generation_match=stats_generation)
+            return
+        except PreconditionError:
+            continue
+    raise RuntimeError(f"故事索引統計更新失敗（多次衝突）：{cid}")
+
+
+# === 建立索引 ===
+def _remove_doc(index: dict, doc_id: str):
+    old = index["docs"].pop(doc_id, None)
+    if not old:
+        return
+    index["total_len"] -= old["len"]
+    for term in old["tf"]:
+        index["df"][term] -= 1
+        if index["df"][term] <= 0:
+            del index["df"][term]
+def _add_doc(index: dict, doc_id: str, date: str, theme: str, summary: str, story: str):
+    _remove_doc(index, doc_id)   # 同一篇重跑時覆蓋
+    terms = tokenize(f"{theme} {summary} {story}")
+    tf = {}
+    for t in terms:
+        tf[t] = tf.get(t, 0) + 1
+    snippet = summary.strip() or truncate_to_tokens(story.strip(), RETRIEVAL_SNIPPET_TOKENS, keep="head")
+    index["docs"][doc_id] = {"date": date, "theme": theme, "snippet": snippet, "tf": tf, "len": len(terms)}
+    index["total_len"] += len(terms)
+    for t in tf:
+        index["df"][t] = index["df"].get(t, 0) + 1
+def add_story(cid: str, date: str, theme: str, summary: str, story: str, max_attempts: int = 5):
+    """把一篇故事加入當月的索引分片（以 generation 前置條件更新，衝突時重讀重試）"""
+    doc_id = f"{date}_{theme}"
+    year_month = date[:7]
+    for _ in range(max_attempts):
+        index, generation = _read_shard(cid, year_month)
+        _add_doc(index, doc_id, date, theme, summary, story)
+        try:
+            generation = write_object(get_story_index_path(cid, year_month), index, if_generation_match=generation)
+        except PreconditionError:
+            continue
+        _update_stats(cid, year_month, index, generation)
+        return
+    raise RuntimeError(f"故事索引更新失敗（多次衝突）：{cid}")
+def rebuild_index(cid: str) -> int:
+    """從 logs/characters/{cid}/ 的所有 log.json 重新建立各月分片與統計檔（刪除已沒有故事的分片），回傳收錄篇數"""
+    store = get_storage()
+    shards = {}
+    for path in store.list(f"logs/characters/{cid}/"):
+        if not path.endswith("_log.json"):
+            continue
+        obj = store.read(path)
+        log = decode(obj.data) if obj else {}
+        if log.get("story"):
+            date = log.get("date", "")
+            _add_doc(shards.setdefault(date[:7], _empty_index()), f"{date}_{log.get('theme', '')}", date,
+                     log.get("theme", ""), log.get("summary", ""), log["story"])
+    for year_month in _shard_months(cid):
+        if year_month not in shards:
+            store.delete(get_story_index_path(cid, year_month))
+    stats = {"months": {}}
+    for year_month, index in shards.items():
+        generation = write_object(get_story_index_path(cid, year_month), index)
+        stats["months"][year_month] = _shard_stats(index, generation)
+    write_object(get_story_index_stats_path(cid), stats)
+    return sum(len(index["docs"]) for index in shards.values())
+
+
+# === 查詢 ===
+def search(cid: str, query: str, k: int = RETRIEVAL_TOP_K, before: str = None) -> list:
+    """
+    回傳 [(score, doc), ...]，依 BM25 分數由高到低。
+    before：只檢索這天之前的故事（補跑舊日期時不會看到之後的故事，文件數與 df 也只算這些）；
+    晚於 before 的月份分片不會讀取。
+    只從最近 RETRIEVAL_MONTHS 個月的分片取候選文件；更早的月份只以統計檔計入文件數、長度與 df。
+    """
+    stats = (read_object(get_story_index_stats_path(cid)) or {}).get("months", {})
+    months = sorted(m for m in (stats or _shard_months(cid)) if not before or m <= before[:7])
+    cut = max(0, len(months) - max(1, RETRIEVAL_MONTHS))
+    shards = [read_object(get_story_index_path(cid, m)) for m in months[cut:]]
+    shards = [index for index in shards if index and index["docs"]]
+    query_terms = set(tokenize(query))
+    docs, total_len, df, n_older = [], 0, {}, 0
+    for m in months[:cut]:
+        if m not in stats:   # 還沒有統計檔（舊版索引）：只用最近的分片
+            continue
+        # 較舊的月份都在 before 之前，整個月份的統計都算進去
+        n_older += stats[m]["n"]
+        total_len += stats[m]["total_len"]
+        for term in query_terms:
+            df[term] = df.get(term, 0) + stats[m]["df"].get(term, 0)
+    for index in shards:
+        if before and any(doc["date"] >= before for doc in index["docs"].values()):
+            # 跨過 before 的分片（當月）：只算之前的文件
+            kept = [doc for doc in index["docs"].values() if doc["date"] < before]
+            shard_df = {t: sum(1 for doc in kept if t in doc["tf"]) for t in query_terms}
+            shard_len = sum(doc["len"] for doc in kept)
+        else:
+            kept, shard_df, shard_len = list(index["docs"].values()), index["df"], index["total_len"]
+        docs.extend(kept)
+        total_len += shard_len
+        for term in query_terms:
+            df[term] = df.get(term, 0) + shard_df.get(term, 0)
+    if not docs:
+        return []
+
+    n = len(docs) + n_older
+    avg_len = total_len / n or 1
+    scored = []
+    for doc in docs:
+        score = 0.0
+        for term in query_terms:
+            f = doc["tf"].get(term)
+            if not f:
+                continue
+            idf = math.log(1 + (n - df.get(term, 0) + 0.5) / (df.get(term, 0) + 0.5))
+            score += idf * f * (BM25_K1 + 1) / (f + BM25_K1 * (1 - BM25_B + BM25_B * doc["len"] / avg_len))
+        if score > 0:
+            scored.append((score, doc))
+    scored.sort(key=lambda x: (-x[0], x[1]["date"]))
+    return scored[:k]
+def related_memory(cid: str, theme_slug: str, budget: int = RETRIEVAL_TOKEN_BUDGET,
+                   k: int = RETRIEVAL_TOP_K, before: str = None) -> str:
+    """取出與主題最相關的過往故事摘要，總長度不超過 budget 個 token"""
+    blocks, used = [], 0
+    for _, doc in search(cid, theme_slug, k=k, before=before):
+        block = f"=== Related {doc['date']}: {doc['theme']} ===\n{doc['snippet']}"
+        cost = count_tokens(block)
+        if used + cost > budget:
+            break
+        blocks.append(block)
+        used += cost
+    return "\n\n".join(blocks)
+
+
+if __name__ == "__main__":
+    # 用法：python story_index.py <character_id> [...]，重建指定角色的索引
+    for character_id in sys.argv[1:]:
+        print(f"✅ {character_id}：已收錄 {rebuild_index(character_id)} 篇故事")
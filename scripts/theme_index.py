@@ -0,0 +1,178 @@
+# theme_index.py
+# 主題索引：把 themes/ 底下所有週主題檔（以及可選的本機年度主題檔）事先編譯成「每天一個小檔」：
+#   themes/index/{year}/{date}.json      {"date": ..., "characters": {cid: theme, ...}}
+#   themes/index/{year}/manifest.json    各日期內容的雜湊、來源檔 generation、缺少的日期
+# 每天只需讀一個小檔（經過 CachedStorage，本機有快取），不必依週數猜主題檔路徑，
+# 月份與週數交界也不會查不到。編譯時就檢查日期是否完整，而不是等到執行當天才發現。
+# 索引不會自動跟著主題檔更新：修改、新增或刪除主題檔後要重新編譯（來源已不包含的日期會被刪除）；
+# --check 比對 manifest 記錄的來源 generation 與目前的主題檔，不一致時回傳 1（可放在每日排程前）。
+#   python theme_index.py [--year 2025] [--start 2025-06-01 --end 2025-06-30] [--local themes/2025_themes.json]
+#   python theme_index.py --check [--year 2025]
+import sys
+import json
+import hashlib
+import argparse
+from datetime import date, timedelta
+from pathlib import Path
+from settings import get_settings
+from storage_backend import get_storage
+from serialization import decode, read_object, write_object
+from firebase_config import get_theme_index_path, get_theme_index_manifest_path
+
+THEME_SOURCE_PREFIX = "themes/"
+THEME_INDEX_PREFIX = "themes/index/"
+
+
+# === 讀取 ===
+def load_day_themes(date_str: str):
+    """回傳 {character_id: theme}；該日期尚未編譯進索引時回傳 None（呼叫端可退回週主題檔）"""
+    entry = read_object(get_theme_index_path(date_str))
+    if entry is None:
+        return None
+    return entry.get("characters", {})
+
+
+# === 編譯 ===
+def _entries_from_source(data: dict, source: str, index: dict, problems: list):
+    """把 {date: [{"character_id": ..., "theme": {...}}, ...]} 併入 index[date][cid]"""
+    for date_str, items in data.items():
+        try:
+            date.fromisoformat(date_str)
+        except (TypeError, ValueError):
+            problems.append(f"{source}: 無效的日期 {date_str!r}")
+            continue
+        day = index.setdefault(date_str, {})
+        for item in items or []:
+            cid = item.get("character_id")
+            theme = item.get("theme") or {}
+            if not cid or not theme.get("title"):
+                problems.append(f"{source}: {date_str} 缺少 character_id 或 theme.title：{item}")
+                continue
+            if cid in day and day[cid] != theme:
+                problems.append(f"{source}: {date_str} 的 {cid} 與其他主題檔內容不一致，以後讀到的為準")
+            day[cid] = theme
+
+
+def _source_paths(store) -> list:
+    return [p for p in store.list(THEME_SOURCE_PREFIX) if not p.startswith(THEME_INDEX_PREFIX) and p.endswith(".json")]
+
+
+def collect_sources(local_files: list = ()) -> tuple:
+    """讀取 bucket 中所有主題檔與本機檔，回傳 (index, sources, problems)"""
+    store = get_storage()
+    index, sources, problems = {}, {}, []
+    for path in _source_paths(store):
+        obj = store.backend.read(path)
+        if obj is None:
+            continue
+        sources[path] = obj.generation
+        try:
+            _entries_from_source(decode(obj.data), path, index, problems)
+        except (ValueError, AttributeError) as e:
+            problems.append(f"{path}: 無法解析：{e}")
+    for local in local_files:
+        data = json.loads(Path(local).read_text(encoding="utf-8"))
+        sources[str(local)] = 0
+        _entries_from_source(data, str(local), index, problems)
+    return index, sources, problems
+
+
+def missing_dates(index: dict, start: date, end: date) -> list:
+    days = ((start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1))
+    return [d for d in days if d not in index]
+
+
+def _digest(entry: dict) -> str:
+    return hashlib.sha1(json.dumps(entry, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+def compile_index(start: date, end: date, local_files: list = ()) -> dict:
+    """
+    編譯 start ~ end 之間每一天的索引；內容沒變的日期不重寫，
+    範圍內曾編譯過、但主題檔已不再包含的日期連同每日檔一起刪除。
+    回傳 {"written": n, "unchanged": n, "deleted": n, "missing": [...], "problems": [...]}
+    """
+    index, sources, problems = collect_sources(local_files)
+    missing = missing_dates(index, start, end)
+    report = {"written": 0, "unchanged": 0, "deleted": 0, "missing": missing, "problems": problems}
+    store = get_storage()
+
+    by_year = {}
+    for date_str in sorted(index):
+        if start.isoformat() <= date_str <= end.isoformat():
+            by_year.setdefault(date_str[:4], []).append(date_str)
+
+    for year in sorted(set(by_year) | {str(y) for y in range(start.year, end.year + 1)}):
+        manifest_path = get_theme_index_manifest_path(year)
+        manifest = read_object(manifest_path, cached=False) or {"dates": {}}
+        for date_str in by_year.get(year, []):
+            entry = {"date": date_str, "characters": index[date_str]}
+            digest = _digest(entry)
+            if manifest["dates"].get(date_str) == digest:
+                report["unchanged"] += 1
+                continue
+            write_object(get_theme_index_path(date_str), entry)
+            manifest["dates"][date_str] = digest
+            report["written"] += 1
+        stale = [d for d in manifest["dates"]
+                 if start.isoformat() <= d <= end.isoformat() and d not in by_year.get(year, [])]
+        for date_str in stale:
+            store.delete(get_theme_index_path(date_str))
+            del manifest["dates"][date_str]
+            report["deleted"] += 1
+        manifest.update({
+            "sources": sources,
+            "missing": [d for d in missing if d.startswith(year)],
+            "compiled_at": get_settings().now.isoformat(),
+        })
+        write_object(manifest_path, manifest)
+    return report
+
+
+def stale_sources(year: str) -> list:
+    """manifest 編譯後新增、修改或刪除的主題檔（本機檔不檢查）"""
+    store = get_storage()
+    manifest = read_object(get_theme_index_manifest_path(year), cached=False)
+    if manifest is None:
+        return [f"{year} 尚未編譯"]
+    compiled = {p: g for p, g in manifest.get("sources", {}).items() if p.startswith(THEME_SOURCE_PREFIX)}
+    current = {p: store.backend.stat(p) for p in _source_paths(store)}
+    return sorted(p for p in set(compiled) | set(current) if compiled.get(p) != current.get(p))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--year", default=get_settings().day.year, help="編譯整年（預設今年）")
+    parser.add_argument("--start", help="開始日期 YYYY-MM-DD（覆寫 --year）")
+    parser.add_argument("--end", help="結束日期 YYYY-MM-DD（覆寫 --year）")
+    parser.add_argument("--local", action="append", default=[], help="額外的本機主題檔（可重複）")
+    parser.add_argument("--allow-gaps", action="store_true", help="有日期缺主題時仍視為成功")
+    parser.add_argument("--check", action="store_true", help="只檢查主題檔在編譯後是否有變動")
+    args = parser.parse_args()
+
+    if args.check:
+        changed = stale_sources(str(args.year))
+        for path in changed:
+            print(f"⚠️ 主題檔在編譯後有變動：{path}")
+        if changed:
+            print("❌ 主題索引需要重新編譯")
+            sys.exit(1)
+        print("✅ 主題索引與主題檔一致")
+        return
+
+    start = date.fromisoformat(args.start) if args.start else date(int(args.year), 1, 1)
+    end = date.fromisoformat(args.end) if args.end else date(int(args.year), 12, 31)
+    report = compile_index(start, end, args.local)
+
+    for problem in report["problems"]:
+        print(f"⚠️ {problem}")
+    print(f"✅ 主題索引：寫入 {report['written']} 天，未變更 {report['unchanged']} 天，刪除 {report['deleted']} 天")
+    if report["missing"]:
+        print(f"❌ {len(report['missing'])} 天沒有主題：{', '.join(report['missing'][:20])}"
+              + (" ..." if len(report["missing"]) > 20 else ""))
+        if not args.allow_gaps:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# tokens.py
+# Token 計算與 prompt 預算：
+#   - 以 tiktoken 計算 token 數，encoder 每個行程只載入一次
+#   - 記憶內容依預算裁切，避免 prompt 無限制變長
+# DeepSeek 的 tokenizer 與 cl100k_base 不完全相同，但數量級一致，足以做預算控制；
+# 實際用量以 API 回傳的 usage 為準。
+import os
+import re
+from functools import lru_cache
+from settings import load_env
+
+load_env()
+
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "cl100k_base")
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))   # system + user prompt 上限
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "1500"))   # 其中記憶內容的上限
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = TOKEN_ENCODING):
+    """載入 tiktoken encoder；無法載入（例如離線且沒有快取）時回傳 None，改用估算"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        print(f"⚠️ 無法載入 tiktoken 編碼 {name}，改用字數估算：{e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = get_encoding()
+    if enc is None:
+        return max(1, len(text) // 4)   # 英文平均約 4 字元一個 token
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = "tail") -> str:
+    """裁切到 max_tokens 以內；keep="tail" 保留最後面（最新）的內容，"head" 保留開頭"""
+    if max_tokens <= 0:
+        return ""
+    enc = get_encoding()
+    if enc is None:
+        limit = max_tokens * 4
+        return text[-limit:] if keep == "tail" else text[:limit]
+    ids = enc.encode(text, disallowed_special=())
+    if len(ids) <= max_tokens:
+        return text
+    ids = ids[-max_tokens:] if keep == "tail" else ids[:max_tokens]
+    return enc.decode(ids)
+
+
+def fit_to_budget(text: str, budget: int) -> str:
+    """
+    把記憶內容切成段落（空行分隔），從最新的段落往回挑，直到用完預算。
+    最新一段本身就超過預算時，只保留它的結尾部分。
+    """
+    if not text or budget <= 0:
+        return ""
+    if count_tokens(text) <= budget:
+        return text
+
+    blocks = [b for b in re.split(r"\n\s*\n", text.strip()) if b.strip()]
+    selected, used = [], 0
+    for block in reversed(blocks):
+        cost = count_tokens(block) + 1
+        if used + cost > budget:
+            if not selected:
+                selected.append(truncate_to_tokens(block, budget, keep="tail"))
+            break
+        selected.append(block)
+        used += cost
+    return "\n\n".join(reversed(selected))
@@ -0,0 +1,153 @@
+# unit_of_work.py
+# 寫入延後合併（write-behind）：一位角色一次執行中的讀寫先暫存在記憶體，
+# commit 時每個路徑只上傳一次：
+#   - JSON（log.json 等）：同一路徑多次寫入只上傳最後一版；曾讀過的路徑以讀到的 generation 為前置條件
+#   - 週檔 append：多次附加合併成一個分段
+#   - 只在不存在時建立的檔案：commit 時以 if_generation_match=0 建立
+#   - after_commit(fn)：資料寫入後才執行（例如 checkpoint 標記完成，避免標記早於資料）
+# utils.read_json_from_firebase / write_json_to_firebase / append_txt_to_firebase 與
+# firebase_config.create_txt_if_missing 會自動使用目前執行緒綁定的 unit of work：
+#   with unit_of_work():           # 已有綁定時加入外層，不另外 commit
+#       ...
+import copy
+import threading
+from contextlib import contextmanager
+from storage_backend import get_storage, PreconditionError
+from serialization import decode, write_object
+from metrics import incr
+
+_local = threading.local()
+
+
+class UnitOfWork:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._generations = {}   # path → 讀取時的 generation（0 表示當時不存在）
+        self._reads = {}         # path → 讀到的內容
+        self._writes = {}        # path → 待寫入的內容
+        self._appends = {}       # (path, order_ns) → [text, ...]
+        self._creates = {}       # path → text（不存在時才建立）
+        self._hooks = []
+
+    # === 暫存 ===
+    def read(self, path: str, default=None):
+        """
+        先看暫存的寫入，再看讀過的內容，都沒有才讀取（回傳副本，修改不影響暫存）。
+        經由 CachedStorage 讀取，generation 取自快取物件（快取在 STORAGE_CACHE_TTL 內才免確認）；
+        若期間被其他程序改過，commit 時的前置條件會失敗並拋出 PreconditionError。
+        """
+        path = str(path)
+        with self._lock:
+            if path in self._writes:
+                incr("uow.read_coalesced")
+                return copy.deepcopy(self._writes[path])
+            if path not in self._reads:
+                obj = get_storage().read(path)
+                self._generations[path] = obj.generation if obj else 0
+                self._reads[path] = decode(obj.data) if obj else None
+            else:
+                incr("uow.read_coalesced")
+            value = self._reads[path]
+        return copy.deepcopy(value) if value is not None else default
+
+    def write(self, path: str, data):
+        with self._lock:
+            if str(path) in self._writes:
+                incr("uow.write_coalesced")
+            self._writes[str(path)] = copy.deepcopy(data)
+
+    def append(self, path: str, text: str, order_ns: int = None):
+        with self._lock:
+            self._appends.setdefault((str(path), order_ns), []).append(text)
+
+    def create_if_missing(self, path: str, text: str):
+        with self._lock:
+            self._creates.setdefault(str(path), text)
+
+    def after_commit(self, fn):
+        with self._lock:
+            self._hooks.append(fn)
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._writes) + len(self._appends) + len(self._creates) + len(self._hooks)
+
+    # === 寫出 ===
+    def commit(self):
+        """
+        依序寫出：建立檔案 → JSON → 附加文字 → after_commit；可重複呼叫（只寫出新的暫存）。
+        中途失敗（例如 PreconditionError）時拋出例外，尚未寫出的暫存與 hook 保留，可修正後再 commit 或 discard。
+        """
+        from firebase_config import write_txt_segment
+
+        with self._lock:
+            store = get_storage()
+            for path, text in list(self._creates.items()):
+                try:
+                    store.write(path, text.encode("utf-8"), content_type="text/plain", if_generation_match=0)
+                except PreconditionError:
+                    pass   # 已存在就保留原內容
+                del self._creates[path]
+            for path, data in list(self._writes.items()):
+                # 讀過的路徑以當時的 generation 為條件，期間被其他程序改過就拋出 PreconditionError
+                self._generations[path] = write_object(path, data, if_generation_match=self._generations.get(path))
+                self._reads[path] = data
+                del self._writes[path]
+            for (path, order_ns), texts in list(self._appends.items()):
+                write_txt_segment(path, "".join(texts), order_ns=order_ns)
+                del self._appends[(path, order_ns)]
+            while self._hooks:
+                # hook 執行成功才移除；hook 中新增的 hook 也會在這一輪執行
+                self._hooks[0]()
+                self._hooks.pop(0)
+
+    def savepoint(self):
+        """目前暫存的副本，交給 rollback 捨棄之後新增的暫存（例如同一個 unit 中後面的階段失敗時）"""
+        with self._lock:
+            return copy.deepcopy((self._writes, self._appends, self._creates)), list(self._hooks)
+
+    def rollback(self, savepoint):
+        with self._lock:
+            (self._writes, self._appends, self._creates), self._hooks = copy.deepcopy(savepoint[0]), list(savepoint[1])
+
+    def discard(self):
+        with self._lock:
+            self._writes.clear()
+            self._appends.clear()
+            self._creates.clear()
+            self._hooks.clear()
+
+    @contextmanager
+    def bind(self):
+        """在目前執行緒綁定此 unit of work（不自動 commit）"""
+        previous = getattr(_local, "current", None)
+        _local.current = self
+        try:
+            yield self
+        finally:
+            _local.current = previous
+
+
+def current_unit_of_work():
+    return getattr(_local, "current", None)
+
+
+@contextmanager
+def unit_of_work():
+    """
+    開啟一個 unit of work，正常結束時 commit、發生例外時捨棄。
+    目前執行緒已綁定其他 unit of work 時直接加入，由外層決定何時 commit。
+    """
+    outer = current_unit_of_work()
+    if outer is not None:
+        yield outer
+        return
+    uow = UnitOfWork()
+    with uow.bind():
+        try:
+            yield uow
+        except BaseException:
+            uow.discard()
+            raise
+    uow.commit()
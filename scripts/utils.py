@@ -2,36 +2,44 @@
 import os
 import json
 import re
-from firebase_admin import storage
-import tiktoken
+import hashlib
+import time
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from io import BytesIO
 from PIL import Image
-import requests
-from dotenv import load_dotenv
+import http_client
 from firebase_config import (
-    get_bucket,
     read_txt_from_firebase,
     write_txt_to_firebase,
+    create_txt_if_missing,
     get_theme_path,
     get_story_txt_path,
     get_log_json_path,
     get_error_log_path,
     get_memory_summary_path,
     get_memory_items_path,
+    get_txt_segment_prefix,
+    write_txt_segment,
 )
+from run_log import get_run_log_sink
+from settings import load_env, get_settings
+from storage_backend import get_storage, PreconditionError
+from rate_limit import get_limiter
+from response_parser import (
+    StreamingResponseParser,
+    ResponseFormatError,
+    parse_response,
+    parse_response_strict,
+)
+from completion_cache import completion_key, get_completion_cache
+from llm_router import Route, StreamInterrupted, LLM_ROUTE_RETRIES, get_router
+from serialization import read_object, write_object
+from unit_of_work import current_unit_of_work
+from image_encoder import encode_image_variants
+from tokens import count_tokens, fit_to_budget, PROMPT_TOKEN_BUDGET, MEMORY_TOKEN_BUDGET
 
-load_dotenv()
-
-# === 今日日期資訊 ===
-TIMEZONE = "Asia/Taipei"
-tz = ZoneInfo(TIMEZONE)
-now = datetime.now(tz)
-TODAY = now.strftime("%Y-%m-%d")     # 格式為 2025-06-23
-year = TODAY[:4]        # 格式為 "2025"
-month = TODAY[5:7]      # 結果會是 "06"
-year_month = TODAY[:7]  # 格式為 "2025-06"
+load_env()
 
 # === 日期與格式工具 ===
 def get_today_date_str():
@@ -62,41 +70,18 @@ def sanitize_for_json(obj: dict) -> dict:                  #將Python的Path物
 
 # === 雲端讀寫工具 ===
 def log_and_print(message: str, error_type: str = "info"):
+    """
+    印出訊息並交給 run_log 緩衝，批次寫入 logs/errors/{date}/ 分段檔（不在呼叫端等待上傳）。
+    """
     print(message)
 
-    # 設定檔案名稱與路徑
     now = datetime.now()
-    date_str = now.strftime("%Y-%m-%d")
-    log_path = get_error_log_path(date_str)
-
-    # 讀取現有 log 檔案（如果存在）
-    try:
-        bucket = get_bucket()
-        blob = bucket.blob(log_path)
-        if blob.exists():
-            content = blob.download_as_text()
-            log_data = json.loads(content)
-        else:
-            log_data = []
-    except Exception as e:
-        print(f"⚠️ 無法讀取現有錯誤日誌：{e}")
-        log_data = []
-        raise
-
-    # 加入新紀錄
     log_entry = {
         "timestamp": now.isoformat(),
         "type": error_type,
         "message": message
     }
-    log_data.append(log_entry)
-
-    # 寫入 Firebase
-    try:
-        json_str = json.dumps(log_data, ensure_ascii=False, indent=2)
-        blob.upload_from_string(json_str, content_type="application/json")
-    except Exception as e:
-        print(f"❌ 錯誤紀錄寫入失敗：{e}")
+    get_run_log_sink().emit(log_entry, now.strftime("%Y-%m-%d"))
 def update_log(log_path, updates: dict):
     """合併 log 資料並寫入 Firebase"""
     # 讀取原始資料
@@ -112,51 +97,108 @@ def update_log(log_path, updates: dict):
     write_json_to_firebase(str(log_path), log_data)
 def update_memory_summary(cid, week, new_summary):          #Firebase Storage
     """
-    合併寫入角色每週的記憶摘要（儲存在Firebase Storage）
+    附加角色每週的記憶摘要（儲存在Firebase Storage），以分段方式寫入，不改寫舊內容
     """
-    path = get_memory_summary_path(cid, week)  # 回傳類似 logs/memory/cid/2025/W25.txt
-
-    # 嘗試讀取舊的摘要內容
-    try:
-        old_summary = read_txt_from_firebase(path).strip()
-    except FileNotFoundError:
-        old_summary = ""
-
-    # 合併新內容
-    combined = f"{old_summary}\n\n=== Week {week} ===\n{new_summary}".strip()
-
-    # 上傳更新後的內容
-    write_txt_to_firebase(path, combined)
-def append_txt_to_firebase(path: str, content: str):
-    bucket = storage.bucket()
-    blob = bucket.blob(path)
-    # 先讀取現有內容（如果有）
-    if blob.exists():
-        existing = blob.download_as_text()
-    else:
-        existing = ""
-    # 合併後寫回去
-    updated = existing + content
-    blob.upload_from_string(updated, content_type="text/plain")
+    path = get_memory_summary_path(cid, week)  # 回傳類似 memory/cid/summary_week_W25.txt
+    append_txt_to_firebase(path, f"\n\n=== Week {week} ===\n{new_summary}")
+def append_txt_to_firebase(path: str, content: str, order_ns: int = None) -> str:
+    """
+    以分段方式附加文字：每次附加寫成 {path}.parts/ 底下一個新的小物件，
+    不再下載整份檔案再上傳。分段只用 if_generation_match=0 建立，
+    同時有多個程序附加也不會互相覆蓋。回傳分段路徑。
+    有綁定 unit of work 時先暫存，commit 時同一檔案的附加合併成一個分段（回傳空字串）。
+    order_ns 見 firebase_config.write_txt_segment。
+    """
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.append(path, content, order_ns=order_ns)
+        return ""
+    return write_txt_segment(path, content, order_ns=order_ns)
+TXT_MERGED_MARKER = "# merged-parts: "
+def _segment_tag(name: str) -> str:
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:12]
+def _split_merged_marker(text: str) -> tuple:
+    """回傳 (去掉合併標記行的內容, 已併入主檔的分段 tag 集合)"""
+    merged, lines = set(), []
+    for line in text.splitlines(keepends=True):
+        if line.startswith(TXT_MERGED_MARKER):
+            merged.update(line[len(TXT_MERGED_MARKER):].split())
+        else:
+            lines.append(line)
+    return "".join(lines), merged
+def iter_appended_txt(path: str):
+    """
+    依序逐段產出一份分段文字檔的內容：先是主檔（若存在），再依附加順序產出每個分段。
+    每段在被取用時才下載。主檔合併標記中列出的分段已在主檔中（合併後尚未刪除），略過。
+    """
+    store = get_storage()
+    merged = set()
+    base = store.read(path)
+    if base is not None:
+        text, merged = _split_merged_marker(base.text())
+        yield text
 
+    for name in store.list(get_txt_segment_prefix(path)):
+        if _segment_tag(name) in merged:
+            continue
+        segment = store.read(name)
+        if segment is not None:  # 剛好被 compact 合併掉的分段，內容已在主檔中
+            yield segment.text()
+def read_appended_txt(path: str) -> str:
+    """將主檔與所有分段組回一份完整文字"""
+    return "".join(iter_appended_txt(path))
+def compact_appended_txt(path: str) -> int:
+    """
+    用 GCS compose 把分段併回主檔，再刪除已合併的分段，回傳合併的分段數。
+    每次 compose 在主檔最後附上一行「# merged-parts: 分段 tag ...」，與分段內容同時生效：
+    合併後、刪除前讀取的人依此略過已併入的分段，不會重複；中途中斷時下次合併先刪除這些分段。
+    （只記錄確切的分段，補跑時之後才寫入、排序較前的分段不會被誤判為已合併。）
+    以主檔 generation 作為前置條件，若期間有人改寫主檔則放棄本次合併。
+    """
+    store = get_storage()
+    base = store.backend.read(path)
+    generation = base.generation if base else 0
+    merged = _split_merged_marker(base.text())[1] if base else set()
+    segments = []
+    for name in store.list(get_txt_segment_prefix(path)):
+        if _segment_tag(name) in merged:
+            store.delete(name)   # 上次合併後沒來得及刪除
+        else:
+            segments.append(name)
+    count = 0
+    # compose 一次最多 32 個來源（含主檔本身與合併標記）
+    for i in range(0, len(segments), 30):
+        batch = segments[i:i + 30]
+        marker = f"{path}.merge-{os.getpid()}-{time.time_ns()}"
+        line = TXT_MERGED_MARKER + " ".join(_segment_tag(name) for name in batch) + "\n"
+        store.write(marker, line.encode("utf-8"), content_type="text/plain")
+        sources = ([path] if generation else []) + batch + [marker]
+        try:
+            generation = store.compose(path, sources, content_type="text/plain", if_generation_match=generation)
+        except PreconditionError:
+            log_and_print(f"⚠️ 合併分段時主檔已被修改，略過：{path}", error_type="WARNING")
+            break
+        finally:
+            store.delete(marker)
+        for name in batch:
+            store.delete(name)
+        count += len(batch)
+    return count
 # === 檔案與日誌工具 ===
 def write_json_to_firebase(path: str, data: dict):
-    bucket = get_bucket()
-    blob = bucket.blob(path)  # ✅ 不再需要 Path() 處理
-
-    # 將 dict 轉成 JSON 並編碼為 bytes
-    json_str = json.dumps(data, ensure_ascii=False, indent=2)
-    buffer = BytesIO(json_str.encode("utf-8"))
-
-    blob.upload_from_file(buffer, content_type="application/json")
+    # 依物件類型選擇格式（緊湊 JSON / msgpack / gzip），見 serialization.py
+    # 有綁定 unit of work 時先暫存，commit 時每個路徑只上傳一次
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.write(str(path), data)
+        return
+    write_object(str(path), data)
 def read_json_from_firebase(path: str) -> dict:
     print(f"[DEBUG] 正在從 Firebase 讀取：{path}")
-    bucket = get_bucket()
-    blob = bucket.blob(str(path))
-    if not blob.exists():
-        return {}
-    content = blob.download_as_text()
-    return json.loads(content)
+    uow = current_unit_of_work()
+    if uow is not None:
+        return uow.read(str(path), default={})
+    return read_object(str(path), default={})
 def write_image_info(path, content):
     """
     將圖片上傳資訊寫入指定 JSON 檔案（Firebase Storage）
@@ -187,7 +229,8 @@ def get_today_characters(weekly_theme: dict, today: str) -> dict:
 def get_today_paths_path(year_month: str, today: str) -> str:
     return f"logs/today_paths/{year_month}/{today}.json"
 def get_today_paths():                                  #Firebase Storage
-    path = f"logs/today_paths/{year_month}/{TODAY}.json"
+    day = get_settings().day
+    path = get_today_paths_path(day.year_month, day.today)
     default_data = {}
 
     # 嘗試讀取 today_paths
@@ -231,20 +274,18 @@ def call_llm_for_story(character_card, theme_slug, memory_summary):
         "Do NOT include any other commentary, explanation, or text outside of this format.\n"
         "All prompts must be visual, concise, and suitable for use in image generation tools (no dialogue or captions)."
     )
+    # 記憶內容依 token 預算裁切：扣掉其他固定內容後剩下的額度，且不超過 MEMORY_TOKEN_BUDGET
+    base_tokens = count_tokens(system_prompt + build_prompt(character_name, theme_slug, ""))
+    memory_budget = min(MEMORY_TOKEN_BUDGET, PROMPT_TOKEN_BUDGET - base_tokens)
+    memory_summary = fit_to_budget(memory_summary or "", memory_budget)
+
     user_prompt = build_prompt(character_name, theme_slug, memory_summary)
     return system_prompt, user_prompt
 # === call Deepseek stoy ===
-def call_Deepseek_story(system_prompt: str, user_prompt: str, model="deepseek/deepseek-r1-0528:free") -> dict:
-    api_key = os.getenv("OR_DEEPKEEP_R1_API")  # 環境變數中讀取 key
-    if not api_key:
-        log_and_print(f"\n❌ 環境變數 OR_DEEPKEEP_R1_API 未設置！\n", error_type="ERROR")
-        raise SystemExit
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "X-Title": "AI_Animal_Story_Generator" 
-    }
-
+# 模型與端點由 llm_router 依 LLM_ROUTES 決定（失敗換路線、可選 hedge）；
+# ImgBB 端點可用環境變數覆寫（例如 benchmarks/ 的本機模擬服務）
+IMGBB_UPLOAD_URL = os.getenv("IMGBB_UPLOAD_URL", "https://api.imgbb.com/1/upload")
+def _build_story_payload(system_prompt: str, user_prompt: str, model: str) -> dict:
     data = {
         "model": model,
         "messages": [
@@ -253,17 +294,130 @@ def call_Deepseek_story(system_prompt: str, user_prompt: str, model="deepseek/de
         "temperature": 1.0,
         "max_tokens": 2048        
     }
+    return data
+def _build_story_headers(route: Route) -> dict:
+    api_key = os.getenv(route.key_env) if route.key_env else None  # 環境變數中讀取 key
+    if not api_key:
+        # 只讓這條路線失敗，交給 router 換下一條
+        raise RuntimeError(f"環境變數 {route.key_env or '(未設定)'} 未設置，無法使用 {route.name}")
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "X-Title": "AI_Animal_Story_Generator" 
+    }
+    return headers
+def _cache_if_well_formed(key: str, response: dict):
+    """只快取格式正確的回應，避免重跑時一直拿到同一份壞掉的輸出"""
+    try:
+        content = response["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return
+    if parse_response(content).ok:
+        get_completion_cache().put(key, response)
+def _story_cache_key(system_prompt: str, user_prompt: str) -> str:
+    """快取 key 以第一優先的模型計算，換路線拿到的回應也記在同一個 key 下"""
+    return completion_key(_build_story_payload(system_prompt, user_prompt, get_router().routes[0].model))
+def _send_story_stream(route: Route, cancel, system_prompt: str, user_prompt: str, on_delta=None) -> dict:
+    """
+    以 SSE 串流送出一次請求，on_delta(text) 逐段收到內容。
+    每讀到一行（含 keep-alive 註解）就檢查 cancel，被取消時關閉連線，hedge 輸掉的請求不會跑完整個生成。
+    已經收到內容後失敗拋出 StreamInterrupted。
+    """
+    data = _build_story_payload(system_prompt, user_prompt, route.model)
+    data["stream"] = True
+    data["stream_options"] = {"include_usage": True}   # 最後一個 chunk 附上 token 用量
+    content, model_used, usage = [], route.model, {}
+
+    response = http_client.post(
+        route.url,
+        headers=_build_story_headers(route),
+        json=data,
+        limiter=get_limiter(route.provider),
+        max_retries=LLM_ROUTE_RETRIES,
+        stream=True,
+    )
+    try:
+        response.raise_for_status()
+        for line in http_client.iter_lines(response):
+            if cancel.is_set():
+                raise RuntimeError("已取消")
+            # SSE：以 ":" 開頭是註解（OpenRouter 的 keep-alive），資料行為 "data: {...}"
+            if not line or not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            chunk = json.loads(payload)
+            if "error" in chunk:
+                raise RuntimeError(f"LLM 串流錯誤：{chunk['error']}")
+            model_used = chunk.get("model", model_used)
+            usage = chunk.get("usage") or usage
+            for choice in chunk.get("choices", []):
+                delta = choice.get("delta", {}).get("content") or ""
+                if delta:
+                    content.append(delta)
+                    if on_delta:
+                        on_delta(delta)
+    except ResponseFormatError:
+        raise
+    except Exception as e:
+        if content:
+            raise StreamInterrupted(f"{route.name} 串流中斷：{e}") from e
+        raise
+    finally:
+        response.close()   # 提早中斷或被取消時也要釋放連線
+    return {
+        "choices": [{"message": {"role": "assistant", "content": "".join(content)}}],
+        "model": model_used,
+        "usage": usage,
+    }
+def call_Deepseek_story(system_prompt: str, user_prompt: str, use_cache: bool = True) -> dict:
+    """
+    一次取得完整回應。底層同樣用串流，hedge 時輸掉的請求能真的中斷；
+    沒有下游回呼，所以中途斷線也可以換路線重來（StreamInterrupted 不視為致命錯誤）。
+    """
+    key = _story_cache_key(system_prompt, user_prompt)
+    if use_cache:
+        cached = get_completion_cache().get(key)
+        if cached is not None:
+            log_and_print(f"♻️ 使用 LLM 快取回應：{key[:12]}\n", error_type="OK")
+            return cached
+
+    def send(route: Route, cancel) -> dict:
+        return _send_story_stream(route, cancel, system_prompt, user_prompt)
 
-    response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=data)
-    response.raise_for_status()
-    return response.json()
-def count_tokens(text: str) -> int:
-    # 基本估算：用空白分隔詞彙數
-    return len(text.split())
+    result = get_router().call(send)
+    _cache_if_well_formed(key, result)
+    return result
+def call_Deepseek_story_stream(system_prompt: str, user_prompt: str, on_prompt=None, use_cache: bool = True) -> dict:
+    """
+    以 SSE 串流呼叫 LLM，邊收 token 邊解析段落：
+    - 每完成一行 prompt 就呼叫 on_prompt(index, prompt)，下游可以提早開始生圖
+    - 輸出明顯不符格式時立即中斷串流（拋出 ResponseFormatError），不必等到 max_tokens 用完
+    - 收到內容前失敗會換路線；已經收到內容（prompt 可能已回呼）後失敗則直接拋出。串流不做 hedge。
+    回傳格式與 call_Deepseek_story 相同（choices[0].message.content），可直接交給 extract_response_parts。
+    """
+    key = _story_cache_key(system_prompt, user_prompt)
+    parser = StreamingResponseParser(on_prompt=on_prompt)
+    if use_cache:
+        cached = get_completion_cache().get(key)
+        if cached is not None:
+            log_and_print(f"♻️ 使用 LLM 快取回應：{key[:12]}\n", error_type="OK")
+            parser.feed(cached["choices"][0]["message"]["content"])   # 照樣逐一回呼 prompt
+            parser.close()
+            return cached
+
+    def send(route: Route, cancel) -> dict:
+        return _send_story_stream(route, cancel, system_prompt, user_prompt, on_delta=parser.feed)
+
+    result = get_router().call(send, hedge=False, fatal=(ResponseFormatError, StreamInterrupted))
+    parser.close()
+    _cache_if_well_formed(key, result)
+    return result
 # 解析英文格式回傳（去除 LLM 加料的前言／後記)
 def extract_response(text: str) -> dict:
     """
-    從 LLM 的回應文字中萃取 story、summary 與 prompt_list。
+    從 LLM 的回應文字中萃取 story、summary 與 prompt_list（單次掃描並驗證）。
     預期格式如下：
     ###STORY:
     ...
@@ -273,66 +427,77 @@ def extract_response(text: str) -> dict:
     - ...
     - ...
     """
-    story_match = re.search(r"###STORY:\s*(.*?)\s*###SUMMARY:", text, re.DOTALL)
-    summary_match = re.search(r"###SUMMARY:\s*(.*?)\s*###PROMPTS:", text, re.DOTALL)
-    prompts_match = re.findall(r"-\s*(.+)", text.split("###PROMPTS:")[-1])
-
-    if not story_match or not summary_match or not prompts_match:
-        log_and_print("\n❌ extract_response 解析失敗，格式可能不符\n", "error")
+    try:
+        return parse_response_strict(text).as_dict()
+    except ResponseFormatError as e:
+        log_and_print(f"\n❌ extract_response 解析失敗，格式可能不符：{e}\n", "error")
         log_and_print(f"\n{text}\n")
-        raise RuntimeError("解析失敗")
-
-    return {
-        "story": story_match.group(1).strip(),
-        "summary": summary_match.group(1).strip(),
-        "prompt_list": [p.strip() for p in prompts_match]
-    }
+        raise
 def extract_response_parts(raw_response: dict) -> dict:
+    """解析 API 回應；格式錯誤不拋例外，記錄在 "parsed".errors 交給呼叫端決定是否重新生成"""
     content = raw_response["choices"][0]["message"]["content"]
     print(content)
+    parsed = parse_response(content)
     return {
-        "story": extract_between(content, "###STORY:", "###SUMMARY:"),
-        "summary": extract_between(content, "###SUMMARY:", "###PROMPTS:"),
-        "prompt_list": extract_list_after(content, "###PROMPTS:"),
+        **parsed.as_dict(),
+        "parsed": parsed,
         "model": raw_response.get("model", ""),
-        "duration": raw_response.get("duration", 0.0)
+        "duration": raw_response.get("duration", 0.0),
+        "usage": raw_response.get("usage") or {},
+        "content": content,
     }
-def extract_between(text: str, start_marker: str, end_marker: str) -> str:
+def build_repair_prompt(story: str, sections: set) -> tuple:
     """
-    從指定起止標記之間擷取文字
+    故事本身沒問題、只有摘要或 prompts 格式錯誤時，只請 LLM 重新產生這些段落。
+    回傳 (system_prompt, user_prompt)。
     """
-    try:
-        return text.split(start_marker)[1].split(end_marker)[0].strip()
-    except IndexError:
-        return ""
-def extract_list_after(text: str, marker: str) -> list:
-    """
-    從指定標記後提取 markdown 列表格式（- item）
-    """
-    try:
-        section = text.split(marker)[1]
-        return [line[1:].strip() for line in section.strip().split("\n") if line.startswith("-")]
-    except IndexError:
-        return []
+    wanted = [name for name in ("SUMMARY", "PROMPTS") if name in sections]
+    formats = {
+        "SUMMARY": "###SUMMARY:\n(1-2 sentence overview)",
+        "PROMPTS": "###PROMPTS:\n- prompt_1\n- prompt_2\n...\n- prompt_10",
+    }
+    system_prompt = (
+        "You are a visual storytelling artist and illustrator who specializes in creating emotional, wordless picture books. "
+        "You will be given a finished story. Please strictly reply using the following format:\n\n"
+        + "\n\n".join(formats[name] for name in wanted)
+        + "\n\nDo NOT include any other commentary, explanation, or text outside of this format.\n"
+        "All prompts must be visual, concise, and suitable for use in image generation tools (no dialogue or captions)."
+    )
+    user_prompt = f"Story:\n{story}\n\nPlease write only the {' and '.join(wanted).lower()} for this story."
+    return system_prompt, user_prompt
 # 圖片生成模擬（TODO: 換成實際生圖）
 def generate_image_from_prompt(prompt):
     img = Image.new("RGB", (512, 512), color="white")
     return img
-# 上傳圖片至 imgbb
-def upload_to_imgbb(image, name):
-    IMG_BB_API_KEY = os.getenv("IMG_BB_API_KEY")  # 環境變數中讀取 key
+# 圖片編碼（JPEG bytes，在呼叫端執行緒直接編碼；管線中改用 image_encoder.encode_image_variants）
+def encode_image(image, format: str = "JPEG") -> bytes:
     buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    encoded_img = buffered.getvalue()
+    image.save(buffered, format=format)
+    return buffered.getvalue()
+# 上傳已編碼的圖片至 imgbb（重試與 429 限流由 http_client 處理）
+def upload_bytes_to_imgbb(encoded_img: bytes, name: str):
+    uploaded = upload_image_to_imgbb(encoded_img, name)
+    return uploaded["url"] if uploaded else None
+def upload_image_to_imgbb(encoded_img: bytes, name: str):
+    """
+    上傳一次，回傳 {"url", "thumbnail_url"}；thumbnail_url 是 ImgBB 自動產生的縮圖（不必再上傳一次）。
+    失敗時回傳 None。
+    """
+    IMG_BB_API_KEY = os.getenv("IMG_BB_API_KEY")  # 環境變數中讀取 key
 
-    response = requests.post(
-        "https://api.imgbb.com/1/upload",   # ImgBB url
+    response = http_client.post(
+        IMGBB_UPLOAD_URL,
         params={"key": IMG_BB_API_KEY},
         files={"image": encoded_img},
-        data={"name": name}
+        data={"name": name},
+        limiter=get_limiter("imgbb"),
     )
     if response.status_code == 200:
-        return response.json()["data"]["url"]
+        data = response.json()["data"]
+        return {"url": data["url"], "thumbnail_url": (data.get("thumb") or {}).get("url")}
     else:
         log_and_print(f"❌ Upload failed:\n{response.text}\n", "error")
         return None
+# 上傳圖片至 imgbb（編碼在 image_encoder 的 process pool 中進行）
+def upload_to_imgbb(image, name):
+    return upload_bytes_to_imgbb(encode_image_variants(image)["data"], name)
@@ -0,0 +1,347 @@
+# work_queue.py
+# 以 bucket 為基礎的分散式工作佇列，讓多台機器分攤同一天的角色：
+#   queue/{date}/{cid}_{stage}.json    每個 (日期, 角色, 階段) 一個物件
+#   {"date", "character", "stage", "info", "state": pending|leased|done|failed,
+#    "owner", "lease_until", "attempts", "not_before", "error"}
+# - 所有狀態變更都以 if_generation_match 條件寫入，同一個項目同時只會有一個 worker 搶到；
+#   worker 列出一次佇列後重複使用快照，搶項目時只重新讀取該項目
+# - 搶到的項目帶有租約（WORK_LEASE_SECONDS），執行期間背景 heartbeat 續約；
+#   worker 當機時租約過期，其他 worker 可以接手（steal）
+# - 階段的寫入都暫存在 unit of work，完成時確認租約仍在才 commit，
+#   被接手的舊 worker 不會覆蓋新 worker 的結果（log.json 也以讀取時的 generation 為條件）
+# - image 要等同一角色的 story 完成才能被搶；story 最終失敗時 image 直接標記為失敗
+#   python work_queue.py enqueue [--date 2025-06-23]     建立當天的 story 檔與佇列（可重複執行）
+#   python work_queue.py work [--date ...] [--threads 2]  在這台機器上處理，直到當天的項目都結束
+#   python work_queue.py status [--date ...]
+import os
+import sys
+import json
+import time
+import random
+import socket
+import secrets
+import argparse
+import threading
+from settings import load_env, get_settings, DayContext
+from storage_backend import get_storage, PreconditionError
+from serialization import decode, write_object
+from firebase_config import get_work_queue_prefix, get_work_item_path
+from unit_of_work import UnitOfWork
+from metrics import incr, span, write_run_summary
+
+load_env()
+
+WORK_LEASE_SECONDS = float(os.getenv("WORK_LEASE_SECONDS", "300"))
+WORK_HEARTBEAT_SECONDS = float(os.getenv("WORK_HEARTBEAT_SECONDS", str(WORK_LEASE_SECONDS / 3)))
+WORK_LEASE_GRACE = float(os.getenv("WORK_LEASE_GRACE", "10"))     # 容許各機器時鐘的誤差
+WORK_MAX_ATTEMPTS = int(os.getenv("WORK_MAX_ATTEMPTS", "3"))
+WORK_RETRY_DELAY = float(os.getenv("WORK_RETRY_DELAY", "30"))     # 失敗後多久才能再被搶（依次數加倍）
+WORK_POLL_SECONDS = float(os.getenv("WORK_POLL_SECONDS", "5"))
+
+STAGES = ("story", "image")
+DEPENDS = {"image": "story"}
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(2)}"
+
+
+# === 建立佇列 ===
+def enqueue(date_str: str, today_paths: dict) -> int:
+    """每位角色的每個階段建立一個項目（已存在就保留原狀態），回傳新建的數量"""
+    created = 0
+    for cid, info in today_paths.items():
+        if "theme" not in info:
+            continue
+        for stage in STAGES:
+            item = {"date": date_str, "character": cid, "stage": stage, "info": info,
+                    "state": "pending", "owner": None, "lease_until": 0, "attempts": 0,
+                    "not_before": 0, "error": None}
+            try:
+                write_object(get_work_item_path(date_str, cid, stage), item, if_generation_match=0)
+                created += 1
+            except PreconditionError:
+                pass
+    return created
+
+
+def enqueue_day(day: DayContext) -> int:
+    """執行當天的 setup（有 checkpoint，可重複）後建立佇列"""
+    from setup_today_structure import setup_day
+    return enqueue(day.today, setup_day(day))
+
+
+# === 租約 ===
+class Lease:
+    """worker 持有中的項目；背景 heartbeat 續約，續約失敗（被接手）時 lost=True"""
+    def __init__(self, path: str, item: dict, generation: int, owner: str, lease_seconds: float):
+        self.path = path
+        self.item = item
+        self.generation = generation
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _write(self, **changes) -> bool:
+        with self._lock:
+            if self.lost:
+                return False
+            item = {**self.item, **changes}
+            try:
+                self.generation = write_object(self.path, item, if_generation_match=self.generation)
+            except PreconditionError:
+                self.lost = True
+                incr("queue.lease_lost")
+                return False
+            self.item = item
+            return True
+
+    def renew(self) -> bool:
+        return self._write(lease_until=time.time() + self.lease_seconds)
+
+    def start_heartbeat(self, interval: float = WORK_HEARTBEAT_SECONDS):
+        def beat():
+            while not self._stop.wait(interval):
+                try:
+                    if not self.renew():
+                        print(f"⚠️ 租約已被其他 worker 接手：{self.path}")
+                        return
+                except Exception as e:
+                    print(f"⚠️ 續約失敗（稍後再試）：{self.path}：{e}")
+        self._thread = threading.Thread(target=beat, daemon=True, name=f"heartbeat:{self.path}")
+        self._thread.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def complete(self) -> bool:
+        return self._write(state="done", owner=None, lease_until=0, error=None)
+
+    def fail(self, error: Exception) -> bool:
+        attempts = self.item["attempts"]
+        final = attempts >= WORK_MAX_ATTEMPTS
+        return self._write(state="failed" if final else "pending", owner=None, lease_until=0,
+                           error=str(error), not_before=time.time() + WORK_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+# === 佇列 ===
+class WorkQueue:
+    def __init__(self, date_str: str, owner: str = None, lease_seconds: float = WORK_LEASE_SECONDS):
+        self.date = date_str
+        self.owner = owner or worker_id()
+        self.lease_seconds = lease_seconds
+
+    def items(self) -> dict:
+        """{path: (item, generation)}（不經過快取，狀態要是最新的）"""
+        store = get_storage()
+        result = {}
+        for path in store.list(get_work_queue_prefix(self.date)):
+            obj = store.backend.read(path)
+            if obj is not None:
+                result[path] = (decode(obj.data), obj.generation)
+        return result
+
+    def _refresh(self, path: str, items: dict):
+        """只重新讀取一個項目（不經過快取）並更新 items，回傳 (item, generation)；已不存在時回傳 None"""
+        obj = get_storage().backend.read(path)
+        if obj is None:
+            items.pop(path, None)
+            return None
+        items[path] = (decode(obj.data), obj.generation)
+        return items[path]
+
+    @staticmethod
+    def _expired(item: dict, now: float) -> bool:
+        return item["state"] == "leased" and now > item["lease_until"] + WORK_LEASE_GRACE
+
+    def _dependency(self, item: dict, items: dict):
+        dep = DEPENDS.get(item["stage"])
+        entry = items.get(get_work_item_path(self.date, item["character"], dep)) if dep else None
+        return entry[0] if entry else None
+
+    def _finished(self, item: dict, items: dict, now: float) -> bool:
+        if item["state"] in ("done", "failed"):
+            return True
+        if item["state"] == "pending" and self._blocked(item, items, now):
+            return True
+        # 租約過期且已用完重試次數：不再接手，視為失敗
+        return self._expired(item, now) and item["attempts"] >= WORK_MAX_ATTEMPTS
+
+    def _blocked(self, item: dict, items: dict, now: float) -> bool:
+        """相依的階段已經結束但沒有成功（例如 story 失敗），這個項目永遠不會能執行"""
+        dep = self._dependency(item, items)
+        return dep is not None and dep["state"] != "done" and self._finished(dep, items, now)
+
+    def _skip_blocked(self, items: dict, now: float):
+        """把相依階段失敗的項目標記為失敗，狀態上看得出原因（寫入衝突時下一輪再處理）"""
+        for path, (item, generation) in items.items():
+            if item["state"] != "pending" or not self._blocked(item, items, now):
+                continue
+            skipped = {**item, "state": "failed", "error": f"相依的 {DEPENDS[item['stage']]} 階段失敗，略過"}
+            try:
+                items[path] = (skipped, write_object(path, skipped, if_generation_match=generation))
+                incr("queue.skipped")
+            except PreconditionError:
+                pass
+
+    def _claimable(self, item: dict, items: dict, now: float) -> bool:
+        if item["state"] == "pending":
+            ready = now >= item.get("not_before", 0)
+        else:
+            ready = self._expired(item, now) and item["attempts"] < WORK_MAX_ATTEMPTS
+        if not ready:
+            return False
+        if DEPENDS.get(item["stage"]):
+            dep = self._dependency(item, items)
+            return dep is not None and dep["state"] == "done"
+        return True
+
+    def claim(self, items: dict = None):
+        """
+        搶一個可執行的項目，回傳 Lease；沒有可搶的項目時回傳 None。
+        items 是之前列出的快照：只重新讀取要搶的候選項目，以讀到的 generation 為條件寫入租約，
+        並把結果寫回 items（快照可以重複用在下一次 claim）。
+        """
+        items = self.items() if items is None else items
+        now = time.time()
+        self._skip_blocked(items, now)
+        candidates = [path for path, (item, _) in items.items() if self._claimable(item, items, now)]
+        # 打亂順序減少多個 worker 搶同一個項目的衝突，再讓前面的階段優先
+        random.shuffle(candidates)
+        candidates.sort(key=lambda path: STAGES.index(items[path][0]["stage"]))
+        for path in candidates:
+            entry = self._refresh(path, items)
+            if entry is None or not self._claimable(entry[0], items, time.time()):
+                continue
+            item, generation = entry
+            stolen = item["state"] == "leased"
+            claimed = {**item, "state": "leased", "owner": self.owner, "attempts": item["attempts"] + 1,
+                       "lease_until": time.time() + self.lease_seconds}
+            try:
+                new_generation = write_object(path, claimed, if_generation_match=generation)
+            except PreconditionError:
+                incr("queue.conflict")
+                continue
+            items[path] = (claimed, new_generation)
+            incr("queue.stolen" if stolen else "queue.claimed")
+            if stolen:
+                print(f"⚠️ 接手過期的項目（原本由 {item['owner']} 處理）：{path}")
+            return Lease(path, claimed, new_generation, self.owner, self.lease_seconds)
+        return None
+
+    def status(self, items: dict = None) -> dict:
+        items = self.items() if items is None else items
+        now = time.time()
+        counts = {}
+        for item, _ in items.values():
+            state = "expired" if self._expired(item, now) else item["state"]
+            counts[state] = counts.get(state, 0) + 1
+        return {"date": self.date, "total": len(items), "states": counts,
+                "finished": all(self._finished(item, items, now) for item, _ in items.values())}
+
+
+# === 執行 ===
+def run_stage(item: dict):
+    from generate_story import generate_character_story
+    from generate_image import generate_all_images
+    day = DayContext.for_date(item["date"])
+    if item["stage"] == "story":
+        return generate_character_story(item["character"], item["info"], day=day)
+    return generate_all_images({item["character"]: item["info"]}, day)
+
+
+def _stage_done(item: dict) -> bool:
+    """以 checkpoint 判斷階段是否真的完成（例如圖片階段可能只成功一部分）"""
+    from checkpoint import Checkpoint
+    state = Checkpoint(item["character"], item["date"], item["info"]["theme"]).load()
+    return item["stage"] in state["stages"]
+
+
+def process(lease: Lease):
+    """執行一個項目：寫入暫存在 unit of work，確認租約仍在才 commit"""
+    item = lease.item
+    uow = UnitOfWork()
+    lease.start_heartbeat()
+    try:
+        with span(f"queue.{item['stage']}", character=item["character"], date=item["date"]):
+            with uow.bind():
+                run_stage(item)
+            if lease.lost or not lease.renew():
+                uow.discard()
+                print(f"⚠️ 租約已失去，放棄寫入：{lease.path}")
+                return
+            uow.commit()
+        if not _stage_done(item):
+            raise RuntimeError(f"{item['stage']} 未完成")
+        lease.complete()
+        incr("queue.completed")
+    except Exception as e:
+        uow.discard()
+        print(f"❌ [{item['character']}] {item['date']} {item['stage']} 失敗：{e}")
+        incr("queue.failed")
+        lease.fail(e)
+    finally:
+        lease.stop_heartbeat()
+
+
+def work(date_str: str, owner: str = None, poll: float = WORK_POLL_SECONDS) -> dict:
+    """
+    持續搶項目執行，直到當天所有項目都完成或失敗；回傳最後的狀態。
+    只在快照裡沒有可搶的項目時才重新列出整個佇列，每次搶只重新讀取候選項目。
+    """
+    queue = WorkQueue(date_str, owner)
+    items, fresh = queue.items(), True
+    while True:
+        lease = queue.claim(items)
+        if lease is not None:
+            process(lease)
+            items[lease.path] = (lease.item, lease.generation)
+            fresh = False
+            continue
+        if fresh:
+            status = queue.status(items)
+            if status["finished"]:
+                return status
+            # 其他 worker 還在處理（或等待重試 / 相依階段）：稍後再看，租約過期時就能接手
+            time.sleep(poll * random.uniform(0.5, 1.5))
+        items, fresh = queue.items(), True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("enqueue", "work", "status"):
+        cmd = sub.add_parser(name)
+        cmd.add_argument("--date", help="日期 YYYY-MM-DD（預設今天）")
+        if name == "work":
+            cmd.add_argument("--threads", type=int, default=1, help="這台機器同時處理的項目數")
+    args = parser.parse_args()
+    day = DayContext.for_date(args.date) if args.date else get_settings().day
+
+    if args.command == "enqueue":
+        print(f"✅ {day.today} 新增 {enqueue_day(day)} 個項目")
+    elif args.command == "status":
+        print(json.dumps(WorkQueue(day.today).status(), ensure_ascii=False, indent=2))
+    else:
+        owner = worker_id()
+        threads = [threading.Thread(target=work, args=(day.today, f"{owner}-{i}"), name=f"worker-{i}")
+                   for i in range(max(1, args.threads))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        status = WorkQueue(day.today).status()
+        print(json.dumps(status, ensure_ascii=False, indent=2))
+        write_run_summary("queue", day.today)
+        unfinished = status["states"].get("failed", 0) + status["states"].get("expired", 0)
+        return 0 if unfinished == 0 else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+# conftest.py
+# 測試一律使用本機 backend（LocalBackend），不需要 Firebase；
+# scripts/ 的模組以檔名直接 import，跟腳本執行時相同。
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "scripts"))
+
+# 模組在 import 時讀取環境變數，必須在 import 之前設定
+_tmp = tempfile.mkdtemp(prefix="ai_animal_story_test_")
+os.environ.setdefault("STORAGE_BACKEND", "local")
+os.environ.setdefault("LOCAL_STORAGE_ROOT", os.path.join(_tmp, "bucket"))
+os.environ.setdefault("STORAGE_CACHE_DIR", os.path.join(_tmp, "cache"))
+
+import metrics  # noqa: E402
+from storage_backend import CachedStorage, LocalBackend, get_storage, set_storage  # noqa: E402
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return LocalBackend(str(tmp_path / "bucket"))
+
+
+@pytest.fixture
+def storage(backend, tmp_path):
+    """每個測試一個獨立的 bucket 與磁碟快取，並替換成共用實例"""
+    previous = get_storage()
+    store = CachedStorage(backend, cache_dir=str(tmp_path / "cache"), ttl=60)
+    set_storage(store)
+    metrics.reset()
+    yield store
+    set_storage(previous)
+
+
+def counter(name: str) -> float:
+    return metrics.snapshot()["counters"].get(name, 0)
@@ -0,0 +1,43 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from response_parser import EXPECTED_PROMPTS, ResponseFormatError, StreamingResponseParser, parse_response
+
+CORPUS = Path(__file__).resolve().parent.parent / "benchmarks" / "parser_corpus"
+EXPECTED = json.loads((CORPUS / "expected.json").read_text(encoding="utf-8"))
+
+
+def load(name: str) -> str:
+    return (CORPUS / name).read_bytes().decode("utf-8")   # 保留 CRLF
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_corpus_errors(name):
+    parsed = parse_response(load(name))
+    assert [[e.section, e.code] for e in parsed.errors] == EXPECTED[name]
+    if name.startswith("valid_"):
+        assert parsed.story and parsed.summary
+        assert len(parsed.prompts) == EXPECTED_PROMPTS
+
+
+@pytest.mark.parametrize("name", sorted(n for n in EXPECTED if n.startswith("valid_")))
+@pytest.mark.parametrize("chunk", [1, 7, 4096])
+def test_streaming_matches_full_parse(name, chunk):
+    text = load(name)
+    emitted = []
+    parser = StreamingResponseParser(on_prompt=lambda index, prompt: emitted.append((index, prompt)))
+    for i in range(0, len(text), chunk):
+        parser.feed(text[i:i + chunk])
+    parsed = parser.finish()
+    full = parse_response(text)
+    assert (parsed.story, parsed.summary, parsed.prompts) == (full.story, full.summary, full.prompts)
+    assert emitted == list(enumerate(full.prompts, 1))
+
+
+def test_streaming_aborts_on_out_of_order_markers():
+    parser = StreamingResponseParser()
+    with pytest.raises(ResponseFormatError):
+        parser.feed(load("malformed_out_of_order.txt"))
+        parser.finish()
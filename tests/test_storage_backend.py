@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from conftest import counter
+from storage_backend import CachedStorage, LocalBackend, NOT_MODIFIED, PreconditionError
+
+
+# === LocalBackend ===
+def test_local_create_only_once(backend):
+    backend.write("a.json", b"1", if_generation_match=0)
+    with pytest.raises(PreconditionError):
+        backend.write("a.json", b"2", if_generation_match=0)
+    assert backend.read("a.json").data == b"1"
+
+
+def test_local_generation_increases_and_guards_writes(backend):
+    first = backend.write("a.json", b"1")
+    second = backend.write("a.json", b"2", if_generation_match=first)
+    assert second > first
+    with pytest.raises(PreconditionError):
+        backend.write("a.json", b"3", if_generation_match=first)
+    assert backend.read("a.json", if_generation_not_match=second) is NOT_MODIFIED
+    assert backend.read("missing.json") is None
+
+
+def test_local_list_and_compose(backend):
+    backend.write("p/b.txt", b"B")
+    backend.write("p/a.txt", b"A")
+    backend.write("q/c.txt", b"C")
+    assert backend.list("p/") == ["p/a.txt", "p/b.txt"]
+    assert set(backend.list_updated("p/")) == {"p/a.txt", "p/b.txt"}
+    backend.compose("p/all.txt", ["p/a.txt", "p/b.txt"])
+    assert backend.read("p/all.txt").data == b"AB"
+
+
+# === CachedStorage ===
+def test_cached_read_within_ttl_skips_backend(storage):
+    storage.write("a.json", b"1")
+    assert storage.read("a.json").data == b"1"
+    assert counter("storage.read") == 0
+    assert counter("cache.storage.lru_hit") == 1
+
+
+def test_cached_revalidates_after_ttl(backend, tmp_path):
+    writer = CachedStorage(backend, cache_dir=str(tmp_path / "w"), ttl=60)
+    reader = CachedStorage(backend, cache_dir=str(tmp_path / "r"), ttl=0)
+    writer.write("a.json", b"1")
+    assert reader.read("a.json").data == b"1"
+
+    # 沒變：條件讀取回傳 NOT_MODIFIED，沿用快取的內容
+    before = counter("storage.read.not_modified")
+    assert reader.read("a.json").data == b"1"
+    assert counter("storage.read.not_modified") == before + 1
+
+    # 其他行程更新後，過了 TTL 就會讀到新內容
+    writer.write("a.json", b"2")
+    assert reader.read("a.json").data == b"2"
+
+
+def test_cached_serves_stale_within_ttl(backend, tmp_path):
+    writer = CachedStorage(backend, cache_dir=str(tmp_path / "w"), ttl=60)
+    reader = CachedStorage(backend, cache_dir=str(tmp_path / "r"), ttl=60)
+    writer.write("a.json", b"1")
+    assert reader.read("a.json").data == b"1"
+    writer.write("a.json", b"2")
+    assert reader.read("a.json").data == b"1"
+    reader.invalidate("a.json")
+    assert reader.read("a.json").data == b"2"
+
+
+def test_disk_cache_shared_between_instances(backend, tmp_path):
+    CachedStorage(backend, cache_dir=str(tmp_path / "c"), ttl=60).write("a.json", b"1")
+    other = CachedStorage(backend, cache_dir=str(tmp_path / "c"), ttl=60)
+    before = counter("cache.storage.disk_hit")
+    assert other.read("a.json").data == b"1"
+    assert counter("cache.storage.disk_hit") == before + 1
+
+
+def test_disk_cache_keyed_by_backend(tmp_path):
+    a = CachedStorage(LocalBackend(str(tmp_path / "a")), cache_dir=str(tmp_path / "c"), ttl=60)
+    b = CachedStorage(LocalBackend(str(tmp_path / "b")), cache_dir=str(tmp_path / "c"), ttl=60)
+    a.write("x.json", b"A")
+    b.write("x.json", b"B")
+    fresh = CachedStorage(LocalBackend(str(tmp_path / "a")), cache_dir=str(tmp_path / "c"), ttl=60)
+    assert fresh.read("x.json").data == b"A"
+
+
+def test_write_only_objects_bypass_cache(storage):
+    storage.write("characters/c/2025/w.txt.parts/0001.txt", b"part")
+    storage.write("logs/errors/2025-01-01/run_0001.jsonl", b"{}\n")
+    assert not any(storage.cache_dir.iterdir())
+    assert storage.read("characters/c/2025/w.txt.parts/0001.txt").data == b"part"
+
+
+def test_disk_cache_prunes_to_size(backend, tmp_path):
+    store = CachedStorage(backend, cache_dir=str(tmp_path / "c"), ttl=60, max_bytes=3000)
+    for i in range(6):
+        store.write(f"{i}.json", b"x" * 1000)
+    store.prune_disk()
+    assert sum(os.path.getsize(p) for p in store.cache_dir.iterdir()) <= 3000
+    # 最近寫入的項目保留
+    assert CachedStorage(backend, cache_dir=str(tmp_path / "c"), ttl=60, max_bytes=3000)._disk_get("5.json")[0]
+
+
+def test_precondition_failure_invalidates(storage, backend):
+    generation = storage.write("a.json", b"1")
+    backend.write("a.json", b"2")
+    with pytest.raises(PreconditionError):
+        storage.write("a.json", b"3", if_generation_match=generation)
+    assert storage.read("a.json").data == b"2"
@@ -0,0 +1,72 @@
+import pytest
+
+from serialization import read_object, write_object
+from storage_backend import PreconditionError
+from unit_of_work import UnitOfWork, current_unit_of_work, unit_of_work
+
+
+def test_writes_are_coalesced_until_commit(storage):
+    uow = UnitOfWork()
+    uow.write("logs/a.json", {"v": 1})
+    uow.write("logs/a.json", {"v": 2})
+    assert read_object("logs/a.json") is None
+    assert uow.read("logs/a.json") == {"v": 2}
+    uow.commit()
+    assert read_object("logs/a.json") == {"v": 2}
+    assert uow.pending == 0
+
+
+def test_commit_fails_when_read_object_changed(storage, backend):
+    write_object("logs/a.json", {"v": 1})
+    uow = UnitOfWork()
+    assert uow.read("logs/a.json") == {"v": 1}
+    # 其他程序在讀取後改寫：直接寫 backend，不經過這個行程的快取
+    storage.invalidate("logs/a.json")
+    write_object("logs/a.json", {"v": "other"})
+    uow.write("logs/a.json", {"v": 2})
+    with pytest.raises(PreconditionError):
+        uow.commit()
+    assert read_object("logs/a.json", cached=False) == {"v": "other"}
+    assert uow.pending == 1   # 暫存保留，可 discard 或重試
+
+
+def test_create_only_if_missing(storage):
+    write_object("logs/a.json", {"v": 1})
+    uow = UnitOfWork()
+    uow.write("logs/a.json", {"v": 2})
+    uow.create_if_missing("story.txt", "first")
+    uow.commit()
+    uow.create_if_missing("story.txt", "second")
+    uow.commit()
+    assert storage.read("story.txt").text() == "first"
+
+
+def test_after_commit_runs_after_data(storage):
+    seen = []
+    uow = UnitOfWork()
+    uow.write("logs/a.json", {"v": 1})
+    uow.after_commit(lambda: seen.append(read_object("logs/a.json")))
+    uow.commit()
+    assert seen == [{"v": 1}]
+
+
+def test_context_discards_on_error(storage):
+    with pytest.raises(ValueError):
+        with unit_of_work() as uow:
+            uow.write("logs/a.json", {"v": 1})
+            raise ValueError
+    assert read_object("logs/a.json") is None
+    assert current_unit_of_work() is None
+
+
+def test_rollback_to_savepoint_keeps_earlier_writes(storage):
+    uow = UnitOfWork()
+    uow.write("logs/setup.json", {"v": 1})
+    savepoint = uow.savepoint()
+    uow.write("logs/setup.json", {"v": 2})
+    uow.write("logs/story.json", {"v": 1})
+    uow.after_commit(lambda: pytest.fail("hook should have been rolled back"))
+    uow.rollback(savepoint)
+    uow.commit()
+    assert read_object("logs/setup.json") == {"v": 1}
+    assert read_object("logs/story.json") is None
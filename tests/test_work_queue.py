@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+import work_queue
+from work_queue import WorkQueue, enqueue
+
+DATE = "2025-01-01"
+PATHS = {"c1": {"theme": "baking_day"}}
+
+
+@pytest.fixture(autouse=True)
+def no_grace(monkeypatch):
+    monkeypatch.setattr(work_queue, "WORK_LEASE_GRACE", 0)
+
+
+def test_enqueue_is_idempotent(storage):
+    assert enqueue(DATE, PATHS) == 2
+    assert enqueue(DATE, PATHS) == 0
+
+
+def test_image_waits_for_story(storage):
+    enqueue(DATE, PATHS)
+    queue = WorkQueue(DATE, owner="a")
+    story = queue.claim()
+    assert story.item["stage"] == "story"
+    assert queue.claim() is None
+    story.complete()
+    assert queue.claim().item["stage"] == "image"
+
+
+def test_expired_lease_is_stolen(storage):
+    enqueue(DATE, PATHS)
+    first = WorkQueue(DATE, owner="a", lease_seconds=0.05).claim()
+    other = WorkQueue(DATE, owner="b")
+    assert other.claim() is None          # 租約還在
+    time.sleep(0.1)
+    stolen = other.claim()
+    assert stolen.path == first.path
+    assert stolen.item["owner"] == "b" and stolen.item["attempts"] == 2
+    # 原本的 worker 續約或完成都會失敗，不會覆蓋新 worker 的結果
+    assert first.renew() is False and first.lost
+    assert first.complete() is False
+    assert stolen.complete() is True
+
+
+def test_heartbeat_keeps_lease(storage):
+    enqueue(DATE, PATHS)
+    lease = WorkQueue(DATE, owner="a", lease_seconds=0.2).claim()
+    lease.start_heartbeat(interval=0.05)
+    try:
+        time.sleep(0.4)
+        assert WorkQueue(DATE, owner="b").claim() is None
+    finally:
+        lease.stop_heartbeat()
+    assert not lease.lost
+
+
+def test_exhausted_attempts_fail_dependents(storage, monkeypatch):
+    monkeypatch.setattr(work_queue, "WORK_MAX_ATTEMPTS", 1)
+    enqueue(DATE, PATHS)
+    queue = WorkQueue(DATE, owner="a")
+    queue.claim().fail(RuntimeError("boom"))
+    assert queue.claim() is None
+    status = queue.status()
+    assert status["finished"] and status["states"] == {"failed": 2}
+
+
+def test_claim_rereads_only_the_candidate(storage):
+    enqueue(DATE, {f"c{i}": {"theme": "t"} for i in range(3)})
+    queue = WorkQueue(DATE, owner="a")
+    items = queue.items()
+    # 快照之後被其他 worker 搶走的項目：重新讀取候選時發現，改搶下一個
+    taken = WorkQueue(DATE, owner="b").claim()
+    lease = queue.claim(items)
+    assert lease.path != taken.path
+    assert items[taken.path][0]["owner"] == "b"
+    assert items[lease.path][0]["owner"] == "a"